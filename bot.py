@@ -5,7 +5,7 @@ Features:
 - Super admin + permissioned admins
 - Groups: members, settings (tg chat id, kick limits), group tests inline
 - Tests: create, assign (public or multi-group), pause/resume/finish, global rating (text+pdf)
-- Results: user submit (no SMS), group manual results, import results (from DB) + optional notify
+- Results: user submit (no SMS), group manual results, import results (CSV/XLSX upload) + optional notify
 - Attendance: daily mark (X only), archive, send DM to absent users, attendance PDF with group name
 - Tasks: create with deadline + points + optional media, publish alerts, students submit any media, one submission, admin grades, auto-kick for missed tasks
 - Global broadcast supports media
@@ -17,15 +17,26 @@ import logging
 import os
 import time
 import shutil
+import io
+import gzip
+import csv
+import tempfile
 import zipfile
 import random
 import re
 import sqlite3
 import string
 import html
+import threading
+import bisect
+import functools
+import heapq
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from typing import Optional, List, Tuple
+from typing import Any, Mapping, Optional, List, Tuple, Sequence, Iterable, Iterator
 
 
 def row_get(row, key, default=None):
@@ -51,14 +62,21 @@ from aiogram.filters import CommandStart, Command
 from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
-    FSInputFile
+    FSInputFile, BufferedInputFile
 )
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
 # ---- PDF (fpdf) ----
-from fpdf import FPDF
+from fpdf import FPDF, FPDF_VERSION
+try:
+    # private fpdf2 internals, only used by PdfFonts' clone fast path (add_font otherwise)
+    from fpdf.fonts import TTFFont, SubsetMap
+    from fontTools import ttLib
+except ImportError:
+    TTFFont = SubsetMap = ttLib = None
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
@@ -95,6 +113,26 @@ API_TOKEN = os.getenv("BOT_TOKEN", "")  # set in hosting env
 # fallback for local dev (optional): set BOT_TOKEN in env
 SUPER_ADMIN_ID = 7880323063
 DB_NAME = os.getenv("DB_PATH", "test_educenter.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))  # idle SQLite connections kept open
+DB_PRAGMA_PROFILE = os.getenv("DB_PRAGMA_PROFILE", "production").strip().lower()  # production / safe / legacy
+DB_THREADS = int(os.getenv("DB_THREADS", str(DB_POOL_SIZE)))  # DB executor worker threads
+DB_INLINE = os.getenv("DB_INLINE", "0") == "1"  # run DB calls on the event loop (baseline for /db_stats)
+REPORT_THREADS = int(os.getenv("REPORT_THREADS", "2"))  # PDF report render threads
+PDF_FONT_DIR = os.getenv("PDF_FONT_DIR", "")  # dir with DejaVuSans.ttf / DejaVuSans-Bold.ttf (also ./fonts, system DejaVu)
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "60"))  # seconds between admin/permission cache reloads
+LEADERBOARD_TESTS = int(os.getenv("LEADERBOARD_TESTS", "64"))  # per-test rankings kept in memory
+DEADLINE_RESYNC = int(os.getenv("DEADLINE_RESYNC", "3600"))  # seconds between deadline heap reloads from DB
+ATT_FLUSH_IDLE = int(os.getenv("ATT_FLUSH_IDLE", "60"))  # seconds an edited attendance sheet waits before it is written
+BROADCAST_RPS = float(os.getenv("BROADCAST_RPS", "25"))  # global send rate (Telegram allows ~30 msg/s per bot)
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))  # concurrent sends in flight
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))  # recipients per checkpoint
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))  # concurrent outbox sends (DMs, kicks, backups)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))  # then the row is marked failed
+OUTBOX_KEEP_DAYS = int(os.getenv("OUTBOX_KEEP_DAYS", "7"))  # sent/failed rows older than this are purged
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", os.path.splitext(DB_NAME)[0] + "_fsm.db")  # in-progress flows (FSM states)
+FSM_FLUSH_SECONDS = float(os.getenv("FSM_FLUSH_SECONDS", "1"))  # changed states are written together at this interval
+FSM_TTL_HOURS = int(os.getenv("FSM_TTL_HOURS", "48"))  # flows untouched this long are dropped
+FSM_CACHE_IDLE = 600  # seconds an idle FSM record stays in memory
 # =========================
 # LOGGING
 # =========================
@@ -104,7 +142,7 @@ logging.basicConfig(level=logging.INFO)
 # ROUTER / DISPATCHER
 # =========================
 router = Router()
-dp = Dispatcher(storage=MemoryStorage())
+# dp is created with the SQLite FSM storage, see FSM STORAGE below
 
 # =========================
 # Helpers
@@ -113,8 +151,8 @@ def now_str() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M")
 
 def escape_html(s: object) -> str:
-    """Escape text for HTML parse mode."""
-    return html.escape(str(s), quote=False)
+    """Escape text for HTML parse mode (None -> "")."""
+    return "" if s is None else html.escape(str(s), quote=False)
 
 def today_str() -> str:
     return datetime.now().strftime("%Y-%m-%d")
@@ -155,11 +193,533 @@ def safe_int(x, default=None):
     except:
         return default
 
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+# =========================
+# DB PRAGMA PROFILES (applied to every connection the bot opens)
+# =========================
+DB_PRAGMA_PROFILES = {
+    # WAL: readers never block the writer; NORMAL sync is durable in WAL except on power loss
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,           # ms to wait on a locked DB instead of failing
+        "cache_size": -20000,           # negative = KiB -> ~20 MB page cache per connection
+        "mmap_size": 128 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "journal_size_limit": 64 * 1024 * 1024,
+    },
+    # WAL but fsync on every commit (slow disks / no UPS)
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 10000,
+        "cache_size": -8000,
+        "mmap_size": 0,
+        "temp_store": "MEMORY",
+        "journal_size_limit": 64 * 1024 * 1024,
+    },
+    # old rollback-journal behaviour (network filesystems where WAL is not supported)
+    "legacy": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+}
+
+if DB_PRAGMA_PROFILE not in DB_PRAGMA_PROFILES:
+    logging.warning("Unknown DB_PRAGMA_PROFILE=%r, using 'production'", DB_PRAGMA_PROFILE)
+    DB_PRAGMA_PROFILE = "production"
+
+
+def apply_pragmas(conn: sqlite3.Connection, profile: Optional[str] = None) -> None:
+    """Apply the selected PRAGMA profile to a freshly opened connection."""
+    for name, value in DB_PRAGMA_PROFILES[profile or DB_PRAGMA_PROFILE].items():
+        conn.execute(f"PRAGMA {name}={value}")
+
+
+def db_pragma_report(conn) -> dict:
+    """Effective PRAGMA values as seen by `conn` (for startup log and /db_stats)."""
+    out = {"profile": DB_PRAGMA_PROFILE}
+    for name in ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size", "temp_store"):
+        try:
+            row = conn.execute(f"PRAGMA {name}").fetchone()
+            out[name] = row[0] if row else None
+        except Exception:
+            out[name] = None
+    return out
+
+
+# =========================
+# DB CONNECTION POOL
+# =========================
+class PooledConnection:
+    """A checked-out pool connection. close() and `with` return it to the pool instead of closing it."""
+
+    __slots__ = ("_pool", "_conn", "_gen", "_released", "_loop_t0")
+
+    def __init__(self, pool: "ConnectionPool", conn: sqlite3.Connection, gen: int):
+        self._pool = pool
+        self._conn = conn
+        self._gen = gen
+        self._released = False
+        # checked out on the event-loop thread: time it, it is time the loop could not serve updates
+        self._loop_t0 = time.perf_counter() if on_loop_thread() else None
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self) -> "PooledConnection":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        try:
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+        finally:
+            self.close()
+        return False
+
+    def close(self) -> None:
+        if not self._released:
+            self._released = True
+            if self._loop_t0 is not None:
+                self._pool._loop_hold(time.perf_counter() - self._loop_t0)
+            self._pool._release(self._conn, self._gen)
+
+    def __del__(self):
+        # safety net for call sites that return early without close()
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    Long-lived SQLite connections shared by every handler.
+    - up to `size` idle connections are kept open and reused (LIFO, so the hottest one stays warm);
+    - if all of them are checked out, an overflow connection is opened and closed on release,
+      so a coroutine never waits for a connection held by another coroutine on the same loop;
+    - writer() hands out the single writer connection for short synchronous write transactions.
+    """
+
+    def __init__(self, path: str, size: int = 4):
+        self.path = path
+        self.size = max(1, int(size))
+        self._lock = threading.Lock()
+        self._idle: List[sqlite3.Connection] = []
+        self._gen = 0
+        self._in_use = 0
+        self._writer: Optional[sqlite3.Connection] = None
+        self._writer_lock = threading.RLock()
+        self._stats = {
+            "opened": 0, "closed": 0, "checkouts": 0, "reused": 0,
+            "overflow": 0, "broken": 0, "peak_in_use": 0, "writer_tx": 0,
+            "loop_checkouts": 0, "loop_hold_ms": 0.0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        try:
+            apply_pragmas(conn)
+        except Exception:
+            conn.close()
+            raise
+        with self._lock:
+            self._stats["opened"] += 1
+        return conn
+
+    def _close(self, conn: sqlite3.Connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._stats["closed"] += 1
+
+    def connection(self) -> PooledConnection:
+        """Check out a connection (general purpose: reads and short writes)."""
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            gen = self._gen
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+            if conn is not None:
+                self._stats["reused"] += 1
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._in_use)
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self._in_use -= 1
+                raise
+        return PooledConnection(self, conn, gen)
+
+    def _loop_hold(self, seconds: float) -> None:
+        with self._lock:
+            self._stats["loop_checkouts"] += 1
+            self._stats["loop_hold_ms"] += seconds * 1000.0
+
+    def _release(self, conn: sqlite3.Connection, gen: int) -> None:
+        try:
+            # Same semantics as sqlite3 close(): uncommitted work is discarded
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+                self._stats["broken"] += 1
+            self._close(conn)
+            return
+        with self._lock:
+            self._in_use -= 1
+            keep = gen == self._gen and len(self._idle) < self.size
+            if keep:
+                self._idle.append(conn)
+            else:
+                self._stats["overflow"] += 1
+        if not keep:
+            self._close(conn)
+
+    @contextmanager
+    def writer(self):
+        """
+        Exclusive write transaction on the single writer connection; commits on success, rolls back on error.
+        Keep the block synchronous: never `await` inside it.
+        """
+        t0 = time.perf_counter() if on_loop_thread() else None
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                with self._lock:
+                    self._stats["writer_tx"] += 1
+                if t0 is not None:
+                    self._loop_hold(time.perf_counter() - t0)
+
+    def reset(self) -> None:
+        """Close idle + writer connections; checked-out ones are closed when released (used after DB restore)."""
+        with self._lock:
+            self._gen += 1
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+        with self._writer_lock:
+            if self._writer is not None:
+                self._close(self._writer)
+                self._writer = None
+
+    def stats(self) -> dict:
+        """Pool size/health snapshot (also probes one idle connection)."""
+        with self._lock:
+            out = dict(self._stats)
+            out["loop_hold_ms"] = round(out["loop_hold_ms"], 1)
+            out.update(size=self.size, idle=len(self._idle), in_use=self._in_use, generation=self._gen)
+        healthy = True
+        try:
+            with self.connection() as conn:
+                conn.execute("SELECT 1").fetchone()
+        except Exception:
+            healthy = False
+        out["healthy"] = healthy
+        return out
+
+
+DB_POOL = ConnectionPool(DB_NAME, DB_POOL_SIZE)
+
+
+def db() -> PooledConnection:
+    """Check out a pooled connection. `conn.close()` (or leaving `with db() as conn:`) returns it to the pool."""
+    return DB_POOL.connection()
+
+
+# =========================
+# DB EXECUTOR (blocking SQLite / file work runs here, not on the event loop)
+# =========================
+# Handlers never touch sqlite directly: they `await run_db(fn, ...)` (or the db_fetch*/db_write
+# shortcuts) so a slow query, a backup or a PDF render delays only its own update.
+# DB_INLINE=1 runs the same calls on the loop thread — the baseline for comparing loop lag.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, DB_THREADS), thread_name_prefix="db")
+
+_LOOP_THREAD_ID: Optional[int] = None
+LOOP_STATS = {
+    "offloaded": 0, "offloaded_ms": 0.0, "inline": 0,
+    "lag_samples": 0, "lag_total_ms": 0.0, "lag_max_ms": 0.0, "stalls": 0,
+}
+
+
+def on_loop_thread() -> bool:
+    return _LOOP_THREAD_ID is not None and threading.get_ident() == _LOOP_THREAD_ID
+
+
+async def run_db(fn, *args, **kwargs):
+    """Run blocking fn(*args, **kwargs) on the DB executor and await its result."""
+    if DB_INLINE:
+        LOOP_STATS["inline"] += 1
+        return fn(*args, **kwargs)
+    t0 = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, functools.partial(fn, *args, **kwargs))
+    finally:
+        LOOP_STATS["offloaded"] += 1
+        LOOP_STATS["offloaded_ms"] += (time.perf_counter() - t0) * 1000.0
+
+
+# PDF/report rendering is CPU-bound; it gets its own small pool so a big report never holds
+# a DB worker (and with it a pooled connection slot) for longer than its cursor needs.
+REPORT_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, REPORT_THREADS), thread_name_prefix="report")
+
+
+async def run_report(fn, *args, **kwargs):
+    """Run a report renderer on REPORT_EXECUTOR and await the bytes it returns."""
+    if DB_INLINE:
+        return fn(*args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(REPORT_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+
+def _fetchone(sql: str, params=()) -> Optional[sqlite3.Row]:
+    with db() as conn:
+        return conn.execute(sql, params).fetchone()
+
+
+def _fetchall(sql: str, params=()) -> List[sqlite3.Row]:
+    with db() as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def _write(sql: str, params=()) -> Tuple[int, Optional[int]]:
+    with DB_POOL.writer() as conn:
+        cur = conn.execute(sql, params)
+        return cur.rowcount, cur.lastrowid
+
+
+async def db_fetchone(sql: str, params=()) -> Optional[sqlite3.Row]:
+    return await run_db(_fetchone, sql, params)
+
+
+async def db_fetchall(sql: str, params=()) -> List[sqlite3.Row]:
+    return await run_db(_fetchall, sql, params)
+
+
+async def db_write(sql: str, params=()) -> Tuple[int, Optional[int]]:
+    """Single-statement write transaction; returns (rowcount, lastrowid)."""
+    return await run_db(_write, sql, params)
+
+
+async def loop_lag_monitor(interval: float = 0.5, stall_ms: float = 100.0):
+    """
+    Measure how long the event loop is blocked: a sleep(interval) that wakes up late was held up by
+    synchronous work on the loop thread. Also pins the loop thread id used by on_loop_thread().
+    """
+    global _LOOP_THREAD_ID
+    _LOOP_THREAD_ID = threading.get_ident()
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        lag_ms = max(0.0, (loop.time() - t0 - interval) * 1000.0)
+        LOOP_STATS["lag_samples"] += 1
+        LOOP_STATS["lag_total_ms"] += lag_ms
+        LOOP_STATS["lag_max_ms"] = max(LOOP_STATS["lag_max_ms"], lag_ms)
+        if lag_ms >= stall_ms:
+            LOOP_STATS["stalls"] += 1
+            logging.warning("Event loop blocked for %.0f ms", lag_ms)
+
+
+def loop_stats(pool: dict) -> dict:
+    """Event-loop blocking snapshot for /db_stats (`pool` is a DB_POOL.stats() result)."""
+    n = LOOP_STATS["lag_samples"]
+    return {
+        "mode": "inline" if DB_INLINE else f"executor x{DB_THREADS}",
+        "lag_avg_ms": round(LOOP_STATS["lag_total_ms"] / n, 2) if n else 0.0,
+        "lag_max_ms": round(LOOP_STATS["lag_max_ms"], 1),
+        "stalls": LOOP_STATS["stalls"],
+        "db_on_loop": pool["loop_checkouts"],
+        "db_on_loop_ms": pool["loop_hold_ms"],
+        "offloaded": LOOP_STATS["offloaded"],
+        "offloaded_ms": round(LOOP_STATS["offloaded_ms"], 1),
+        "inline": LOOP_STATS["inline"],
+    }
+
+
+# =========================
+# FSM STORAGE (SQLite)
+# =========================
+# In-progress flows (test answering, task builder media, grading, restore ...) are kept in their own
+# SQLite file, so a restart or redeploy does not drop them and a DB restore does not bring old ones back.
+# Handlers read and write an in-memory record; changed records are written together every
+# FSM_FLUSH_SECONDS (a handler's set_state + update_data cost one row write) and on shutdown.
+# Flows untouched for FSM_TTL_HOURS expire, idle records leave memory after FSM_CACHE_IDLE seconds.
+
+def _fsm_json(obj):
+    # sets (e.g. selected groups) come back as lists; readers already wrap them in set()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+class _FsmRecord:
+    # dirty counts changes since the last successful write (0 = clean), so a change made while a
+    # flush is in flight keeps the record dirty; unwritable is the dirty count json.dumps failed on
+    __slots__ = ("state", "data", "touched", "dirty", "unwritable")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None):
+        self.state = state
+        self.data = data or {}
+        self.touched = time.monotonic()
+        self.dirty = 0
+        self.unwritable = 0
+
+
+class SqliteStorage(BaseStorage):
+    """aiogram FSM storage on SQLite with a write-back cache (see the section comment)."""
+
+    def __init__(self, path: str, ttl_hours: int, flush_every: float, cache_idle: int = FSM_CACHE_IDLE):
+        self.pool = ConnectionPool(path, 1)
+        self.ttl = ttl_hours * 3600
+        self.flush_every = flush_every
+        self.cache_idle = cache_idle
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._records: dict = {}
+        self._schema = False
+        self._stats = {"loads": 0, "flushes": 0, "rows_written": 0, "expired": 0}
+
+    def _ensure_schema(self, conn) -> None:
+        if not self._schema:
+            conn.execute("""CREATE TABLE IF NOT EXISTS fsm(
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_fsm_updated ON fsm(updated_at)")
+            self._schema = True
+
+    def _load(self, k: str) -> _FsmRecord:
+        with self.pool.writer() as conn:
+            self._ensure_schema(conn)
+            r = conn.execute("SELECT state, data, updated_at FROM fsm WHERE key=?", (k,)).fetchone()
+        if not r or r["updated_at"] < time.time() - self.ttl:
+            return _FsmRecord()
+        return _FsmRecord(r["state"], json.loads(r["data"]) if r["data"] else None)
+
+    async def _record(self, key: StorageKey) -> _FsmRecord:
+        k = self.key_builder.build(key)
+        rec = self._records.get(k)
+        if rec is None:
+            loaded = await run_db(self._load, k)
+            self._stats["loads"] += 1
+            # another update for the same chat may have loaded it while we waited
+            rec = self._records.setdefault(k, loaded)
+        rec.touched = time.monotonic()
+        return rec
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        rec = await self._record(key)
+        rec.state = state.state if isinstance(state, State) else state
+        rec.dirty += 1
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        rec = await self._record(key)
+        rec.data = dict(data)
+        rec.dirty += 1
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return (await self._record(key)).data.copy()
+
+    def _write(self, upserts: list, deletes: list) -> None:
+        with self.pool.writer() as conn:
+            self._ensure_schema(conn)
+            if upserts:
+                conn.executemany("""INSERT INTO fsm(key, state, data, updated_at) VALUES (?,?,?,?)
+                                    ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data,
+                                                                   updated_at=excluded.updated_at""", upserts)
+            if deletes:
+                conn.executemany("DELETE FROM fsm WHERE key=?", deletes)
+
+    async def flush(self) -> int:
+        """Write every changed record in one transaction; a finished flow (no state, no data) deletes its row.
+        A record whose data json.dumps rejects is logged and left dirty (kept in memory) without holding
+        back the others; records are marked clean only once the write has committed."""
+        now = time.time()
+        written, upserts, deletes = [], [], []
+        for k, rec in self._records.items():
+            if not rec.dirty or rec.unwritable == rec.dirty:
+                continue
+            if rec.state is None and not rec.data:
+                deletes.append((k,))
+            else:
+                try:
+                    data = json.dumps(rec.data, ensure_ascii=False, separators=(",", ":"),
+                                      default=_fsm_json) if rec.data else None
+                except (TypeError, ValueError):
+                    rec.unwritable = rec.dirty
+                    logging.exception("FSM data of %s is not serializable; kept in memory only", k)
+                    continue
+                upserts.append((k, rec.state, data, now))
+            written.append((rec, rec.dirty))
+        if not written:
+            return 0
+        await run_db(self._write, upserts, deletes)
+        for rec, seen in written:
+            if rec.dirty == seen:  # not changed again while the write was in flight
+                rec.dirty = 0
+        self._stats["flushes"] += 1
+        self._stats["rows_written"] += len(written)
+        return len(written)
+
+    def _purge(self) -> int:
+        with self.pool.writer() as conn:
+            self._ensure_schema(conn)
+            return conn.execute("DELETE FROM fsm WHERE updated_at < ?", (time.time() - self.ttl,)).rowcount
+
+    async def expire(self) -> None:
+        """Drop idle clean records from memory and abandoned flows from the file."""
+        now = time.monotonic()
+        for k in [k for k, rec in self._records.items()
+                  if not rec.dirty and now - rec.touched > min(self.cache_idle, self.ttl)]:
+            del self._records[k]
+        self._stats["expired"] += await run_db(self._purge)
+
+    async def run(self) -> None:
+        expired_at = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_every)
+            try:
+                await self.flush()
+                if time.monotonic() - expired_at > 60:
+                    expired_at = time.monotonic()
+                    await self.expire()
+            except Exception:
+                logging.exception("FSM storage flush failed")
+
+    async def close(self) -> None:
+        # called by the dispatcher on shutdown
+        await self.flush()
 
+    def stats(self) -> dict:
+        return {"cached": len(self._records), "dirty": sum(1 for r in self._records.values() if r.dirty),
+                **self._stats}
+
+
+FSM_STORAGE = SqliteStorage(FSM_DB_PATH, FSM_TTL_HOURS, FSM_FLUSH_SECONDS)
+dp = Dispatcher(storage=FSM_STORAGE)
 
 def ensure_attendance_schema(conn: sqlite3.Connection) -> None:
     """Ensure attendance tables exist (safe to call often). Helps after DB restore/migrations."""
@@ -187,7 +747,7 @@ def ensure_attendance_schema(conn: sqlite3.Connection) -> None:
 def log_admin(admin_id: int, action: str, payload: dict | None = None) -> None:
     """Best-effort admin audit logger. Never raises."""
     try:
-        with db() as conn:
+        with DB_POOL.writer() as conn:
             conn.execute(
                 """CREATE TABLE IF NOT EXISTS admin_logs (
                        id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -206,31 +766,10 @@ def log_admin(admin_id: int, action: str, payload: dict | None = None) -> None:
                     json.dumps(payload or {}, ensure_ascii=False),
                 ),
             )
-            conn.commit()
     except Exception:
         # Do not break main flow on logging failures
         return
 
-def safe_pdf_text(s: str) -> str:
-    """
-    fpdf default fonts can break on non-latin-1 chars.
-    We normalize & replace problematic chars to avoid latin-1 errors.
-    """
-    if s is None:
-        return ""
-    s = str(s)
-    # Replace Uzbek apostrophes variants and quotes
-    s = s.replace("ʻ", "'").replace("’", "'").replace("`", "'")
-    s = s.replace("“", '"').replace("”", '"')
-    # Remove any remaining non-latin-1
-    s2 = []
-    for ch in s:
-        if ord(ch) <= 255:
-            s2.append(ch)
-        else:
-            s2.append("?")
-    return "".join(s2)
-
 async def safe_edit(call: CallbackQuery, text: str, kb: InlineKeyboardMarkup):
     """
     Avoid TelegramBadRequest: message is not modified
@@ -284,7 +823,10 @@ def kb_back_home(back_cb: str = "a:home") -> InlineKeyboardMarkup:
 # DB INIT / MIGRATIONS
 # =========================
 
-def migrate_task_submissions_columns(conn: sqlite3.Connection) -> None:
+# Versioned migrations: each runs once, in order, inside its own transaction, and is recorded in
+# schema_version. Append new ones at the end; never renumber or edit an applied migration.
+
+def _m001_task_submissions_columns(conn: sqlite3.Connection) -> None:
     """Backwards-compatible migration for legacy task_submissions schema."""
     c = conn.cursor()
     # If table doesn't exist yet, skip (it will be created in init_db).
@@ -303,12 +845,152 @@ def migrate_task_submissions_columns(conn: sqlite3.Connection) -> None:
         c.execute("ALTER TABLE task_submissions ADD COLUMN graded_by INTEGER")
 
 
+def _m002_hot_path_indexes(conn: sqlite3.Connection) -> None:
+    """Secondary indexes for the hot queries (ratings, my results, memberships, attendance, tasks, tests)."""
+    for sql in (
+        # results WHERE test_id=? ORDER BY percent DESC, score DESC
+        "CREATE INDEX IF NOT EXISTS ix_results_test_rank ON results(test_id, percent DESC, score DESC)",
+        # results WHERE user_id=? ORDER BY id DESC (rowid is implicitly part of the index)
+        "CREATE INDEX IF NOT EXISTS ix_results_user ON results(user_id)",
+        # members WHERE user_id=? (UNIQUE(group_id, user_id) already covers group_id lookups)
+        "CREATE INDEX IF NOT EXISTS ix_members_user ON members(user_id)",
+        # attendance WHERE group_id=? AND att_date=?
+        "CREATE INDEX IF NOT EXISTS ix_attendance_group_date ON attendance(group_id, att_date)",
+        # tasks WHERE status='published' (enforcement), tasks WHERE group_id=? [AND status=?] ORDER BY id DESC
+        "CREATE INDEX IF NOT EXISTS ix_tasks_status_due ON tasks(status, due_at)",
+        "CREATE INDEX IF NOT EXISTS ix_tasks_group ON tasks(group_id, status)",
+        # test_groups WHERE group_id=?
+        "CREATE INDEX IF NOT EXISTS ix_test_groups_group ON test_groups(group_id)",
+        # tests ORDER BY created_at DESC LIMIT n
+        "CREATE INDEX IF NOT EXISTS ix_tests_created ON tests(created_at)",
+    ):
+        conn.execute(sql)
+    conn.execute("ANALYZE")
+
+
+def _m003_broadcast_jobs(conn: sqlite3.Connection) -> None:
+    """Persistent broadcast jobs; `cursor` is the last users.user_id already processed."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS broadcast_jobs(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            src_chat_id INTEGER,
+            src_message_id INTEGER,
+            status TEXT,
+            total INTEGER DEFAULT 0,
+            cursor INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            progress_message_id INTEGER,
+            created_at TEXT,
+            finished_at TEXT
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_broadcast_jobs_status ON broadcast_jobs(status)")
+
+
+def _m004_deliveries(conn: sqlite3.Connection) -> None:
+    """Per-recipient delivery outcomes + users.reachable (0 after Forbidden / chat not found)."""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(users)").fetchall()]
+    if "reachable" not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN reachable INTEGER NOT NULL DEFAULT 1")
+    if "unreachable_at" not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN unreachable_at TEXT")
+    conn.execute("""CREATE TABLE IF NOT EXISTS deliveries(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            job TEXT,
+            status TEXT,
+            error_code TEXT,
+            created_at TEXT
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_deliveries_job ON deliveries(job)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_deliveries_user ON deliveries(user_id)")
+
+
+def _m005_task_miss_log(conn: sqlite3.Connection) -> None:
+    """One row per (task, user) miss already counted; used to be created inside the enforcement loop."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS task_miss_log(
+            task_id INTEGER, group_id INTEGER, user_id INTEGER,
+            UNIQUE(task_id, group_id, user_id)
+        )""")
 
 
-def ensure_attendance_schema(conn) -> None:
-    """Ensure attendance tables exist for older DBs or after restore."""
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS attendance_archive(
+def _m006_test_score_hist(conn: sqlite3.Connection) -> None:
+    """Per-test histogram of result percents (n results per distinct percent), kept in sync by triggers,
+    so rank / percentile / average read a few histogram rows instead of scanning results."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS test_score_hist(
+            test_id TEXT,
+            percent REAL,
+            n INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(test_id, percent)
+        )""")
+    bump = """INSERT OR IGNORE INTO test_score_hist(test_id, percent, n) VALUES ({r}.test_id, round(COALESCE({r}.percent, 0), 4), 0);
+              UPDATE test_score_hist SET n = n + 1
+               WHERE test_id={r}.test_id AND percent=round(COALESCE({r}.percent, 0), 4);"""
+    drop = """UPDATE test_score_hist SET n = n - 1
+               WHERE test_id={r}.test_id AND percent=round(COALESCE({r}.percent, 0), 4);
+              DELETE FROM test_score_hist
+               WHERE test_id={r}.test_id AND percent=round(COALESCE({r}.percent, 0), 4) AND n <= 0;"""
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_results_hist_ins AFTER INSERT ON results BEGIN {bump.format(r='NEW')} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_results_hist_del AFTER DELETE ON results BEGIN {drop.format(r='OLD')} END")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_results_hist_upd AFTER UPDATE OF test_id, percent ON results
+                     BEGIN {drop.format(r='OLD')} {bump.format(r='NEW')} END""")
+    conn.execute("DELETE FROM test_score_hist")
+    conn.execute("""INSERT INTO test_score_hist(test_id, percent, n)
+                    SELECT test_id, round(COALESCE(percent, 0), 4), COUNT(*) FROM results GROUP BY 1, 2""")
+
+
+def _m007_report_cache(conn: sqlite3.Connection) -> None:
+    """Telegram file_id of each generated report plus per-entity data versions that triggers bump on every
+    write to the rows a report is built from; a report is resent by file_id while its version still matches."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS report_versions(
+            scope TEXT,
+            entity TEXT,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(scope, entity)
+        )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS report_cache(
+            kind TEXT,
+            entity TEXT,
+            version TEXT,
+            file_id TEXT,
+            created_at TEXT,
+            PRIMARY KEY(kind, entity)
+        )""")
+    bump = """INSERT INTO report_versions(scope, entity, version) VALUES ('{scope}', CAST({ent} AS TEXT), 1)
+              ON CONFLICT(scope, entity) DO UPDATE SET version = version + 1;"""
+    watched = [
+        # (trigger suffix, table, events, scope, entity expression over NEW/OLD)
+        ("results", "results", ("INSERT", "DELETE", "UPDATE"), "test", "{r}.test_id"),
+        ("subm", "submissions", ("INSERT", "DELETE", "UPDATE"), "test", "{r}.test_id"),
+        ("tests", "tests", ("UPDATE OF keys",), "test", "{r}.test_id"),
+        ("att", "attendance", ("INSERT", "DELETE", "UPDATE"), "att", "{r}.group_id || ':' || {r}.att_date"),
+        ("members", "members", ("INSERT", "DELETE"), "group", "{r}.group_id"),
+        ("groups", "groups", ("UPDATE OF name",), "group", "{r}.id"),
+        ("users", "users", ("UPDATE OF full_name",), "names", "'*'"),
+    ]
+    for suffix, table, events, scope, ent in watched:
+        for ev in events:
+            kind = ev.split()[0]
+            body = "".join(bump.format(scope=scope, ent=ent.format(r=r))
+                           for r in (("OLD", "NEW") if kind == "UPDATE" else ("OLD",) if kind == "DELETE" else ("NEW",)))
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_rv_{suffix}_{kind.lower()} AFTER {ev} ON {table} BEGIN {body} END")
+
+
+def _att_streak(statuses: Iterable[str]) -> Tuple[int, int]:
+    """(current, longest) run of consecutive 'absent' in date-ordered statuses."""
+    cur = best = 0
+    for st in statuses:
+        cur = cur + 1 if st == "absent" else 0
+        best = max(best, cur)
+    return cur, best
+
+
+def _m008_attendance_analytics(conn: sqlite3.Connection) -> None:
+    """attendance_archive becomes the per-student snapshot of every finalized day; att_monthly (kept by
+    triggers) and att_streaks (kept by archive_attendance_day) are the aggregates the analytics screens read.
+    Days finalized before this migration are backfilled from attendance + current members."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS attendance_archive(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         group_id INTEGER,
         user_id INTEGER,
@@ -317,14 +999,195 @@ def ensure_attendance_schema(conn) -> None:
         note TEXT,
         created_at TEXT
     )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS attendance_days(
-        group_id INTEGER,
-        att_date TEXT,
-        saved_at TEXT,
-        saved_by INTEGER,
-        PRIMARY KEY(group_id, att_date)
-    )""")
+    conn.execute("""DELETE FROM attendance_archive WHERE id NOT IN
+                    (SELECT MAX(id) FROM attendance_archive GROUP BY group_id, user_id, att_date)""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_att_archive ON attendance_archive(group_id, user_id, att_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_att_archive_day ON attendance_archive(group_id, att_date)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS att_monthly(
+            group_id INTEGER,
+            user_id INTEGER,
+            month TEXT,
+            days INTEGER NOT NULL DEFAULT 0,
+            absent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(group_id, user_id, month)
+        )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS att_streaks(
+            group_id INTEGER,
+            user_id INTEGER,
+            last_date TEXT,
+            cur_absent INTEGER NOT NULL DEFAULT 0,
+            max_absent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(group_id, user_id)
+        )""")
+    add = """INSERT INTO att_monthly(group_id, user_id, month, days, absent)
+             VALUES ({r}.group_id, {r}.user_id, substr({r}.att_date, 1, 7), 1, {r}.status='absent')
+             ON CONFLICT(group_id, user_id, month) DO UPDATE SET days = days + 1, absent = absent + ({r}.status='absent');"""
+    sub = """UPDATE att_monthly SET days = days - 1, absent = absent - ({r}.status='absent')
+              WHERE group_id={r}.group_id AND user_id={r}.user_id AND month=substr({r}.att_date, 1, 7);"""
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_att_archive_ins AFTER INSERT ON attendance_archive BEGIN {add.format(r='NEW')} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_att_archive_del AFTER DELETE ON attendance_archive BEGIN {sub.format(r='OLD')} END")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_att_archive_upd AFTER UPDATE OF status ON attendance_archive
+                     BEGIN {sub.format(r='OLD')} {add.format(r='NEW')} END""")
+
+    now = now_str()
+    conn.execute("""INSERT OR IGNORE INTO attendance_archive(group_id, user_id, att_date, status, created_at)
+                    SELECT a.group_id, a.user_id, a.att_date, 'absent', ?
+                    FROM attendance a JOIN attendance_days d ON d.group_id=a.group_id AND d.att_date=a.att_date
+                    WHERE a.status='absent'""", (now,))
+    conn.execute("""INSERT OR IGNORE INTO attendance_archive(group_id, user_id, att_date, status, created_at)
+                    SELECT d.group_id, m.user_id, d.att_date, 'present', ?
+                    FROM attendance_days d JOIN members m ON m.group_id=d.group_id""", (now,))
+    conn.execute("DELETE FROM att_streaks")
+    key, statuses, last = None, [], None
+    for r in conn.execute("SELECT group_id, user_id, att_date, status FROM attendance_archive ORDER BY group_id, user_id, att_date"):
+        if (r[0], r[1]) != key:
+            if key is not None:
+                conn.execute("INSERT INTO att_streaks VALUES (?,?,?,?,?)", (*key, last, *_att_streak(statuses)))
+            key, statuses = (r[0], r[1]), []
+        statuses.append(r[3])
+        last = r[2]
+    if key is not None:
+        conn.execute("INSERT INTO att_streaks VALUES (?,?,?,?,?)", (*key, last, *_att_streak(statuses)))
+
+
+def _m009_outbox(conn: sqlite3.Connection) -> None:
+    """Telegram side effects (DMs, kicks, documents) written in the same transaction as the change that
+    causes them and sent later by OUTBOX; `dedupe_key` makes re-enqueueing the same intent a no-op."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS outbox(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedupe_key TEXT UNIQUE,
+            kind TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            payload TEXT,
+            job TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_at REAL NOT NULL,
+            created_at REAL NOT NULL,
+            done_at REAL,
+            error TEXT
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_outbox_ready ON outbox(status, next_at)")
+
+
+def _m010_test_group_score(conn: sqlite3.Connection) -> None:
+    """Per-(test, group) count and sum of result percents of the group's current members, for the groups
+    the test is assigned to; triggers on results, members and test_groups keep it in sync, so the group
+    average in "my results" is a keyed lookup instead of a results JOIN members scan."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS test_group_score(
+            test_id TEXT,
+            group_id INTEGER,
+            n INTEGER NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY(test_id, group_id)
+        )""")
+    upsert = "ON CONFLICT(test_id, group_id) DO UPDATE SET n = n + excluded.n, total = total + excluded.total;"
+    prune = "DELETE FROM test_group_score WHERE test_id={r}.test_id AND n <= 0;"
+    res_add = ("""INSERT INTO test_group_score(test_id, group_id, n, total)
+                  SELECT {r}.test_id, tg.group_id, 1, COALESCE({r}.percent, 0)
+                    FROM test_groups tg JOIN members m ON m.group_id=tg.group_id AND m.user_id={r}.user_id
+                   WHERE tg.test_id={r}.test_id """ + upsert)
+    res_sub = ("""UPDATE test_group_score SET n = n - 1, total = total - COALESCE({r}.percent, 0)
+                   WHERE test_id={r}.test_id AND group_id IN
+                         (SELECT tg.group_id FROM test_groups tg JOIN members m ON m.group_id=tg.group_id
+                           WHERE tg.test_id={r}.test_id AND m.user_id={r}.user_id);""" + prune)
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_results_tgs_ins AFTER INSERT ON results BEGIN {res_add.format(r='NEW')} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_results_tgs_del AFTER DELETE ON results BEGIN {res_sub.format(r='OLD')} END")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_results_tgs_upd AFTER UPDATE OF test_id, user_id, percent ON results
+                     BEGIN {res_sub.format(r='OLD')} {res_add.format(r='NEW')} END""")
+    # joining / leaving a group adds / removes the member's results on the group's tests
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS trg_members_tgs_ins AFTER INSERT ON members BEGIN
+            INSERT INTO test_group_score(test_id, group_id, n, total)
+            SELECT r.test_id, NEW.group_id, COUNT(*), SUM(COALESCE(r.percent, 0))
+              FROM results r JOIN test_groups tg ON tg.test_id=r.test_id AND tg.group_id=NEW.group_id
+             WHERE r.user_id=NEW.user_id
+             GROUP BY r.test_id """ + upsert + " END")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS trg_members_tgs_del AFTER DELETE ON members BEGIN
+            UPDATE test_group_score
+               SET n = n - (SELECT COUNT(*) FROM results r
+                             WHERE r.user_id=OLD.user_id AND r.test_id=test_group_score.test_id),
+                   total = total - (SELECT COALESCE(SUM(COALESCE(r.percent, 0)), 0) FROM results r
+                                     WHERE r.user_id=OLD.user_id AND r.test_id=test_group_score.test_id)
+             WHERE group_id=OLD.group_id
+               AND test_id IN (SELECT test_id FROM results WHERE user_id=OLD.user_id);
+            DELETE FROM test_group_score WHERE group_id=OLD.group_id AND n <= 0;
+        END""")
+    # assigning / unassigning a test to a group
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS trg_test_groups_tgs_ins AFTER INSERT ON test_groups BEGIN
+            INSERT INTO test_group_score(test_id, group_id, n, total)
+            SELECT NEW.test_id, NEW.group_id, COUNT(*), SUM(COALESCE(r.percent, 0))
+              FROM results r JOIN members m ON m.group_id=NEW.group_id AND m.user_id=r.user_id
+             WHERE r.test_id=NEW.test_id
+            HAVING COUNT(*) > 0 """ + upsert + " END")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS trg_test_groups_tgs_del AFTER DELETE ON test_groups BEGIN
+            DELETE FROM test_group_score WHERE test_id=OLD.test_id AND group_id=OLD.group_id;
+        END""")
+    conn.execute("DELETE FROM test_group_score")
+    conn.execute("""INSERT INTO test_group_score(test_id, group_id, n, total)
+                    SELECT r.test_id, tg.group_id, COUNT(*), SUM(COALESCE(r.percent, 0))
+                      FROM results r
+                      JOIN test_groups tg ON tg.test_id=r.test_id
+                      JOIN members m ON m.group_id=tg.group_id AND m.user_id=r.user_id
+                     GROUP BY r.test_id, tg.group_id""")
+
+
+def _m011_results_submission_link(conn: sqlite3.Connection) -> None:
+    """results.submission_id links the row an online submission produced, so a key fix regrades exactly
+    those rows. Existing rows are linked by user, test and the timestamp both got when submitted."""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(results)").fetchall()]
+    if "submission_id" not in cols:
+        conn.execute("ALTER TABLE results ADD COLUMN submission_id INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_results_submission ON results(submission_id) WHERE submission_id IS NOT NULL")
+    conn.execute("""UPDATE results SET submission_id=s.id
+                      FROM submissions s
+                     WHERE results.submission_id IS NULL
+                       AND s.user_id=results.user_id AND s.test_id=results.test_id AND s.submitted_at=results.date
+                       AND results.id=(SELECT MIN(r.id) FROM results r
+                                        WHERE r.user_id=s.user_id AND r.test_id=s.test_id AND r.date=s.submitted_at)""")
+
+
+MIGRATIONS = [
+    (1, "task_submissions legacy columns", _m001_task_submissions_columns),
+    (2, "hot-path secondary indexes", _m002_hot_path_indexes),
+    (3, "broadcast jobs", _m003_broadcast_jobs),
+    (4, "delivery log + users.reachable", _m004_deliveries),
+    (5, "task_miss_log", _m005_task_miss_log),
+    (6, "per-test score histogram", _m006_test_score_hist),
+    (7, "report cache", _m007_report_cache),
+    (8, "attendance analytics", _m008_attendance_analytics),
+    (9, "side-effect outbox", _m009_outbox),
+    (10, "per-group test score totals", _m010_test_group_score),
+    (11, "results -> submissions link", _m011_results_submission_link),
+]
+
+
+def run_migrations(conn: sqlite3.Connection) -> None:
+    """Apply pending MIGRATIONS in order and log how long each one took."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_version(
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TEXT,
+            duration_ms REAL
+        )""")
     conn.commit()
+    done = {int(r[0]) for r in conn.execute("SELECT version FROM schema_version").fetchall()}
+    for version, name, fn in MIGRATIONS:
+        if version in done:
+            continue
+        t0 = time.perf_counter()
+        try:
+            conn.execute("BEGIN")  # DDL does not open a transaction implicitly
+            fn(conn)
+            ms = (time.perf_counter() - t0) * 1000
+            conn.execute("INSERT INTO schema_version(version, name, applied_at, duration_ms) VALUES (?,?,?,?)",
+                         (version, name, now_str(), ms))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logging.exception("Migration %03d (%s) failed", version, name)
+            raise
+        logging.info("Migration %03d (%s) applied in %.1f ms", version, name, ms)
+
 
 def init_db() -> None:
     conn = db()
@@ -462,8 +1325,8 @@ def init_db() -> None:
             UNIQUE(task_id, user_id)
         )""")
 
-    # Apply migrations for legacy DBs
-    migrate_task_submissions_columns(conn)
+    # Apply pending versioned migrations (legacy columns, indexes, ...)
+    run_migrations(conn)
 
     # Ensure super admin
     c.execute(
@@ -472,7 +1335,16 @@ def init_db() -> None:
     )
 
     conn.commit()
+
+    # Startup tuning: refresh planner stats and report the effective PRAGMA profile
+    try:
+        conn.execute("PRAGMA optimize")
+    except Exception:
+        pass
+    rep = db_pragma_report(conn)
     conn.close()
+    logging.info("SQLite %s (%s): %s", sqlite3.sqlite_version, DB_NAME,
+                 ", ".join(f"{k}={v}" for k, v in rep.items()))
 
 
 init_db()
@@ -487,33 +1359,94 @@ PERMS = [
     ("attendance", "Davomat"),
     ("results", "Natijalar"),
     ("tasks", "Vazifalar"),
+    ("export", "Eksport"),
     ("admins", "Adminlar"),
 ]
 
+class AdminCache:
+    """
+    Process-wide snapshot of `admins` + enabled `admin_permissions`, so authorization is a dict lookup.
+    - load() swaps in a fresh snapshot (startup, after any write to those tables, after DB restore);
+    - loop_admin_cache() reloads it every ADMIN_CACHE_TTL seconds to pick up rows edited outside the bot.
+    Lookups never touch SQLite.
+    """
+
+    def __init__(self):
+        self._roles: dict = {}
+        self._perms: dict = {}
+        self._loaded_at = 0.0
+        self._loads = 0
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        with db() as conn:
+            roles = {int(r["user_id"]): r["role"] for r in conn.execute("SELECT user_id, role FROM admins")}
+            perms: dict = {}
+            for r in conn.execute("SELECT admin_id, perm FROM admin_permissions WHERE enabled=1"):
+                perms.setdefault(int(r["admin_id"]), set()).add(r["perm"])
+        with self._lock:
+            self._roles = roles
+            self._perms = {uid: frozenset(p) for uid, p in perms.items()}
+            self._loaded_at = time.monotonic()
+            self._loads += 1
+
+    invalidate = load
+
+    def role(self, uid: int) -> Optional[str]:
+        return self._roles.get(uid)
+
+    def perms(self, uid: int) -> frozenset:
+        return self._perms.get(uid, frozenset())
+
+    def admin_ids(self) -> List[int]:
+        return list(self._roles)
+
+    def with_perm(self, perm: str) -> List[int]:
+        """Admins allowed to use `perm` (role 'super' or an enabled permission row)."""
+        roles, perms = self._roles, self._perms
+        return [uid for uid, role in roles.items() if role == "super" or perm in perms.get(uid, ())]
+
+    def stats(self) -> dict:
+        return {"admins": len(self._roles), "loads": self._loads,
+                "age_s": round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None}
+
+
+ADMIN_CACHE = AdminCache()
+ADMIN_CACHE.load()
+
+
+async def loop_admin_cache():
+    while True:
+        await asyncio.sleep(max(5, ADMIN_CACHE_TTL))
+        try:
+            await run_db(ADMIN_CACHE.load)
+        except Exception:
+            logging.exception("Admin cache reload failed")
+
+
 def is_super(uid: int) -> bool:
     return uid == SUPER_ADMIN_ID
 
 def is_admin(uid: int) -> bool:
-    conn = db()
-    r = conn.execute("SELECT role FROM admins WHERE user_id=?", (uid,)).fetchone()
-    conn.close()
-    return r is not None
+    return ADMIN_CACHE.role(uid) is not None
 
 def has_perm(uid: int, perm: str) -> bool:
     if is_super(uid):
         return True
-    conn = db()
-    r = conn.execute("SELECT enabled FROM admin_permissions WHERE admin_id=? AND perm=?", (uid, perm)).fetchone()
-    conn.close()
-    return bool(r and int(r["enabled"]) == 1)
+    return perm in ADMIN_CACHE.perms(uid)
 
-async def guard(call: CallbackQuery, perm: Optional[str] = None) -> bool:
-    uid = call.from_user.id
+def _check_access(uid: int, perm: Optional[str]) -> Optional[str]:
+    """None if uid may use `perm`, otherwise the refusal text."""
     if not is_admin(uid):
-        await call.answer("Ruxsat yo‘q.", show_alert=True)
-        return False
+        return "Ruxsat yo‘q."
     if perm and not has_perm(uid, perm):
-        await call.answer("Bu funksiya siz uchun yopiq.", show_alert=True)
+        return "Bu funksiya siz uchun yopiq."
+    return None
+
+async def guard(call: CallbackQuery, perm: Optional[str] = None) -> bool:
+    err = _check_access(call.from_user.id, perm)
+    if err:
+        await call.answer(err, show_alert=True)
         return False
     return True
 
@@ -527,15 +1460,10 @@ async def guard_call(call: CallbackQuery, perm: Optional[str] = None) -> bool:
 async def guard_msg(message, perm: Optional[str] = None) -> bool:
     """Permission guard for message-based admin actions."""
     uid = getattr(getattr(message, "from_user", None), "id", 0) or 0
-    if not is_admin(uid):
-        try:
-            await message.reply("Ruxsat yo‘q.")
-        except Exception:
-            pass
-        return False
-    if perm and not has_perm(uid, perm):
+    err = _check_access(uid, perm)
+    if err:
         try:
-            await message.reply("Bu funksiya siz uchun yopiq.")
+            await message.reply(err)
         except Exception:
             pass
         return False
@@ -545,13 +1473,7 @@ async def guard_msg(message, perm: Optional[str] = None) -> bool:
 
 def get_all_admin_ids() -> List[int]:
     """Return all admin user IDs including SUPER_ADMIN_ID."""
-    ids: List[int] = []
-    try:
-        with db() as conn:
-            rows = conn.execute("SELECT user_id FROM admins").fetchall()
-            ids = [int(r["user_id"]) for r in rows if r and r["user_id"] is not None]
-    except Exception:
-        ids = []
+    ids: List[int] = ADMIN_CACHE.admin_ids()
     if SUPER_ADMIN_ID not in ids:
         ids.insert(0, int(SUPER_ADMIN_ID))
     # de-dup while preserving order
@@ -574,8 +1496,8 @@ def make_db_snapshot_zip() -> Tuple[str, str]:
     snap_path = f"/tmp/backup_{ts}_{os.path.basename(db_path)}"
     zip_path = f"/tmp/backup_{ts}_{os.path.basename(db_path)}.zip"
 
-    # create snapshot
-    src = sqlite3.connect(db_path)
+    # create snapshot (pooled connection; backup API gives a consistent copy)
+    src = db()
     try:
         dst = sqlite3.connect(snap_path)
         try:
@@ -605,44 +1527,38 @@ def make_db_snapshot_zip() -> Tuple[str, str]:
     return zip_path, caption
 
 
-async def send_db_backup_to_admins(bot: Bot, reason: str = "scheduled"):
-    """Send DB backup to all admins (DM). Never raises."""
+def _queue_db_backup(reason: str) -> int:
+    """Snapshot the DB and queue the zip for every admin; the outbox deletes the file after the last send."""
     try:
         zip_path, caption = make_db_snapshot_zip()
     except Exception as e:
         # if snapshot failed, notify super admin only
-        try:
-            await bot.send_message(int(SUPER_ADMIN_ID), f"❌ DB backup xatolik ({escape_html(reason)}): <code>{escape_html(e)}</code>")
-        except Exception:
-            pass
-        return
+        with DB_POOL.writer() as conn:
+            return outbox_put(conn, "message", int(SUPER_ADMIN_ID), job="backup",
+                              text=f"❌ DB backup xatolik ({escape_html(reason)}): <code>{escape_html(e)}</code>")
 
     # Telegram bot file size limits exist; try anyway, but warn if huge.
     try:
         size_mb = os.path.getsize(zip_path) / (1024 * 1024)
         if size_mb > 45:
-            warn = f"⚠️ Backup fayl juda katta: <b>{size_mb:.1f} MB</b>. Telegram limitiga urilishi mumkin."
-        else:
-            warn = ""
+            caption += f"\n\n⚠️ Backup fayl juda katta: <b>{size_mb:.1f} MB</b>. Telegram limitiga urilishi mumkin."
     except Exception:
-        warn = ""
+        pass
 
-    ids = get_all_admin_ids()
-    for uid in ids:
-        try:
-            await bot.send_document(
-                chat_id=int(uid),
-                document=FSInputFile(zip_path, filename=os.path.basename(zip_path)),
-                caption=(caption + (("\n\n" + warn) if warn else ""))
-            )
-        except Exception:
-            # ignore per-admin failures (blocked bot, etc.)
-            pass
+    name = os.path.basename(zip_path)
+    with DB_POOL.writer() as conn:
+        return sum(outbox_put(conn, "document", uid, key=f"backup:{name}:{uid}", job="backup",
+                              path=zip_path, filename=name, caption=caption, cleanup=True)
+                   for uid in get_all_admin_ids())
 
+
+async def send_db_backup_to_admins(bot: Bot, reason: str = "scheduled"):
+    """Send DB backup to all admins (DM) through the outbox. Never raises."""
     try:
-        os.remove(zip_path)
+        await run_db(_queue_db_backup, reason)
+        OUTBOX.wake()
     except Exception:
-        pass
+        logging.exception("DB backup (%s) could not be queued", reason)
 
 
 def seconds_until_next_backup(hour: int = 6, minute: int = 0, tz_name: str = "Asia/Samarkand") -> int:
@@ -664,7 +1580,7 @@ async def cmd_backup_db(message: Message):
     if not await guard_msg(message, "admins"):
         return
     try:
-        zip_path, caption = make_db_snapshot_zip()
+        zip_path, caption = await run_db(make_db_snapshot_zip)
     except Exception as e:
         await message.reply(f"❌ Backup qilishda xatolik: <code>{escape_html(e)}</code>")
         return
@@ -695,6 +1611,45 @@ async def cmd_backup_db(message: Message):
             pass
 
 
+@router.message(Command("db_stats"))
+async def cmd_db_stats(message: Message):
+    """Connection pool size/health, PRAGMA, event-loop blocking, admin cache, deadline scheduler, outbox and report cache metrics."""
+    if not await guard_msg(message, "admins"):
+        return
+    st = await run_db(DB_POOL.stats)
+    lines = [f"{k}: <b>{escape_html(v)}</b>" for k, v in st.items()]
+
+    def _pragmas() -> dict:
+        with db() as conn:
+            return db_pragma_report(conn)
+
+    prag = await run_db(_pragmas)
+    lines.append("")
+    lines += [f"{k}: <code>{escape_html(v)}</code>" for k, v in prag.items()]
+    lines.append("")
+    lines.append("⏱ <b>Event loop</b>")
+    lines += [f"{k}: <b>{escape_html(v)}</b>" for k, v in loop_stats(st).items()]
+    lines.append("")
+    lines.append("🔐 <b>Admin cache</b>")
+    lines += [f"{k}: <b>{escape_html(v)}</b>" for k, v in ADMIN_CACHE.stats().items()]
+    lines.append("")
+    lines.append("⏰ <b>Deadlines</b>")
+    lines += [f"{k}: <b>{escape_html(v)}</b>" for k, v in DEADLINES.stats().items()]
+    lines.append("")
+    lines.append("🗓 <b>Attendance sheets</b>")
+    lines += [f"{k}: <b>{escape_html(v)}</b>" for k, v in ATT_SHEETS.stats().items()]
+    lines.append("")
+    lines.append("🧭 <b>FSM storage</b>")
+    lines += [f"{k}: <b>{escape_html(v)}</b>" for k, v in FSM_STORAGE.stats().items()]
+    lines.append("")
+    lines.append("📨 <b>Outbox</b>")
+    lines += [f"{k}: <b>{escape_html(v)}</b>" for k, v in (await OUTBOX.metrics()).items()]
+    lines.append("")
+    lines.append("📄 <b>Report cache</b>")
+    lines += [f"{k}: <b>{escape_html(v)}</b>" for k, v in {**REPORTS.stats(), **PDF_FONTS.stats()}.items()]
+    await message.reply("🗄 <b>DB pool</b>\n" + "\n".join(lines))
+
+
 # =========================
 # ADMIN: DB RESTORE (upload SQLite file)
 # =========================
@@ -735,10 +1690,40 @@ def _restore_db_from_path(src_path: str) -> str:
     if not _is_sqlite_file(tmp_db):
         raise ValueError("Bu fayl SQLite DB emas (header mos emas).")
 
+    # Fold the WAL into the current file and close pooled connections, so no stale -wal/-shm
+    # from the old DB is replayed on top of the restored one
+    DB_POOL.reset()
+    try:
+        chk = sqlite3.connect(db_path)
+        try:
+            chk.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            chk.close()
+    except Exception:
+        pass
+
     # Replace atomically
     new_path = db_path + ".new"
     shutil.copyfile(tmp_db, new_path)
     os.replace(new_path, db_path)
+    for suffix in ("-wal", "-shm"):
+        try:
+            os.remove(db_path + suffix)
+        except FileNotFoundError:
+            pass
+    # pooled connections still point at the replaced file
+    DB_POOL.reset()
+    # an older backup lacks newer tables / columns: bring it up to the current schema
+    init_db()
+    # the backup's queued DMs / kicks and unfinished broadcasts belong to its own past; replaying them
+    # would message or kick students again
+    with DB_POOL.writer() as conn:
+        conn.execute("""UPDATE outbox SET status='cancelled', done_at=?, error='restore'
+                         WHERE status IN ('pending', 'sending')""", (time.time(),))
+        conn.execute("UPDATE broadcast_jobs SET status='cancelled', finished_at=? WHERE status='running'", (now_str(),))
+    ADMIN_CACHE.invalidate()
+    LEADERBOARD.invalidate()
+    ATT_SHEETS.reset()
 
     for p in cleanup:
         try:
@@ -769,11 +1754,12 @@ async def cmd_restore_db(message: Message, state: FSMContext):
 
 @router.message(Command("cancel"))
 async def cmd_cancel(message: Message, state: FSMContext):
-    cur = await state.get_state()
-    if cur == RestoreState.waiting_file.state:
-        await state.clear()
-        await message.reply("✅ Bekor qilindi.")
-        return
+    await state.clear()
+    uid = message.from_user.id
+    if is_admin(uid):
+        await message.answer("Bekor qilindi.", reply_markup=kb_admin_home(uid))
+    else:
+        await message.answer("Bekor qilindi.", reply_markup=kb_user_home())
 
 
 @router.message(RestoreState.waiting_file, F.document)
@@ -783,7 +1769,7 @@ async def restore_db_document(message: Message, state: FSMContext):
 
     # Safety: backup current DB before restore
     try:
-        pre_zip, pre_cap = make_db_snapshot_zip()
+        pre_zip, pre_cap = await run_db(make_db_snapshot_zip)
         try:
             await message.bot.send_document(
                 chat_id=message.from_user.id,
@@ -818,7 +1804,18 @@ async def restore_db_document(message: Message, state: FSMContext):
         return
 
     try:
-        restored = _restore_db_from_path(tmp_path)
+        # stop sending before the swap; the worker restarts on the restored DB below
+        await OUTBOX.stop()
+        running = list(_BROADCAST_TASKS.values())
+        for t in running:
+            t.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        try:
+            restored = await run_db(_restore_db_from_path, tmp_path)
+        finally:
+            # after a failed restore this picks the old DB's work back up; after a good one there is none
+            OUTBOX.start(message.bot)
+            await resume_broadcast_jobs(message.bot)
     except Exception as e:
         await message.reply(f"❌ Restore xatolik: <code>{escape_html(e)}</code>")
         try:
@@ -833,6 +1830,9 @@ async def restore_db_document(message: Message, state: FSMContext):
         except Exception:
             pass
 
+    # deadlines of the restored tests / tasks
+    await DEADLINES.reload()
+
     await state.clear()
     await message.reply(
         "✅ <b>DB tiklandi.</b>\n"
@@ -841,16 +1841,12 @@ async def restore_db_document(message: Message, state: FSMContext):
     )
 
 def ensure_user(uid: int, name: str):
-    conn = db()
-    row = conn.execute("SELECT 1 FROM users WHERE user_id=?", (uid,)).fetchone()
-    if not row:
-        conn.execute("INSERT INTO users(user_id, full_name, created_at) VALUES (?,?,?)",
+    # keep name if exists
+    with DB_POOL.writer() as conn:
+        conn.execute("INSERT OR IGNORE INTO users(user_id, full_name, created_at) VALUES (?,?,?)",
                      (uid, name, now_str()))
-    else:
-        # keep name if exists
-        pass
-    conn.commit()
-    conn.close()
+        # they just wrote to us, so they can be reached again
+        conn.execute("UPDATE users SET reachable=1, unreachable_at=NULL WHERE user_id=? AND reachable=0", (uid,))
 
 def get_user_name(uid: int) -> str:
     conn = db()
@@ -858,23 +1854,404 @@ def get_user_name(uid: int) -> str:
     conn.close()
     return r["full_name"] if r and r["full_name"] else str(uid)
 
-def ensure_deadline(test_id: str) -> Tuple[Optional[str], Optional[str]]:
-    conn = db()
-    r = conn.execute("SELECT status, deadline FROM tests WHERE test_id=?", (test_id,)).fetchone()
-    if not r:
-        conn.close()
+# Effective test status in SQL: a test past its deadline reads as 'finished' even if the row has not been
+# updated yet (deadlines are "%Y-%m-%d %H:%M", so string order is time order). Bind now_str() for the `?`.
+TEST_STATUS_SQL = ("CASE WHEN t.status!='finished' AND t.deadline GLOB '????-??-?? ??:??' AND t.deadline <= ? "
+                   "THEN 'finished' ELSE t.status END")
+
+
+def finish_expired_tests() -> int:
+    """Bulk-finalize every test whose deadline has passed; returns how many rows changed."""
+    with DB_POOL.writer() as conn:
+        return conn.execute("""UPDATE tests SET status='finished'
+                               WHERE status!='finished' AND deadline GLOB '????-??-?? ??:??' AND deadline <= ?""",
+                            (now_str(),)).rowcount
+
+
+def with_test_status(rows: List[sqlite3.Row]) -> List[sqlite3.Row]:
+    """Rows selected with `raw_status` + effective `status`: persist any deadline-derived 'finished' in one UPDATE."""
+    if any(r["raw_status"] != r["status"] for r in rows):
+        finish_expired_tests()
+    return rows
+
+
+def ensure_deadline(test_id: str) -> Tuple[Optional[str], Optional[str]]:
+    with db() as conn:
+        r = conn.execute(f"SELECT t.status AS raw_status, {TEST_STATUS_SQL} AS status, t.deadline FROM tests t WHERE t.test_id=?",
+                         (now_str(), test_id)).fetchone()
+    if not r:
         return None, None
-    status, deadline = r["status"], r["deadline"]
-    try:
-        if deadline and status != "finished":
-            if datetime.now() >= parse_dt(deadline):
-                conn.execute("UPDATE tests SET status='finished' WHERE test_id=?", (test_id,))
-                conn.commit()
-                status = "finished"
-    except:
-        pass
-    conn.close()
-    return status, deadline
+    with_test_status([r])
+    return r["status"], r["deadline"]
+
+# =========================
+# LEADERBOARD (per-test ranking)
+# =========================
+class Leaderboard:
+    """
+    Per-test results kept sorted in memory (percent DESC, score DESC, then submit order), so top-N and
+    rank pages are a bisect/slice instead of an ORDER BY over the whole test.
+    - built lazily from `results` on first use (so it survives restarts: results is the durable copy);
+    - add() inserts new results into an already-loaded board in O(log n) search + one list insert
+      (keys end with results.id, so a row the board already picked up on load is not added twice);
+    - invalidate(tid) after anything rewrites or deletes results of a test (regrade, import, restore).
+    At most LEADERBOARD_TESTS boards are kept (least recently used are dropped).
+    """
+
+    def __init__(self, max_tests: int):
+        self.max_tests = max_tests
+        self._boards: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.loads = 0
+
+    @staticmethod
+    def _entry(r) -> dict:
+        keys = r.keys()
+        return {
+            "id": int(r["id"]),
+            "user_id": int(r["user_id"]) if r["user_id"] is not None else 0,
+            "full_name": r["full_name"],
+            "percent": float(r["percent"] or 0),
+            "score": int(r["score"] or 0) if "score" in keys else 0,
+            "total": int(r["total"] or 0) if "total" in keys else 0,
+            "date": (r["date"] or "") if "date" in keys else "",
+        }
+
+    @staticmethod
+    def _key(e: dict) -> tuple:
+        return (-e["percent"], -e["score"], e["id"])
+
+    def _insert(self, b: dict, e: dict) -> None:
+        k = self._key(e)
+        i = bisect.bisect_left(b["keys"], k)
+        if i < len(b["keys"]) and b["keys"][i] == k:
+            return  # already there: the board was loaded after the row was committed
+        b["keys"].insert(i, k)
+        b["entries"].insert(i, e)
+
+    def _board(self, tid: str) -> dict:
+        with self._lock:
+            b = self._boards.get(tid)
+            if b is not None:
+                self._boards.move_to_end(tid)
+                return b
+            with db() as conn:
+                rows = conn.execute("SELECT * FROM results WHERE test_id=?", (tid,)).fetchall()
+            entries = sorted((self._entry(r) for r in rows), key=self._key)
+            b = {"keys": [self._key(e) for e in entries], "entries": entries}
+            self._boards[tid] = b
+            self.loads += 1
+            while len(self._boards) > self.max_tests:
+                self._boards.popitem(last=False)
+            return b
+
+    def add(self, tid: str, rows) -> None:
+        """Record freshly inserted results rows (sqlite3.Row with an id) of test `tid`."""
+        with self._lock:
+            b = self._boards.get(tid)
+            if b is None:
+                return  # loaded with the new rows on first use
+            for r in rows:
+                self._insert(b, self._entry(r))
+
+    def invalidate(self, tid: Optional[str] = None) -> None:
+        with self._lock:
+            if tid is None:
+                self._boards.clear()
+            else:
+                self._boards.pop(tid, None)
+
+    def page(self, tid: str, offset: int = 0, limit: Optional[int] = None) -> List[dict]:
+        with self._lock:
+            entries = self._board(tid)["entries"]
+            return entries[offset:] if limit is None else entries[offset:offset + limit]
+
+    def size(self, tid: str) -> int:
+        with self._lock:
+            return len(self._board(tid)["entries"])
+
+
+LEADERBOARD = Leaderboard(LEADERBOARD_TESTS)
+
+# =========================
+# GRADING ENGINE
+# =========================
+try:
+    import numpy as np  # optional: vectorized regrade (pure-bytes fallback below)
+except ImportError:
+    np = None
+
+# bytes.translate table: XOR byte 0 (answer == key) -> 1, anything else -> 0
+_MATCH = bytes([1] + [0] * 255)
+
+
+def _answer_bytes(ans: Optional[str], n: int) -> bytes:
+    """One byte per question, padded/truncated to the key length (missing answers count as wrong)."""
+    b = (ans or "").upper().encode("ascii", "replace")[:n]
+    return b + b"-" * (n - len(b))
+
+
+def grade_matrix(keys: str, answers: List[str]) -> Tuple[List[int], List[int]]:
+    """
+    Grade many answer strings against one key in one pass: (score per answer, correct count per question).
+    Answers are compared as byte arrays: with NumPy a single (n, q) == key compare; without it each row is
+    XOR-ed against the key as one big int and bytes.translate marks the matches, so the per-answer work
+    stays in C either way.
+    """
+    q = len(keys)
+    if not answers or not q:
+        return [0] * len(answers), [0] * q
+    kb = keys.upper().encode("ascii", "replace")
+    rows = [_answer_bytes(a, q) for a in answers]
+    if np is not None:
+        m = np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(len(rows), q) == np.frombuffer(kb, dtype=np.uint8)
+        return m.sum(axis=1).tolist(), m.sum(axis=0).tolist()
+    k = int.from_bytes(kb, "big")
+    flags = [(int.from_bytes(r, "big") ^ k).to_bytes(q, "big").translate(_MATCH) for r in rows]
+    return [f.count(1) for f in flags], [sum(col) for col in zip(*flags)]
+
+
+def grade_one(keys: str, ans: str) -> int:
+    return grade_matrix(keys, [ans])[0][0]
+
+
+def regrade_test(tid: str, new_keys: str) -> dict:
+    """
+    Replace tests.keys and regrade every online submission of the test, all in one writer transaction
+    (the results row each submission produced is rewritten in place; the histogram triggers follow).
+    Manual and imported results are not linked to a submission and are left alone. "n" is the number of
+    submissions graded (per_q is over them), "regraded" the results rows rewritten.
+    """
+    total = len(new_keys)
+    with DB_POOL.writer() as conn:
+        subs = conn.execute("SELECT id, answers FROM submissions WHERE test_id=?", (tid,)).fetchall()
+        old = {int(r["submission_id"]): r["score"] for r in
+               conn.execute("SELECT submission_id, score FROM results WHERE test_id=? AND submission_id IS NOT NULL", (tid,))}
+        scores, per_q = grade_matrix(new_keys, [s["answers"] for s in subs])
+        conn.execute("UPDATE tests SET keys=? WHERE test_id=?", (new_keys, tid))
+        conn.executemany(
+            "UPDATE results SET score=?, total=?, percent=? WHERE submission_id=? AND test_id=?",
+            [(sc, total, (sc / total) * 100 if total else 0.0, int(s["id"]), tid)
+             for s, sc in zip(subs, scores) if int(s["id"]) in old],
+        )
+    LEADERBOARD.invalidate(tid)
+    changed = sum(1 for s, sc in zip(subs, scores) if int(s["id"]) in old and old[int(s["id"])] != sc)
+    regraded = sum(1 for s in subs if int(s["id"]) in old)
+    return {"n": len(subs), "regraded": regraded, "changed": changed, "total": total, "per_q": per_q}
+
+
+class ItemAnalysis:
+    """
+    Streaming item analysis of one test: feed() answer strings in batches (one pass over submissions),
+    report() gives per question the % correct (difficulty), how often each option was picked
+    (distractors) and the point-biserial correlation between getting it right and the total score
+    (discrimination). Only running sums are kept, so memory is O(questions), not O(takers).
+    """
+
+    OPTIONS = "ABCD"
+
+    def __init__(self, keys: str):
+        self.keys = keys.upper()
+        q = len(self.keys)
+        self.n = 0
+        self.s = 0        # sum of total scores
+        self.ss = 0       # sum of squared total scores
+        self.correct = [0] * q
+        self.s_correct = [0] * q  # sum of total scores of takers who got question j right
+        self.picks = [dict.fromkeys(self.OPTIONS + "-", 0) for _ in range(q)]
+
+    def feed(self, answers: List[str]) -> None:
+        q = len(self.keys)
+        if not answers or not q:
+            return
+        rows = [_answer_bytes(a, q) for a in answers]
+        kb = self.keys.encode("ascii", "replace")
+        if np is not None:
+            a = np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(len(rows), q)
+            m = a == np.frombuffer(kb, dtype=np.uint8)
+            scores = m.sum(axis=1)
+            correct, s_correct = m.sum(axis=0).tolist(), (scores @ m).tolist()
+            for opt in self.OPTIONS:
+                for j, c in enumerate((a == ord(opt)).sum(axis=0).tolist()):
+                    self.picks[j][opt] += c
+            scores = scores.tolist()
+        else:
+            k = int.from_bytes(kb, "big")
+            flags = [(int.from_bytes(r, "big") ^ k).to_bytes(q, "big").translate(_MATCH) for r in rows]
+            scores = [f.count(1) for f in flags]
+            correct = [sum(col) for col in zip(*flags)]
+            s_correct = [sum(sc for sc, hit in zip(scores, col) if hit) for col in zip(*flags)]
+            for j, col in enumerate(zip(*rows)):
+                picks = self.picks[j]
+                for opt in self.OPTIONS:
+                    picks[opt] += col.count(ord(opt))
+        for j in range(q):
+            self.correct[j] += correct[j]
+            self.s_correct[j] += s_correct[j]
+        self.n += len(rows)
+        self.s += sum(scores)
+        self.ss += sum(sc * sc for sc in scores)
+
+    def report(self) -> List[dict]:
+        n = self.n
+        mean = self.s / n if n else 0.0
+        sd = max(self.ss / n - mean * mean, 0.0) ** 0.5 if n else 0.0
+        out = []
+        for j, key in enumerate(self.keys):
+            c = self.correct[j]
+            p = c / n if n else 0.0
+            rpb = None
+            if n and sd > 0 and 0 < c < n:
+                m1 = self.s_correct[j] / c
+                m0 = (self.s - self.s_correct[j]) / (n - c)
+                rpb = (m1 - m0) / sd * (p * (1 - p)) ** 0.5
+            picks = dict(self.picks[j])
+            picks["-"] = n - sum(picks[o] for o in self.OPTIONS)  # blank / invalid
+            top_wrong = max((o for o in self.OPTIONS if o != key), key=lambda o: picks[o], default=None)
+            out.append({
+                "q": j + 1, "key": key, "p": p, "rpb": rpb, "picks": picks,
+                # an item most takers answer with the same wrong option usually has a wrong key
+                "suspect": bool(top_wrong and picks[top_wrong] > c),
+                "weak": rpb is not None and rpb < 0.2,
+            })
+        return out
+
+    def summary(self) -> dict:
+        mean = self.s / self.n if self.n else 0.0
+        sd = max(self.ss / self.n - mean * mean, 0.0) ** 0.5 if self.n else 0.0
+        return {"n": self.n, "questions": len(self.keys), "mean": mean, "sd": sd}
+
+
+def item_analysis(tid: str, batch: int = 1000) -> Optional[Tuple[dict, List[dict]]]:
+    """One streaming pass over the test's submissions (fetchmany batches, never the whole table)."""
+    with db() as conn:
+        t = conn.execute("SELECT keys FROM tests WHERE test_id=?", (tid,)).fetchone()
+        if not t or not t["keys"]:
+            return None
+        acc = ItemAnalysis(t["keys"])
+        cur = conn.execute("SELECT answers FROM submissions WHERE test_id=?", (tid,))
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            acc.feed([r["answers"] for r in rows])
+    return acc.summary(), acc.report()
+
+
+def item_analysis_text(tid: str, summary: dict, items: List[dict]) -> List[str]:
+    """Text report split into Telegram-sized messages."""
+    head = (f"🔬 <b>Savollar tahlili</b> — <code>{tid}</code>\n"
+            f"Topshirganlar: <b>{summary['n']}</b> · Savollar: <b>{summary['questions']}</b>\n"
+            f"O‘rtacha ball: <b>{summary['mean']:.1f}</b> (σ {summary['sd']:.1f})\n"
+            f"Format: ✅kalit to‘g‘ri% · variantlar · r (ajratish)\n"
+            f"⚠️ r&lt;0.2 — sust ajratadi · ❓ ko‘pchilik bir xil xato javob — kalitni tekshiring\n\n")
+    lines = []
+    for it in items:
+        pk = it["picks"]
+        opts = " ".join(f"{o}{pk[o]}" for o in ItemAnalysis.OPTIONS if o != it["key"])
+        r = f"{it['rpb']:.2f}" if it["rpb"] is not None else "—"
+        flag = ("❓" if it["suspect"] else "") + ("⚠️" if it["weak"] else "")
+        lines.append(f"{it['q']}) ✅{it['key']} {it['p'] * 100:.0f}% · {opts} · bo‘sh {pk['-']} · r {r} {flag}".rstrip())
+    msgs, cur = [], head
+    for ln in lines:
+        if len(cur) + len(ln) + 1 > 3800:
+            msgs.append(cur)
+            cur = ""
+        cur += ln + "\n"
+    msgs.append(cur)
+    return msgs
+
+
+def fmt_per_question(per_q: List[int], n: int) -> str:
+    """'1: 80% · 2: 45% · ...' — share of correct answers per question."""
+    if not n:
+        return "—"
+    return " · ".join(f"{i}: {c * 100 // n}%" for i, c in enumerate(per_q, 1))
+
+
+# =========================
+# KEYSET PAGINATION (list screens)
+# =========================
+PAGE_SIZE = 15
+RATING_PAGE_SIZE = 25
+
+
+class Keyset:
+    """
+    Keyset ("seek") pagination: every view is one `... AND (k1, k2) < (key of cursor row) ORDER BY k1, k2
+    LIMIT n+1` query, so a page costs the same on row 20 and row 20 000. The cursor that goes into
+    callback_data is just the id of the first/last row shown (stays far below Telegram's 64 bytes);
+    `key_of` turns it back into the full sort key.
+
+    sql    -- "SELECT ..., <id> AS _cur FROM ... WHERE <filter>" (no ORDER BY / LIMIT)
+    key    -- unique sort key, display order, e.g. ("t.created_at", "t.rowid")
+    key_of -- "SELECT <same columns> FROM <table> WHERE <id>=?"
+    """
+
+    def __init__(self, sql: str, key: Tuple[str, ...], key_of: str, desc: bool = False):
+        self.sql, self.key, self.key_of, self.desc = sql, key, key_of, desc
+
+    def _query(self, after: bool) -> Tuple[str, str]:
+        lt = self.desc == after  # rows after the cursor of a DESC list have smaller keys
+        op = "<" if lt else ">"
+        direction = "DESC" if lt else "ASC"
+        seek = f"({', '.join(self.key)}) {op} ({self.key_of})"
+        order = ", ".join(f"{k} {direction}" for k in self.key)
+        return seek, order
+
+    def page(self, params=(), cursor: Optional[int] = None, back: bool = False,
+             limit: int = PAGE_SIZE) -> Tuple[List[sqlite3.Row], bool, bool]:
+        """Returns (rows, has_prev, has_next); `back` = rows before `cursor` instead of after it."""
+        if cursor is None:
+            seek, order = None, ", ".join(f"{k} {'DESC' if self.desc else 'ASC'}" for k in self.key)
+        else:
+            seek, order = self._query(after=not back)
+        q = self.sql + (f" AND {seek}" if seek else "") + f" ORDER BY {order} LIMIT ?"
+        args = tuple(params) + ((cursor,) if seek else ()) + (limit + 1,)
+        with db() as conn:
+            rows = conn.execute(q, args).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if back:
+            rows.reverse()
+            return rows, more, True
+        return rows, cursor is not None, more
+
+
+def parse_page(data: str, prefix: str) -> Tuple[Optional[int], bool]:
+    """`<prefix>:n:<cursor>` / `<prefix>:p:<cursor>` -> (cursor, back); anything else -> first page."""
+    rest = data[len(prefix):].strip(":") if data.startswith(prefix) else ""
+    if not rest:
+        return None, False
+    d, cur = rest.split(":", 1)
+    return int(cur), d == "p"
+
+
+def kb_page_nav(prefix: str, rows, has_prev: bool, has_next: bool, cur_col: str = "_cur") -> List[InlineKeyboardButton]:
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"{prefix}:p:{rows[0][cur_col]}"))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"{prefix}:n:{rows[-1][cur_col]}"))
+    return nav
+
+
+GROUPS_PAGES = Keyset(
+    "SELECT id, name, invite_code, id AS _cur FROM groups WHERE 1=1",
+    key=("id",), key_of="SELECT id FROM groups WHERE id=?", desc=True,
+)
+TESTS_PAGES = Keyset(
+    f"SELECT t.test_id, t.status AS raw_status, {TEST_STATUS_SQL} AS status, t.deadline, t.rowid AS _cur "
+    f"FROM tests t WHERE 1=1",
+    key=("t.created_at", "t.rowid"), key_of="SELECT created_at, rowid FROM tests WHERE rowid=?", desc=True,
+)
+STUDENTS_PAGES = Keyset(
+    """SELECT u.user_id, u.full_name, u.user_id AS _cur
+         FROM members m JOIN users u ON u.user_id=m.user_id
+        WHERE m.group_id=?""",
+    key=("COALESCE(u.full_name, '')", "u.user_id"),
+    key_of="SELECT COALESCE(full_name, ''), user_id FROM users WHERE user_id=?",
+)
 
 # =========================
 # STATES
@@ -900,14 +2277,20 @@ class AState(StatesGroup):
     t_keys = State()
     t_minutes = State()
     t_assign = State()
+    t_edit_keys = State()
 
     # manual results
     m_tid = State()
     m_total = State()
     m_scores = State()
 
+    # data export
+    exp_range = State()
+
     # import results
     imp_tid = State()
+    imp_total = State()
+    imp_file = State()
 
     # group settings
     gs_chatid = State()
@@ -943,6 +2326,8 @@ def kb_admin_home(uid: int) -> InlineKeyboardMarkup:
         rows.append([InlineKeyboardButton(text="🧪 Testlar", callback_data="a:tests")])
     if has_perm(uid, "broadcast") or is_super(uid):
         rows.append([InlineKeyboardButton(text="📢 Global xabar", callback_data="a:broadcast")])
+    if has_perm(uid, "export") or is_super(uid):
+        rows.append([InlineKeyboardButton(text="📤 Eksport", callback_data="a:export")])
     if is_super(uid):
         rows.append([InlineKeyboardButton(text="👮 Adminlar", callback_data="a:admins")])
     rows.append([InlineKeyboardButton(text="👤 User rejimi", callback_data="a:as_user")])
@@ -951,87 +2336,341 @@ def kb_admin_home(uid: int) -> InlineKeyboardMarkup:
 # =========================
 # PDF GENERATORS
 # =========================
-def pdf_rating(filename: str, title: str, rows: List[Tuple[str, int, int, float, str]]):
+# Reports render in memory on REPORT_EXECUTOR (`await run_report(pdf_x, ...)`) and return bytes that
+# are sent as BufferedInputFile — no file in the CWD, so concurrent requests never share a path.
+# Rows are pulled from a cursor one at a time; only the FPDF page buffer grows with the report.
+class PdfFonts:
     """
-    rows: (full_name, score, total, percent, date)
+    Unicode TTF faces (Latin, Uzbek Latin, Cyrillic) for reports, parsed once per process.
+    fpdf builds the glyph width / cmap tables of a TTF on every add_font(); here they are built
+    once and each document gets a clone sharing them, with its own fontTools object (the
+    subsetter rewrites that one in place when the PDF is written) opened from the cached bytes.
+    The clone copies fpdf private state, so it is only used on the fpdf2 line it was checked
+    against (CLONE_VERSIONS); other versions call add_font() per document, same output.
+    Without a font file reports fall back to core Arial, and text goes through pdf_safe.
     """
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_auto_page_break(auto=True, margin=12)
-
-    # Header
-    pdf.set_fill_color(33, 150, 243)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(190, 12, txt=pdf_safe(title), ln=True, align="C", fill=True)
-
-    pdf.ln(3)
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Arial", "B", 10)
-    pdf.set_fill_color(230, 230, 230)
-
-    pdf.cell(12, 8, pdf_safe("No"), 1, 0, "C", True)
-    pdf.cell(78, 8, pdf_safe("Ism"), 1, 0, "C", True)
-    pdf.cell(26, 8, pdf_safe("Ball"), 1, 0, "C", True)
-    pdf.cell(22, 8, pdf_safe("Foiz"), 1, 0, "C", True)
-    pdf.cell(52, 8, pdf_safe("Sana"), 1, 1, "C", True)
-
-    pdf.set_font("Arial", "", 10)
-
-    for i, (name, score, total, percent, date_s) in enumerate(rows, 1):
-        p = float(percent)
-
-        # Color bands (you requested: 85+ green, 65+ yellow, else red)
-        if p >= 85:
-            pdf.set_fill_color(90, 220, 120)
-        elif p >= 65:
-            pdf.set_fill_color(255, 215, 80)
-        else:
-            pdf.set_fill_color(255, 110, 110)
+    FAMILY = "DejaVu"
+    FILES = {"": "DejaVuSans.ttf", "B": "DejaVuSans-Bold.ttf"}
+    CLONE_VERSIONS = ("2.8.",)
+
+    def __init__(self, dirs: Sequence[str]):
+        self.dirs = [d for d in dirs if d]
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._faces: dict = {}  # style -> (template TTFFont, file bytes, path)
+        self.can_clone = TTFFont is not None and FPDF_VERSION.startswith(self.CLONE_VERSIONS)
+        self.clones = 0
+        self.fallbacks = 0
+
+    def _find(self, name: str) -> Optional[str]:
+        for d in self.dirs:
+            p = os.path.join(d, name)
+            if os.path.isfile(p):
+                return p
+        return None
+
+    def _load(self) -> None:
+        with self._lock:
+            if self._loaded:
+                return
+            paths = {style: self._find(name) for style, name in self.FILES.items()}
+            if all(paths.values()):
+                try:
+                    probe = FPDF()
+                    for style, path in paths.items():
+                        probe.add_font(self.FAMILY, style, path)
+                        with open(path, "rb") as f:
+                            self._faces[style] = (probe.fonts[f"{self.FAMILY.lower()}{style}"], f.read(), path)
+                    logging.info("PDF font: %s", ", ".join(paths.values()))
+                except Exception:
+                    logging.exception("PDF font load failed; reports use latin-1 core fonts")
+                    self._faces = {}
+            else:
+                logging.warning("PDF font %s not found in %s; reports use latin-1 core fonts",
+                                "/".join(self.FILES.values()), self.dirs)
+            self._loaded = True
+
+    @property
+    def unicode(self) -> bool:
+        self._load()
+        return bool(self._faces)
+
+    def _clone(self, pdf: FPDF, style: str) -> None:
+        tpl, data, _path = self._faces[style]
+        f = object.__new__(TTFFont)
+        for slot in TTFFont.__slots__:
+            if hasattr(tpl, slot):
+                setattr(f, slot, getattr(tpl, slot))
+        f.i = len(pdf.fonts) + 1
+        f.ttfont = ttLib.TTFont(io.BytesIO(data), recalcTimestamp=False, lazy=True)
+        f._hbfont = None
+        f.missing_glyphs = []
+        f.biggest_size_pt = 0
+        f.subset = SubsetMap(f)
+        pdf.fonts[f"{self.FAMILY.lower()}{style}"] = f
+
+    def install(self, pdf: FPDF) -> str:
+        """Make the report font available in `pdf`; returns the family to pass to set_font()."""
+        if not self.unicode:
+            return "Arial"
+        for style in self.FILES:
+            if self.can_clone:
+                try:
+                    self._clone(pdf, style)
+                    self.clones += 1
+                    continue
+                except Exception:
+                    # fpdf internals differ from what the clone expects: take the documented path
+                    logging.exception("PDF font clone failed; using add_font")
+                    self.can_clone = False
+            self.fallbacks += 1
+            pdf.add_font(self.FAMILY, style, self._faces[style][2])
+        return self.FAMILY
+
+    def stats(self) -> dict:
+        self._load()
+        return {"font": self.FAMILY if self._faces else "Arial (latin-1)", "clones": self.clones,
+                "fallbacks": self.fallbacks, "clone_path": "on" if self.can_clone else f"off (fpdf2 {FPDF_VERSION})"}
+
+
+PDF_FONTS = PdfFonts([PDF_FONT_DIR, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts"),
+                      "/usr/share/fonts/truetype/dejavu"])
 
-        pdf.cell(12, 8, str(i), 1, 0, "C", True)
-        pdf.cell(78, 8, pdf_safe(name)[:44], 1, 0, "L", True)
-        pdf.cell(26, 8, pdf_safe(f"{score}/{total}"), 1, 0, "C", True)
-        pdf.cell(22, 8, pdf_safe(f"{p:.1f}%"), 1, 0, "C", True)
-        pdf.cell(52, 8, pdf_safe(date_s), 1, 1, "C", True)
 
-    pdf.output(filename)
+class PdfTable:
+    """
+    Single-table A4 report: a title band, optional subtitle, then rows under a header that
+    is repeated at the top of every page.
+    columns: [(label, width_mm, align)]
+    """
+    ROW_H = 8
+
+    def __init__(self, title: str, columns: List[Tuple[str, int, str]], subtitle: Optional[str] = None):
+        self.columns = columns
+        self.rows = 0
+        self.pdf = FPDF()
+        self.font = PDF_FONTS.install(self.pdf)
+        # the TTF takes any text as is; core fonts only latin-1
+        self.text = str if self.font != "Arial" else pdf_safe
+        self.pdf.set_auto_page_break(auto=True, margin=12)
+        self.pdf.add_page()
+
+        self.pdf.set_fill_color(33, 150, 243)
+        self.pdf.set_text_color(255, 255, 255)
+        self.pdf.set_font(self.font, "B", 14)
+        self.pdf.cell(190, 12, txt=self.text(title), ln=True, align="C", fill=True)
+        self.pdf.set_text_color(0, 0, 0)
+        if subtitle:
+            self.pdf.set_font(self.font, "", 10)
+            self.pdf.cell(0, 8, self.text(subtitle), ln=1, align="C")
+        self.pdf.ln(2)
+        self._header()
+
+    def _header(self) -> None:
+        pdf = self.pdf
+        pdf.set_font(self.font, "B", 10)
+        pdf.set_fill_color(230, 230, 230)
+        last = len(self.columns) - 1
+        for i, (label, w, _) in enumerate(self.columns):
+            pdf.cell(w, self.ROW_H, self.text(label), 1, 1 if i == last else 0, "C", True)
+        pdf.set_font(self.font, "", 10)
+
+    def row(self, cells: Sequence, fill: Optional[Tuple[int, int, int]] = None) -> None:
+        pdf = self.pdf
+        if pdf.will_page_break(self.ROW_H):
+            pdf.add_page()
+            self._header()
+        if fill:
+            pdf.set_fill_color(*fill)
+        last = len(self.columns) - 1
+        for i, ((_, w, align), v) in enumerate(zip(self.columns, cells)):
+            # clip to the column so long names never wrap into the next row
+            text = self.text(v)
+            width = pdf.get_string_width(text)
+            if width > w - 2:
+                text = text[:max(1, int(len(text) * (w - 2) / width))]
+                while len(text) > 1 and pdf.get_string_width(text) > w - 2:
+                    text = text[:-1]
+            pdf.cell(w, self.ROW_H, text, 1, 1 if i == last else 0, align, bool(fill))
+        self.rows += 1
+
+    def note(self, text: str) -> None:
+        self.pdf.ln(3)
+        self.pdf.set_font(self.font, "", 9)
+        self.pdf.multi_cell(0, 5, self.text(text))
+
+    def output(self) -> bytes:
+        return bytes(self.pdf.output())
+
+
+def _percent_fill(p: float) -> Tuple[int, int, int]:
+    # Color bands (you requested: 85+ green, 65+ yellow, else red)
+    if p >= 85:
+        return (90, 220, 120)
+    if p >= 65:
+        return (255, 215, 80)
+    return (255, 110, 110)
+
+
+def pdf_rating(tid: str, title: str) -> Optional[bytes]:
+    """
+    Full rating of a test, streamed from results in rank order (ix_results_test_rank).
+    None when the test has no results.
+    """
+    t = PdfTable(title, [("No", 12, "C"), ("Ism", 78, "L"), ("Ball", 26, "C"), ("Foiz", 22, "C"), ("Sana", 52, "C")])
+    with db() as conn:
+        cur = conn.execute(
+            "SELECT full_name, score, total, percent, date FROM results WHERE test_id=? "
+            "ORDER BY percent DESC, score DESC, id",
+            (tid,),
+        )
+        for i, r in enumerate(cur, 1):
+            p = float(r["percent"] or 0)
+            date_s = to_uz_time_str(r["date"]) if r["date"] else ""
+            t.row([str(i), r["full_name"] or "", f"{r['score'] or 0}/{r['total'] or 0}", f"{p:.1f}%", date_s],
+                  _percent_fill(p))
+    return t.output() if t.rows else None
 
 
-def pdf_attendance(filename: str, group_name: str, date_s: str, rows: List[Tuple[str, str]]):
+def pdf_item_analysis(title: str, summary: dict, items: List[dict]) -> bytes:
     """
-    rows = [(name, status)] status: present/absent
+    items: ItemAnalysis.report() rows
     """
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_auto_page_break(auto=True, margin=12)
-
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(0, 10, safe_pdf_text(f"Davomat — {group_name}"), ln=1, align="C")
-    pdf.set_font("Arial", "", 11)
-    pdf.cell(0, 8, safe_pdf_text(f"Sana: {date_s} | Jami: {len(rows)}"), ln=1, align="C")
-    pdf.ln(2)
-
-    # Header
-    pdf.set_font("Arial", "B", 10)
-    pdf.set_fill_color(230, 230, 230)
-    pdf.cell(10, 8, "#", 1, 0, "C", True)
-    pdf.cell(140, 8, "Ism", 1, 0, "L", True)
-    pdf.cell(40, 8, "Holat", 1, 1, "C", True)
-
-    pdf.set_font("Arial", "", 10)
-    for i, (name, st) in enumerate(rows, 1):
-        if st == "absent":
-            pdf.set_fill_color(255, 210, 210)
-            label = "Qatnashmadi"
+    t = PdfTable(
+        title,
+        [("No", 12, "C"), ("Kalit", 16, "C"), ("To'g'ri %", 24, "C"), ("A", 20, "C"), ("B", 20, "C"),
+         ("C", 20, "C"), ("D", 20, "C"), ("Bo'sh", 22, "C"), ("r_pb", 36, "C")],
+        subtitle=f"Topshirganlar: {summary['n']} | Savollar: {summary['questions']} | "
+                 f"O'rtacha ball: {summary['mean']:.1f} (sd {summary['sd']:.1f})",
+    )
+    for it in items:
+        # difficulty bands: too easy / ok / too hard
+        p = it["p"] * 100
+        if it["suspect"] or p < 30:
+            fill = (255, 110, 110)
+        elif it["weak"] or p > 90:
+            fill = (255, 215, 80)
         else:
-            pdf.set_fill_color(200, 255, 200)
-            label = "Qatnashdi"
-        pdf.cell(10, 8, str(i), 1, 0, "C", True)
-        pdf.cell(140, 8, safe_pdf_text(name)[:80], 1, 0, "L", True)
-        pdf.cell(40, 8, safe_pdf_text(label), 1, 1, "C", True)
+            fill = (90, 220, 120)
+        pk = it["picks"]
+        r = f"{it['rpb']:.2f}" if it["rpb"] is not None else "-"
+        t.row([str(it["q"]), it["key"], f"{p:.0f}%"] + [
+            f"{pk[o]}{'*' if o == it['key'] else ''}" for o in ItemAnalysis.OPTIONS
+        ] + [str(pk["-"]), r], fill)
+
+    t.note("* - to'g'ri javob. Qizil: ko'pchilik bir xil xato variantni tanlagan (kalitni tekshiring) "
+           "yoki juda qiyin (<30%). Sariq: sust ajratadi (r_pb < 0.2) yoki juda oson (>90%).")
+    return t.output()
+
+
+def pdf_attendance(gid: int, group_name: str, date_s: str) -> Optional[bytes]:
+    """
+    Attendance sheet of a group for one date, streamed from members x attendance.
+    Students without a mark count as present. None when the group has no students.
+    """
+    t = PdfTable(f"Davomat — {group_name}", [("#", 10, "C"), ("Ism", 140, "L"), ("Holat", 40, "C")],
+                 subtitle=f"Sana: {date_s}")
+    absent = 0
+    with db() as conn:
+        cur = conn.execute(
+            """SELECT u.full_name, a.status
+               FROM members m
+               JOIN users u ON u.user_id=m.user_id
+               LEFT JOIN attendance a ON a.group_id=m.group_id AND a.user_id=m.user_id AND a.att_date=?
+               WHERE m.group_id=?
+               ORDER BY u.full_name""",
+            (date_s, gid),
+        )
+        for i, r in enumerate(cur, 1):
+            if r["status"] == "absent":
+                absent += 1
+                t.row([str(i), r["full_name"] or "", "Qatnashmadi"], (255, 210, 210))
+            else:
+                t.row([str(i), r["full_name"] or "", "Qatnashdi"], (200, 255, 200))
+    if not t.rows:
+        return None
+    t.note(f"Jami: {t.rows} | Qatnashdi: {t.rows - absent} | Qatnashmadi: {absent}")
+    return t.output()
 
-    pdf.output(filename)
+
+# =========================
+# REPORT CACHE (Telegram file_id per report and data version)
+# =========================
+class ReportCache:
+    """
+    Sent reports keyed by (kind, entity) and remembered with the data version they were built from.
+    The version is read from report_versions, which triggers bump on every write to the underlying
+    rows (see migration 007), so a cached file_id is reused only while nothing it shows has changed.
+    Repeat requests resend the Telegram file_id: no render, no upload.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    @staticmethod
+    def version(scopes: Sequence[Tuple[str, str]]) -> str:
+        with db() as conn:
+            out = []
+            for scope, entity in scopes:
+                r = conn.execute("SELECT version FROM report_versions WHERE scope=? AND entity=?",
+                                 (scope, str(entity))).fetchone()
+                out.append(str(r["version"]) if r else "0")
+        return ".".join(out)
+
+    @staticmethod
+    def get(kind: str, entity: str, version: str) -> Optional[str]:
+        with db() as conn:
+            r = conn.execute("SELECT file_id FROM report_cache WHERE kind=? AND entity=? AND version=?",
+                             (kind, entity, version)).fetchone()
+        return r["file_id"] if r else None
+
+    @staticmethod
+    def put(kind: str, entity: str, version: str, file_id: str) -> None:
+        with DB_POOL.writer() as conn:
+            conn.execute("INSERT OR REPLACE INTO report_cache(kind, entity, version, file_id, created_at) VALUES (?,?,?,?,?)",
+                         (kind, entity, version, file_id, now_str()))
+
+    @staticmethod
+    def drop(kind: str, entity: str) -> None:
+        with DB_POOL.writer() as conn:
+            conn.execute("DELETE FROM report_cache WHERE kind=? AND entity=?", (kind, entity))
+
+    async def send(self, message: Message, kind: str, entity: str, scopes: Sequence[Tuple[str, str]],
+                   filename: str, render, *args) -> bool:
+        """
+        Send report `kind` of `entity` to the chat of `message`: the cached file_id when its version is
+        current, otherwise render(*args) on REPORT_EXECUTOR, upload and remember the new file_id.
+        False when render returned nothing (empty report).
+        """
+        version = await run_db(self.version, scopes)
+        fid = await run_db(self.get, kind, entity, version)
+        if fid:
+            try:
+                await message.answer_document(fid)
+                self.hits += 1
+                return True
+            except TelegramBadRequest:
+                # file_id no longer accepted (different bot token, file expired) - render again
+                self.stale += 1
+                await run_db(self.drop, kind, entity)
+        self.misses += 1
+        data = await run_report(render, *args)
+        if not data:
+            return False
+        sent = await message.answer_document(BufferedInputFile(data, filename=filename))
+        doc = getattr(sent, "document", None)
+        if doc is not None:
+            # cached under the version read before rendering: a write during the render only costs a re-render
+            await run_db(self.put, kind, entity, version, doc.file_id)
+        return True
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "stale": self.stale}
+
+
+REPORTS = ReportCache()
 # =========================
 # START / USER REGISTER
 # =========================
@@ -1041,9 +2680,7 @@ async def cmd_start(message: Message, state: FSMContext):
     uid = message.from_user.id
 
     # ensure user row exists
-    conn = db()
-    u = conn.execute("SELECT full_name FROM users WHERE user_id=?", (uid,)).fetchone()
-    conn.close()
+    u = await db_fetchone("SELECT full_name FROM users WHERE user_id=?", (uid,))
 
     if not u:
         # ask name (first time)
@@ -1057,7 +2694,7 @@ async def cmd_start(message: Message, state: FSMContext):
     if is_admin(uid):
         await message.answer("⚙️ <b>Admin panel</b>", reply_markup=kb_admin_home(uid))
     else:
-        await message.answer(f"👋 Salom, <b>{safe_pdf_text(u['full_name'])}</b>!", reply_markup=kb_user_home())
+        await message.answer(f"👋 Salom, <b>{escape_html(u['full_name'])}</b>!", reply_markup=kb_user_home())
 
 @router.message(UState.reg_name)
 async def reg_name(message: Message, state: FSMContext):
@@ -1065,7 +2702,7 @@ async def reg_name(message: Message, state: FSMContext):
     if len(name) < 3:
         await message.answer("Iltimos, ism-familiyani to‘liq yozing:")
         return
-    ensure_user(message.from_user.id, name)
+    await run_db(ensure_user, message.from_user.id, name)
     await state.clear()
     await message.answer("✅ Saqlandi! Asosiy menyu:", reply_markup=kb_user_home())
 
@@ -1113,24 +2750,27 @@ async def u_join_code(message: Message, state: FSMContext):
         await message.answer("❌ Kod formati xato. Masalan: 1234AB")
         return
     uid = message.from_user.id
-    ensure_user(uid, message.from_user.full_name or "No Name")
-
-    conn = db()
-    g = conn.execute("SELECT id, name FROM groups WHERE invite_code=?", (code,)).fetchone()
+    await run_db(ensure_user, uid, message.from_user.full_name or "No Name")
+
+    def _join():
+        with DB_POOL.writer() as conn:
+            g = conn.execute("SELECT id, name FROM groups WHERE invite_code=?", (code,)).fetchone()
+            if not g:
+                return None
+            exists = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (g["id"], uid)).fetchone()
+            if not exists:
+                conn.execute("INSERT INTO members(group_id, user_id) VALUES (?,?)", (g["id"], uid))
+                conn.execute("INSERT OR IGNORE INTO counters(group_id, user_id, absent_count, missed_task_count) VALUES (?,?,0,0)",
+                             (g["id"], uid))
+            return g
+
+    g = await run_db(_join)
     if not g:
-        conn.close()
         await message.answer("❌ Guruh topilmadi. Kodni tekshiring.")
         return
-    exists = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (g["id"], uid)).fetchone()
-    if not exists:
-        conn.execute("INSERT INTO members(group_id, user_id) VALUES (?,?)", (g["id"], uid))
-        conn.execute("INSERT OR IGNORE INTO counters(group_id, user_id, absent_count, missed_task_count) VALUES (?,?,0,0)",
-                     (g["id"], uid))
-        conn.commit()
-    conn.close()
 
     await state.clear()
-    await message.answer(f"✅ <b>{safe_pdf_text(g['name'])}</b> guruhiga qo‘shildingiz.", reply_markup=kb_user_home())
+    await message.answer(f"✅ <b>{escape_html(g['name'])}</b> guruhiga qo‘shildingiz.", reply_markup=kb_user_home())
 
 def user_groups(uid: int) -> List[Tuple[int, str]]:
     conn = db()
@@ -1149,7 +2789,7 @@ def user_groups(uid: int) -> List[Tuple[int, str]]:
 @router.callback_query(F.data == "u:mygroups")
 async def u_mygroups(call: CallbackQuery):
     uid = call.from_user.id
-    groups = user_groups(uid)
+    groups = await run_db(user_groups, uid)
     if not groups:
         await safe_edit(call, "Siz hech qaysi guruhda emassiz.", kb_user_home())
         return
@@ -1165,10 +2805,8 @@ async def u_group_view(call: CallbackQuery):
     uid = call.from_user.id
     gid = int(call.data.split(":")[2])
 
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
+    mem = await db_fetchone("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid))
+    g = await db_fetchone("SELECT name FROM groups WHERE id=?", (gid,))
     if not mem or not g:
         await call.answer("Bu guruh sizniki emas.", show_alert=True)
         return
@@ -1179,54 +2817,53 @@ async def u_group_view(call: CallbackQuery):
         [InlineKeyboardButton(text="⬅️ Ortga", callback_data="u:mygroups")],
         [InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")],
     ])
-    await safe_edit(call, f"📌 <b>{safe_pdf_text(g['name'])}</b>\nQuyidan bo‘lim tanlang:", kb)
+    await safe_edit(call, f"📌 <b>{escape_html(g['name'])}</b>\nQuyidan bo‘lim tanlang:", kb)
 
 # =========================
 # USER: group tests list
 # =========================
-def tests_for_user_in_group(uid: int, gid: int) -> List[sqlite3.Row]:
-    conn = db()
-    # allowed: public OR assigned to this group
-    rows = conn.execute("""
-        SELECT t.test_id, t.status, t.deadline, COALESCE(t.is_public,0) AS is_public
-        FROM tests t
-        LEFT JOIN test_groups tg ON tg.test_id=t.test_id
-        WHERE (COALESCE(t.is_public,0)=1) OR (tg.group_id=?)
-        GROUP BY t.test_id
-        ORDER BY t.created_at DESC
-    """, (gid,)).fetchall()
-    conn.close()
-    return rows
+def tests_for_user_in_group(uid: int, gid: int, limit: int = 30) -> List[sqlite3.Row]:
+    with db() as conn:
+        # allowed: public OR assigned to this group
+        rows = conn.execute(f"""
+            SELECT t.test_id, t.status AS raw_status, {TEST_STATUS_SQL} AS status, t.deadline,
+                   COALESCE(t.is_public,0) AS is_public
+            FROM tests t
+            LEFT JOIN test_groups tg ON tg.test_id=t.test_id
+            WHERE (COALESCE(t.is_public,0)=1) OR (tg.group_id=?)
+            GROUP BY t.test_id
+            ORDER BY t.created_at DESC
+            LIMIT ?
+        """, (now_str(), gid, limit)).fetchall()
+    return with_test_status(rows)
 
 @router.callback_query(F.data.startswith("u:gt:"))
 async def u_group_tests(call: CallbackQuery):
     uid = call.from_user.id
     gid = int(call.data.split(":")[2])
 
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
+    mem = await db_fetchone("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid))
+    g = await db_fetchone("SELECT name FROM groups WHERE id=?", (gid,))
     if not mem or not g:
         await call.answer("Bu guruh sizniki emas.", show_alert=True)
         return
 
-    rows = tests_for_user_in_group(uid, gid)
+    rows = await run_db(tests_for_user_in_group, uid, gid)
     if not rows:
         kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"u:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")]])
         await safe_edit(call, "Bu guruhda hozircha test yo‘q.", kb)
         return
 
     kb_rows = []
-    for r in rows[:30]:
-        status, dl = ensure_deadline(r["test_id"])
+    for r in rows:
+        status = r["status"]
         icon = "🟢" if status == "active" else "⏸" if status == "paused" else "🏁"
         kb_rows.append([InlineKeyboardButton(
             text=f"{icon} {r['test_id']} ({status})",
             callback_data=f"u:solve_tid:{r['test_id']}"
         )])
     kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"u:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")])
-    await safe_edit(call, f"🧪 <b>{safe_pdf_text(g['name'])}</b> — Testlar:", InlineKeyboardMarkup(inline_keyboard=kb_rows))
+    await safe_edit(call, f"🧪 <b>{escape_html(g['name'])}</b> — Testlar:", InlineKeyboardMarkup(inline_keyboard=kb_rows))
 
 # =========================
 # USER: Solve test (by id from list or manual)
@@ -1248,7 +2885,7 @@ async def u_solve_from_button(call: CallbackQuery, state: FSMContext):
 @router.message(UState.solve_tid)
 async def u_solve_tid_msg(message: Message, state: FSMContext):
     tid = (message.text or "").strip()
-    status, deadline = ensure_deadline(tid)
+    status, deadline = await run_db(ensure_deadline, tid)
     if status is None:
         await message.answer("❌ Test topilmadi.")
         return
@@ -1263,23 +2900,27 @@ async def u_solve_tid_msg(message: Message, state: FSMContext):
 
     # allow if public OR assigned to any of user's groups
     uid = message.from_user.id
-    conn = db()
-    pub = conn.execute("SELECT COALESCE(is_public,0) AS p FROM tests WHERE test_id=?", (tid,)).fetchone()
-    if pub and int(pub["p"]) == 1:
-        allowed = True
-    else:
-        gids = conn.execute("SELECT group_id FROM members WHERE user_id=?", (uid,)).fetchall()
-        if not gids:
-            allowed = False
-        else:
-            myg = [int(x["group_id"]) for x in gids]
-            tg = conn.execute("SELECT group_id FROM test_groups WHERE test_id=?", (tid,)).fetchall()
-            allowed_set = {int(x["group_id"]) for x in tg}
-            allowed = any(g in allowed_set for g in myg)
-    # anti-cheat
-    already = conn.execute("SELECT 1 FROM submissions WHERE user_id=? AND test_id=?", (uid, tid)).fetchone()
-    keys = conn.execute("SELECT keys FROM tests WHERE test_id=?", (tid,)).fetchone()
-    conn.close()
+
+    def _load():
+        with db() as conn:
+            pub = conn.execute("SELECT COALESCE(is_public,0) AS p FROM tests WHERE test_id=?", (tid,)).fetchone()
+            if pub and int(pub["p"]) == 1:
+                allowed = True
+            else:
+                gids = conn.execute("SELECT group_id FROM members WHERE user_id=?", (uid,)).fetchall()
+                if not gids:
+                    allowed = False
+                else:
+                    myg = [int(x["group_id"]) for x in gids]
+                    tg = conn.execute("SELECT group_id FROM test_groups WHERE test_id=?", (tid,)).fetchall()
+                    allowed_set = {int(x["group_id"]) for x in tg}
+                    allowed = any(g in allowed_set for g in myg)
+            # anti-cheat
+            already = conn.execute("SELECT 1 FROM submissions WHERE user_id=? AND test_id=?", (uid, tid)).fetchone()
+            keys = conn.execute("SELECT keys FROM tests WHERE test_id=?", (tid,)).fetchone()
+            return allowed, already, keys
+
+    allowed, already, keys = await run_db(_load)
 
     if not allowed:
         await message.answer("❌ Bu test sizga biriktirilmagan (public emas va guruhingizda yo‘q).")
@@ -1304,7 +2945,7 @@ async def u_solve_answers(message: Message, state: FSMContext):
     tid = data.get("tid")
     keys = data.get("keys", "")
 
-    status, _ = ensure_deadline(tid)
+    status, _ = await run_db(ensure_deadline, tid)
     if status != "active":
         await message.answer("⛔️ Test tugagan yoki pauzada.")
         await state.clear()
@@ -1319,28 +2960,34 @@ async def u_solve_answers(message: Message, state: FSMContext):
         return
 
     uid = message.from_user.id
-    ensure_user(uid, message.from_user.full_name or "No Name")
-    full_name = get_user_name(uid)
 
-    conn = db()
-    # anti-cheat
-    already = conn.execute("SELECT 1 FROM submissions WHERE user_id=? AND test_id=?", (uid, tid)).fetchone()
-    if already:
-        conn.close()
+    def _submit() -> Optional[Tuple[int, int, float]]:
+        ensure_user(uid, message.from_user.full_name or "No Name")
+        full_name = get_user_name(uid)
+        with DB_POOL.writer() as conn:
+            # anti-cheat
+            already = conn.execute("SELECT 1 FROM submissions WHERE user_id=? AND test_id=?", (uid, tid)).fetchone()
+            if already:
+                return None
+            # grade against the current key (an admin may have fixed it since the test was opened)
+            cur_keys = conn.execute("SELECT keys FROM tests WHERE test_id=?", (tid,)).fetchone()
+            cur_keys = cur_keys["keys"] if cur_keys and cur_keys["keys"] else keys
+            score, total = grade_one(cur_keys, ans), len(cur_keys)
+            pct = (score / total) * 100 if total else 0.0
+            sub = conn.execute("""INSERT INTO submissions(user_id, test_id, answers, submitted_at)
+                                  VALUES (?,?,?,?)""", (uid, tid, ans, now_str()))
+            cur = conn.execute("""INSERT INTO results(user_id, test_id, score, total, percent, date, full_name, submission_id)
+                                  VALUES (?,?,?,?,?,?,?,?)""", (uid, tid, score, total, pct, now_str(), full_name, sub.lastrowid))
+            new = conn.execute("SELECT * FROM results WHERE id=?", (cur.lastrowid,)).fetchall()
+        LEADERBOARD.add(tid, new)
+        return score, total, pct
+
+    graded = await run_db(_submit)
+    if graded is None:
         await message.answer("⚠️ Siz bu testni topshirib bo‘lgansiz.")
         await state.clear()
         return
-
-    score = sum(1 for a, k in zip(ans, keys) if a == k)
-    total = len(keys)
-    pct = (score / total) * 100 if total else 0.0
-
-    conn.execute("""INSERT INTO submissions(user_id, test_id, answers, submitted_at)
-                    VALUES (?,?,?,?)""", (uid, tid, ans, now_str()))
-    conn.execute("""INSERT INTO results(user_id, test_id, score, total, percent, date, full_name)
-                    VALUES (?,?,?,?,?,?,?)""", (uid, tid, score, total, pct, now_str(), full_name))
-    conn.commit()
-    conn.close()
+    score, total, pct = graded
 
     await state.clear()
     await message.answer(
@@ -1354,18 +3001,44 @@ async def u_solve_answers(message: Message, state: FSMContext):
 @router.callback_query(F.data == "u:myresults")
 async def u_myresults(call: CallbackQuery):
     uid = call.from_user.id
-    conn = db()
-    rows = conn.execute("""SELECT test_id, score, total, percent, date
-                           FROM results WHERE user_id=?
-                           ORDER BY id DESC LIMIT 15""", (uid,)).fetchall()
-    conn.close()
+    # rank / percentile / average come from test_score_hist (a handful of rows per test), the group
+    # average from test_group_score; equal percents share a rank
+    rows = await db_fetchall("""
+        SELECT r.test_id, r.score, r.total, r.percent, r.date,
+               SUM(h.n) AS takers,
+               SUM(CASE WHEN h.percent > round(COALESCE(r.percent, 0), 4) THEN h.n ELSE 0 END) AS above,
+               SUM(CASE WHEN h.percent < round(COALESCE(r.percent, 0), 4) THEN h.n ELSE 0 END) AS below,
+               SUM(h.percent * h.n) / SUM(h.n) AS avg
+          FROM (SELECT id, test_id, score, total, percent, date FROM results
+                 WHERE user_id=? ORDER BY id DESC LIMIT 15) r
+          LEFT JOIN test_score_hist h ON h.test_id=r.test_id
+         GROUP BY r.id
+         ORDER BY r.id DESC""", (uid,))
     if not rows:
         await safe_edit(call, "Sizda hali natija yo‘q.", kb_user_home())
         return
+    # group average: the test's totals in the student's group(s) the test is assigned to
+    tids = sorted({r["test_id"] for r in rows})
+    group_avg: dict = {}
+    for g in await db_fetchall(f"""
+        SELECT s.test_id, g.name, s.total / s.n AS avg
+          FROM members me
+          JOIN test_group_score s ON s.group_id=me.group_id
+          JOIN groups g ON g.id=me.group_id
+         WHERE me.user_id=? AND s.test_id IN ({",".join("?" * len(tids))})
+         ORDER BY me.group_id""", (uid, *tids)):
+        group_avg.setdefault(g["test_id"], []).append(f"⌀ {escape_html(g['name'])}: {float(g['avg'] or 0):.1f}%")
 
     text = "📄 <b>Natijalarim</b>\n\n"
     for i, r in enumerate(rows, 1):
         text += f"{i}) <code>{r['test_id']}</code> — <b>{r['score']}/{r['total']}</b> ({r['percent']:.1f}%) | {r['date']}\n"
+        takers = int(r["takers"] or 0)
+        if takers:
+            better = int(r["below"] or 0) * 100 / takers
+            # public test taken outside any of its groups: the average over all takers
+            avg = " · ".join(group_avg.get(r["test_id"], [])) or f"⌀ {float(r['avg'] or 0):.1f}%"
+            text += (f"    🏅 O‘rin: <b>{int(r['above'] or 0) + 1}</b>/{takers}"
+                     f" · 📈 {better:.0f}% dan yaxshi · {avg}\n")
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")]
@@ -1375,17 +3048,19 @@ async def u_myresults(call: CallbackQuery):
 # =========================
 # ADMIN: GROUPS LIST / CREATE / VIEW
 # =========================
-@router.callback_query(F.data == "a:groups")
+@router.callback_query(F.data.regexp(r"^a:groups(:[np]:\d+)?$"))
 async def a_groups(call: CallbackQuery):
     if not await guard(call, "groups"):
         return
-    conn = db()
-    groups = conn.execute("SELECT id, name, invite_code FROM groups ORDER BY id DESC").fetchall()
-    conn.close()
+    cursor, back = parse_page(call.data, "a:groups")
+    groups, has_prev, has_next = await run_db(GROUPS_PAGES.page, (), cursor, back)
 
     kb_rows = []
     for g in groups:
         kb_rows.append([InlineKeyboardButton(text=f"📁 {g['name']}", callback_data=f"a:g:{g['id']}")])
+    nav = kb_page_nav("a:groups", groups, has_prev, has_next)
+    if nav:
+        kb_rows.append(nav)
     kb_rows.append([InlineKeyboardButton(text="➕ Guruh yaratish", callback_data="a:g_add")])
     kb_rows.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
 
@@ -1402,7 +3077,7 @@ async def a_g_add(call: CallbackQuery, state: FSMContext):
 @router.message(AState.g_name)
 async def a_g_add_save(message: Message, state: FSMContext):
     uid = message.from_user.id
-    if not is_admin(uid) or not has_perm(uid, "groups"):
+    if _check_access(uid, "groups"):
         await state.clear()
         return
     name = (message.text or "").strip()
@@ -1410,26 +3085,24 @@ async def a_g_add_save(message: Message, state: FSMContext):
         await message.answer("Guruh nomi qisqa. Qayta kiriting:")
         return
 
-    conn = db()
-    code = None
-    for _ in range(200):
-        cand = gen_group_code()
-        ex = conn.execute("SELECT 1 FROM groups WHERE invite_code=?", (cand,)).fetchone()
-        if not ex:
-            code = cand
-            break
+    def _create() -> Optional[str]:
+        with DB_POOL.writer() as conn:
+            for _ in range(200):
+                cand = gen_group_code()
+                ex = conn.execute("SELECT 1 FROM groups WHERE invite_code=?", (cand,)).fetchone()
+                if not ex:
+                    conn.execute("INSERT INTO groups(name, invite_code) VALUES (?,?)", (name, cand))
+                    return cand
+        return None
+
+    code = await run_db(_create)
     if not code:
-        conn.close()
         await message.answer("Kod yaratib bo‘lmadi.")
         await state.clear()
         return
 
-    conn.execute("INSERT INTO groups(name, invite_code) VALUES (?,?)", (name, code))
-    conn.commit()
-    conn.close()
-
     await state.clear()
-    await message.answer(f"✅ Guruh yaratildi: <b>{safe_pdf_text(name)}</b>\nKod: <code>{code}</code>",
+    await message.answer(f"✅ Guruh yaratildi: <b>{escape_html(name)}</b>\nKod: <code>{code}</code>",
                          reply_markup=kb_admin_home(uid))
 
 @router.callback_query(F.data.startswith("a:g:"))
@@ -1437,10 +3110,8 @@ async def a_group_view(call: CallbackQuery):
     if not await guard(call, "groups"):
         return
     gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT * FROM groups WHERE id=?", (gid,)).fetchone()
-    cnt = conn.execute("SELECT COUNT(*) AS c FROM members WHERE group_id=?", (gid,)).fetchone()
-    conn.close()
+    g = await db_fetchone("SELECT * FROM groups WHERE id=?", (gid,))
+    cnt = await db_fetchone("SELECT COUNT(*) AS c FROM members WHERE group_id=?", (gid,))
     if not g:
         await call.answer("Guruh topilmadi.", show_alert=True)
         return
@@ -1449,7 +3120,8 @@ async def a_group_view(call: CallbackQuery):
         [InlineKeyboardButton(text="👨‍🎓 O‘quvchilar", callback_data=f"a:g_students:{gid}")],
         [InlineKeyboardButton(text="🧪 Guruh testlari", callback_data=f"a:g_tests:{gid}")],
         [InlineKeyboardButton(text="📥 Natija (manual/import)", callback_data=f"a:g_results:{gid}")],
-        [InlineKeyboardButton(text="🗓 Davomat", callback_data=f"a:g_att:{gid}")],
+        [InlineKeyboardButton(text="🗓 Davomat", callback_data=f"a:g_att:{gid}"),
+         InlineKeyboardButton(text="📊 Davomat tahlili", callback_data=f"a:att_an:{gid}")],
         [InlineKeyboardButton(text="📌 Vazifalar", callback_data=f"a:g_tasks:{gid}")],
         [InlineKeyboardButton(text="⚙️ Sozlamalar", callback_data=f"a:g_set:{gid}")],
         [InlineKeyboardButton(text="🔁 Kod yangilash", callback_data=f"a:g_regen:{gid}")],
@@ -1457,7 +3129,7 @@ async def a_group_view(call: CallbackQuery):
         [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
     ])
 
-    text = (f"📁 <b>{safe_pdf_text(g['name'])}</b>\n"
+    text = (f"📁 <b>{escape_html(g['name'])}</b>\n"
             f"🔑 Kod: <code>{g['invite_code']}</code>\n"
             f"👨‍🎓 O‘quvchilar: <b>{int(cnt['c'])}</b>\n"
             f"📌 tg_chat_id: <code>{g['tg_chat_id'] if g['tg_chat_id'] else 'yo‘q'}</code>\n"
@@ -1470,21 +3142,20 @@ async def a_group_regen(call: CallbackQuery):
     if not await guard(call, "groups"):
         return
     gid = int(call.data.split(":")[2])
-    conn = db()
-    code = None
-    for _ in range(200):
-        cand = gen_group_code()
-        ex = conn.execute("SELECT 1 FROM groups WHERE invite_code=?", (cand,)).fetchone()
-        if not ex:
-            code = cand
-            break
-    if not code:
-        conn.close()
+
+    def _regen() -> Optional[str]:
+        with DB_POOL.writer() as conn:
+            for _ in range(200):
+                cand = gen_group_code()
+                ex = conn.execute("SELECT 1 FROM groups WHERE invite_code=?", (cand,)).fetchone()
+                if not ex:
+                    conn.execute("UPDATE groups SET invite_code=? WHERE id=?", (cand, gid))
+                    return cand
+        return None
+
+    if not await run_db(_regen):
         await call.answer("Kod yaratib bo‘lmadi.", show_alert=True)
         return
-    conn.execute("UPDATE groups SET invite_code=? WHERE id=?", (code, gid))
-    conn.commit()
-    conn.close()
     await call.answer("✅ Kod yangilandi", show_alert=True)
     # refresh view
     await a_group_view(call)
@@ -1496,24 +3167,22 @@ async def a_g_students(call: CallbackQuery):
     if not await guard(call, "groups"):
         return
     gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT name, tg_chat_id FROM groups WHERE id=?", (gid,)).fetchone()
-    students = conn.execute("""
-        SELECT u.user_id, u.full_name
-        FROM members m JOIN users u ON u.user_id=m.user_id
-        WHERE m.group_id=?
-        ORDER BY u.full_name
-    """, (gid,)).fetchall()
-    conn.close()
+    prefix = f"a:g_students:{gid}"
+    cursor, back = parse_page(call.data, prefix)
+    g = await db_fetchone("SELECT name, tg_chat_id FROM groups WHERE id=?", (gid,))
+    students, has_prev, has_next = await run_db(STUDENTS_PAGES.page, (gid,), cursor, back)
     if not g:
         await call.answer("Guruh topilmadi.", show_alert=True)
         return
 
-    text = f"👨‍🎓 <b>{safe_pdf_text(g['name'])}</b> — O‘quvchilar\n\n"
+    text = f"👨‍🎓 <b>{escape_html(g['name'])}</b> — O‘quvchilar\n\n"
     kb_rows = []
-    for i, s in enumerate(students, 1):
-        text += f"{i}. {safe_pdf_text(s['full_name'])}\n"
-        kb_rows.append([InlineKeyboardButton(text=f"❌ {s['full_name'][:18]}", callback_data=f"a:g_kick:{gid}:{s['user_id']}")])
+    for s in students:
+        text += f"• {escape_html(s['full_name'])}\n"
+        kb_rows.append([InlineKeyboardButton(text=f"❌ {(s['full_name'] or '')[:18]}", callback_data=f"a:g_kick:{gid}:{s['user_id']}")])
+    nav = kb_page_nav(prefix, students, has_prev, has_next)
+    if nav:
+        kb_rows.append(nav)
     kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
 
     await safe_edit(call, text, InlineKeyboardMarkup(inline_keyboard=kb_rows))
@@ -1525,19 +3194,16 @@ async def a_g_kick(call: CallbackQuery):
     _, _, gid, uid = call.data.split(":")
     gid = int(gid); uid = int(uid)
 
-    conn = db()
-    g = conn.execute("SELECT tg_chat_id FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.execute("DELETE FROM members WHERE group_id=? AND user_id=?", (gid, uid))
-    conn.commit()
-    conn.close()
+    def _kick():
+        with DB_POOL.writer() as conn:
+            g = conn.execute("SELECT tg_chat_id FROM groups WHERE id=?", (gid,)).fetchone()
+            conn.execute("DELETE FROM members WHERE group_id=? AND user_id=?", (gid, uid))
+            # kick from telegram group if chat_id set; keyed by the callback so a redelivered tap kicks once
+            if g and g["tg_chat_id"]:
+                outbox_put(conn, "kick", int(g["tg_chat_id"]), key=f"manual_kick:{gid}:{uid}:{call.id}", user_id=uid)
 
-    # kick from telegram group if chat_id set
-    if g and g["tg_chat_id"]:
-        try:
-            await call.bot.ban_chat_member(chat_id=int(g["tg_chat_id"]), user_id=uid)
-            await call.bot.unban_chat_member(chat_id=int(g["tg_chat_id"]), user_id=uid)
-        except:
-            pass
+    await run_db(_kick)
+    OUTBOX.wake()
 
     await call.answer("Chiqarildi", show_alert=True)
     await a_g_students(call)
@@ -1550,9 +3216,7 @@ async def a_g_set(call: CallbackQuery):
     if not await guard(call, "groups"):
         return
     gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT * FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
+    g = await db_fetchone("SELECT * FROM groups WHERE id=?", (gid,))
     if not g:
         await call.answer("Guruh topilmadi.", show_alert=True)
         return
@@ -1564,7 +3228,7 @@ async def a_g_set(call: CallbackQuery):
         [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}")],
         [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
     ])
-    text = (f"⚙️ <b>Sozlamalar</b>\nGuruh: <b>{safe_pdf_text(g['name'])}</b>\n\n"
+    text = (f"⚙️ <b>Sozlamalar</b>\nGuruh: <b>{escape_html(g['name'])}</b>\n\n"
             f"tg_chat_id: <code>{g['tg_chat_id'] if g['tg_chat_id'] else 'yo‘q'}</code>\n"
             f"Absent kick limit: <b>{g['att_absent_limit']}</b>\n"
             f"Task miss kick limit: <b>{g['task_miss_limit']}</b>\n\n"
@@ -1584,7 +3248,7 @@ async def a_gs_chat(call: CallbackQuery, state: FSMContext):
 
 @router.message(AState.gs_chatid)
 async def a_gs_chat_save(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "groups"):
+    if _check_access(message.from_user.id, "groups"):
         await state.clear()
         return
     data = await state.get_data()
@@ -1594,10 +3258,7 @@ async def a_gs_chat_save(message: Message, state: FSMContext):
     if chat_id is None:
         await message.answer("❌ Raqam bo‘lishi kerak. Masalan: -1001234567890")
         return
-    conn = db()
-    conn.execute("UPDATE groups SET tg_chat_id=? WHERE id=?", (chat_id, gid))
-    conn.commit()
-    conn.close()
+    await db_write("UPDATE groups SET tg_chat_id=? WHERE id=?", (chat_id, gid))
     await state.clear()
     await message.answer("✅ Saqlandi", reply_markup=kb_admin_home(message.from_user.id))
 
@@ -1613,7 +3274,7 @@ async def a_gs_att(call: CallbackQuery, state: FSMContext):
 
 @router.message(AState.gs_att_limit)
 async def a_gs_att_save(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "groups"):
+    if _check_access(message.from_user.id, "groups"):
         await state.clear()
         return
     data = await state.get_data()
@@ -1622,10 +3283,7 @@ async def a_gs_att_save(message: Message, state: FSMContext):
     if lim is None or lim < 1:
         await message.answer("❌ 1 dan katta raqam kiriting.")
         return
-    conn = db()
-    conn.execute("UPDATE groups SET att_absent_limit=? WHERE id=?", (lim, gid))
-    conn.commit()
-    conn.close()
+    await db_write("UPDATE groups SET att_absent_limit=? WHERE id=?", (lim, gid))
     await state.clear()
     await message.answer("✅ Saqlandi", reply_markup=kb_admin_home(message.from_user.id))
 
@@ -1641,7 +3299,7 @@ async def a_gs_task(call: CallbackQuery, state: FSMContext):
 
 @router.message(AState.gs_task_limit)
 async def a_gs_task_save(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "groups"):
+    if _check_access(message.from_user.id, "groups"):
         await state.clear()
         return
     data = await state.get_data()
@@ -1650,10 +3308,7 @@ async def a_gs_task_save(message: Message, state: FSMContext):
     if lim is None or lim < 1:
         await message.answer("❌ 1 dan katta raqam kiriting.")
         return
-    conn = db()
-    conn.execute("UPDATE groups SET task_miss_limit=? WHERE id=?", (lim, gid))
-    conn.commit()
-    conn.close()
+    await db_write("UPDATE groups SET task_miss_limit=? WHERE id=?", (lim, gid))
     await state.clear()
     await message.answer("✅ Saqlandi", reply_markup=kb_admin_home(message.from_user.id))
 
@@ -1678,6 +3333,148 @@ def group_students(gid: int) -> List[Tuple[int, str]]:
     conn.close()
     return [(int(r["user_id"]), r["full_name"]) for r in rows]
 
+class AttendanceSheet:
+    """Marks of one (group, date) while admins tap through it: `absent` is the live state, `saved` what is in the DB."""
+
+    def __init__(self, gid: int, date_s: str, group_name: str, students: List[Tuple[int, str]], saved: set):
+        self.gid, self.date, self.group_name, self.students = gid, date_s, group_name, students
+        self.ids = {uid for uid, _ in students}
+        self.saved = set(saved)
+        self.absent = set(saved)
+        self.touched = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    @property
+    def dirty(self) -> bool:
+        return self.absent != self.saved
+
+
+class AttendanceSheets:
+    """
+    Open attendance sheets per (group, date). A tap flips a mark in memory and re-renders from it;
+    the sheet is written to `attendance` in one transaction (executemany of the difference) on Save /
+    report / DM / PDF (finalize_attendance_day), or by loop_att_flush() once idle for ATT_FLUSH_IDLE s.
+    Anything that reads `attendance` for a date being edited must flush(gid, date) (or flush_all()) first.
+    """
+
+    def __init__(self, idle: int):
+        self.idle = idle
+        self._sheets: dict = {}
+        self._locks: dict = {}  # (gid, date) -> asyncio.Lock held by open() / toggle()
+        self.flushes = 0
+        self.rows_written = 0
+
+    @staticmethod
+    def _load(gid: int, date_s: str) -> Optional[AttendanceSheet]:
+        with db() as conn:
+            g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
+            if not g:
+                return None
+            studs = conn.execute("""
+                SELECT u.user_id, u.full_name
+                FROM members m JOIN users u ON u.user_id=m.user_id
+                WHERE m.group_id=?
+                ORDER BY u.full_name
+            """, (gid,)).fetchall()
+            absent = conn.execute("SELECT user_id FROM attendance WHERE group_id=? AND att_date=? AND status='absent'",
+                                  (gid, date_s)).fetchall()
+        return AttendanceSheet(gid, date_s, g["name"], [(int(r["user_id"]), r["full_name"]) for r in studs],
+                               {int(r["user_id"]) for r in absent})
+
+    def _lock(self, key: tuple) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    async def open(self, gid: int, date_s: str, *, fresh: bool = False) -> Optional[AttendanceSheet]:
+        """The sheet of (gid, date); `fresh` writes pending marks and reloads students/marks from the DB."""
+        # a tap waits for a reopen in progress instead of landing on the sheet being replaced
+        async with self._lock((gid, date_s)):
+            return await self._open(gid, date_s, fresh)
+
+    async def _open(self, gid: int, date_s: str, fresh: bool) -> Optional[AttendanceSheet]:
+        key = (gid, date_s)
+        sh = self._sheets.get(key)
+        if sh is not None and not fresh:
+            sh.touched = time.monotonic()
+            return sh
+        if sh is not None:
+            await self._flush(sh)
+        sh = await run_db(self._load, gid, date_s)
+        if sh is None:
+            self._sheets.pop(key, None)
+            return None
+        self._sheets[key] = sh
+        return sh
+
+    async def toggle(self, gid: int, date_s: str, uid: int) -> Optional[AttendanceSheet]:
+        async with self._lock((gid, date_s)):
+            sh = await self._open(gid, date_s, False)
+            if sh is not None and uid in sh.ids:
+                sh.absent ^= {uid}
+            return sh
+
+    async def _flush(self, sh: AttendanceSheet) -> None:
+        async with sh.lock:
+            if not sh.dirty:
+                return
+            absent = set(sh.absent)
+            add, remove = absent - sh.saved, sh.saved - absent
+
+            def _write():
+                with DB_POOL.writer() as conn:
+                    conn.executemany("INSERT OR REPLACE INTO attendance(group_id, user_id, att_date, status) VALUES (?,?,?,'absent')",
+                                     [(sh.gid, uid, sh.date) for uid in add])
+                    conn.executemany("DELETE FROM attendance WHERE group_id=? AND user_id=? AND att_date=?",
+                                     [(sh.gid, uid, sh.date) for uid in remove])
+
+            await run_db(_write)
+            sh.saved = absent
+            self.flushes += 1
+            self.rows_written += len(add) + len(remove)
+
+    async def flush(self, gid: int, date_s: str) -> None:
+        sh = self._sheets.get((gid, date_s))
+        if sh is not None:
+            await self._flush(sh)
+
+    async def flush_all(self) -> None:
+        for sh in list(self._sheets.values()):
+            await self._flush(sh)
+
+    async def flush_idle(self) -> None:
+        """Write and close sheets nobody touched for `idle` seconds."""
+        now = time.monotonic()
+        for key, sh in list(self._sheets.items()):
+            if now - sh.touched >= self.idle:
+                await self._flush(sh)
+                if self._sheets.get(key) is sh and time.monotonic() - sh.touched >= self.idle:
+                    del self._sheets[key]
+                    lock = self._locks.get(key)
+                    if lock is not None and not lock.locked():
+                        del self._locks[key]
+
+    def reset(self) -> None:
+        """Forget every open sheet without writing it (the DB underneath was replaced)."""
+        self._sheets.clear()
+
+    def stats(self) -> dict:
+        return {"open": len(self._sheets), "dirty": sum(1 for sh in self._sheets.values() if sh.dirty),
+                "flushes": self.flushes, "rows_written": self.rows_written, "idle_flush_s": self.idle}
+
+
+ATT_SHEETS = AttendanceSheets(ATT_FLUSH_IDLE)
+
+
+async def loop_att_flush():
+    while True:
+        await asyncio.sleep(max(5, ATT_FLUSH_IDLE // 2))
+        try:
+            await ATT_SHEETS.flush_idle()
+        except Exception:
+            logging.exception("Attendance sheet flush failed")
+
 @router.callback_query(F.data.startswith("a:g_att:"))
 async def a_g_att_menu(call: CallbackQuery):
     if not await guard(call, "attendance"):
@@ -1685,28 +3482,22 @@ async def a_g_att_menu(call: CallbackQuery):
     parts = call.data.split(":")
     gid = int(parts[2])
     d = parts[3] if len(parts) > 3 else today_str()
-    await _render_attendance_screen(call, gid, d)
+    await _render_attendance_screen(call, await ATT_SHEETS.open(gid, d, fresh=True))
 
 
-async def _render_attendance_screen(call: CallbackQuery, gid: int, d: str):
-    """Render attendance UI for group/date. Do NOT mutate call.data (CallbackQuery is frozen in aiogram v3)."""
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
-    if not g:
+async def _render_attendance_screen(call: CallbackQuery, sheet: Optional[AttendanceSheet]):
+    """Render attendance UI from the in-memory sheet. Do NOT mutate call.data (CallbackQuery is frozen in aiogram v3)."""
+    if sheet is None:
         await call.answer("Guruh topilmadi.", show_alert=True)
         return
-
-    studs = group_students(gid)
-    amap = attendance_map(gid, d)
+    gid, d = sheet.gid, sheet.date
 
     # UI: Only mark absent with ❌; default present
     kb_rows = []
-    for uid, name in studs:
-        st = amap.get(uid, "present")
-        icon = "❌" if st == "absent" else "✅"
+    for uid, name in sheet.students:
+        icon = "❌" if uid in sheet.absent else "✅"
         kb_rows.append([InlineKeyboardButton(
-            text=f"{icon} {name[:22]}",
+            text=f"{icon} {(name or '')[:22]}",
             callback_data=f"a:att_t:{gid}:{uid}:{d}"
         )])
 
@@ -1714,10 +3505,11 @@ async def _render_attendance_screen(call: CallbackQuery, gid: int, d: str):
     kb_rows.append([InlineKeyboardButton(text="📨 Yo‘qlarga DM yuborish", callback_data=f"a:att_send:{gid}:{d}")])
     kb_rows.append([InlineKeyboardButton(text="📄 Hisobot (text)", callback_data=f"a:att_rep:{gid}:{d}")])
     kb_rows.append([InlineKeyboardButton(text="📥 Hisobot (PDF)", callback_data=f"a:att_pdf:{gid}:{d}")])
-    kb_rows.append([InlineKeyboardButton(text="🗂 Arxiv", callback_data=f"a:att_arc:{gid}")])
+    kb_rows.append([InlineKeyboardButton(text="🗂 Arxiv", callback_data=f"a:att_arc:{gid}"),
+                    InlineKeyboardButton(text="📊 Tahlil", callback_data=f"a:att_an:{gid}")])
     kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
 
-    await safe_edit(call, f"🗓 <b>Davomat</b>\nGuruh: <b>{safe_pdf_text(g['name'])}</b>\nSana: <code>{d}</code>\n\n"
+    await safe_edit(call, f"🗓 <b>Davomat</b>\nGuruh: <b>{escape_html(sheet.group_name)}</b>\nSana: <code>{d}</code>\n\n"
                           f"Faqat qatnashmaganlarni ❌ qilib belgilang.", InlineKeyboardMarkup(inline_keyboard=kb_rows))
 
 
@@ -1733,34 +3525,15 @@ async def a_att_open(call: CallbackQuery):
     gid = int(parts[2])
     d = parts[3]
     # Open the same attendance screen for archived date
-    await _render_attendance_screen(call, gid, d)
+    await _render_attendance_screen(call, await ATT_SHEETS.open(gid, d, fresh=True))
 
 @router.callback_query(F.data.startswith("a:att_t:"))
 async def a_att_toggle(call: CallbackQuery):
     if not await guard(call, "attendance"):
         return
     _, _, gid, uid, d = call.data.split(":")
-    gid = int(gid); uid = int(uid)
-
-    conn = db()
-    cur = conn.execute("""
-        SELECT status FROM attendance WHERE group_id=? AND user_id=? AND att_date=?
-    """, (gid, uid, d)).fetchone()
-
-    if not cur:
-        # mark absent
-        conn.execute("""INSERT OR REPLACE INTO attendance(group_id, user_id, att_date, status)
-                        VALUES (?,?,?,'absent')""", (gid, uid, d))
-    else:
-        # if absent -> remove row (back to present)
-        if cur["status"] == "absent":
-            conn.execute("DELETE FROM attendance WHERE group_id=? AND user_id=? AND att_date=?", (gid, uid, d))
-        else:
-            conn.execute("UPDATE attendance SET status='absent' WHERE group_id=? AND user_id=? AND att_date=?", (gid, uid, d))
-    conn.commit()
-    conn.close()
-
-    await a_g_att_menu(call)
+    # in memory only: written on Save/report/DM/PDF or after ATT_FLUSH_IDLE seconds without taps
+    await _render_attendance_screen(call, await ATT_SHEETS.toggle(int(gid), d, int(uid)))
 
 @router.callback_query(F.data.startswith("a:att_rep:"))
 async def a_att_report_text(call: CallbackQuery):
@@ -1773,20 +3546,18 @@ async def a_att_report_text(call: CallbackQuery):
     await finalize_attendance_day(call.bot, gid, d, saved_by=call.from_user.id, send_dm=False)
 
 
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
+    g = await db_fetchone("SELECT name FROM groups WHERE id=?", (gid,))
     if not g:
         await call.answer("Guruh topilmadi.", show_alert=True)
         return
 
-    studs = group_students(gid)
-    amap = attendance_map(gid, d)
+    studs = await run_db(group_students, gid)
+    amap = await run_db(attendance_map, gid, d)
     absent = [(uid, nm) for uid, nm in studs if amap.get(uid, "present") == "absent"]
     present = len(studs) - len(absent)
 
     text = (f"📄 <b>Davomat hisoboti</b>\n"
-            f"Guruh: <b>{safe_pdf_text(g['name'])}</b>\n"
+            f"Guruh: <b>{escape_html(g['name'])}</b>\n"
             f"Sana: <code>{d}</code>\n\n"
             f"Jami: <b>{len(studs)}</b>\n"
             f"✅ Qatnashdi: <b>{present}</b>\n"
@@ -1795,7 +3566,7 @@ async def a_att_report_text(call: CallbackQuery):
     if absent:
         text += "❌ <b>QATNASHMAGANLAR:</b>\n"
         for i, (_uid, nm) in enumerate(absent, 1):
-            text += f"{i}. {safe_pdf_text(nm)}\n"
+            text += f"{i}. {escape_html(nm)}\n"
     else:
         text += "✅ Bugun hamma qatnashgan."
 
@@ -1817,103 +3588,108 @@ async def a_att_pdf(call: CallbackQuery):
     await finalize_attendance_day(call.bot, gid, d, saved_by=call.from_user.id, send_dm=False)
 
 
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
+    g = await db_fetchone("SELECT name FROM groups WHERE id=?", (gid,))
     if not g:
         await call.answer("Guruh topilmadi.", show_alert=True)
         return
 
-    studs = group_students(gid)
-    amap = attendance_map(gid, d)
-    rows = [(nm, "absent" if amap.get(uid, "present") == "absent" else "present") for uid, nm in studs]
-
-    fname = f"attendance_G{gid}_{d}.pdf"
-    pdf_attendance(fname, g["name"], d, rows)
-    try:
-        await call.message.answer_document(FSInputFile(fname))
-    finally:
-        try:
-            os.remove(fname)
-        except:
-            pass
+    sent = await REPORTS.send(call.message, "attendance", f"{gid}:{d}",
+                              [("att", f"{gid}:{d}"), ("group", gid), ("names", "*")],
+                              f"attendance_G{gid}_{d}.pdf", pdf_attendance, gid, g["name"], d)
+    if not sent:
+        await call.answer("Guruhda o‘quvchi yo‘q.", show_alert=True)
 
 
 
 # ---------------- Attendance finalize / archive / auto-kick ----------------
-async def finalize_attendance_day(bot: Bot, gid: int, att_date: str, saved_by: int, *, send_dm: bool = False) -> dict:
-    """Finalize attendance day: record day into attendance_days (once), increment absent counters once, and auto-kick if limit reached.
-    If send_dm=True, DM absent users with their current counter (does not re-increment if already finalized)."""
-    conn = db()
-    g = conn.execute("SELECT id, name, tg_chat_id, att_absent_limit FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
-    if not g:
-        return {"ok": False, "error": "group_not_found"}
-
-    studs = group_students(gid)
-    amap = attendance_map(gid, att_date)
-    absent = [(uid, nm) for uid, nm in studs if amap.get(uid, "present") == "absent"]
-
-    conn = db()
-    cur = conn.execute(
-        "INSERT OR IGNORE INTO attendance_days(group_id, att_date, saved_at, saved_by) VALUES (?,?,?,?)",
-        (gid, att_date, now_str(), int(saved_by)),
-    )
-    conn.commit()
-    inserted = (cur.rowcount == 1)
-    conn.close()
-
-    sent = 0
-    kicked = 0
-
-    limit = int(g["att_absent_limit"] or 0)
-    if limit <= 0:
-        limit = 999999
-
-    for uid, nm in absent:
-        conn = db()
-        conn.execute("INSERT OR IGNORE INTO counters(group_id, user_id, absent_count, missed_task_count) VALUES (?,?,0,0)", (gid, uid))
-        if inserted:
-            conn.execute("UPDATE counters SET absent_count = absent_count + 1 WHERE group_id=? AND user_id=?", (gid, uid))
-        row = conn.execute("SELECT absent_count FROM counters WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-        conn.commit()
-        conn.close()
-
-        cnt_abs = int(row["absent_count"]) if row else 0
-
+def _finalize_day(gid: int, att_date: str, saved_by: int, send_dm: bool) -> Optional[dict]:
+    """
+    DB part of finalize_attendance_day, one writer transaction (concurrent Saves of a day serialize on it,
+    and only the one that inserts the attendance_days row counts the absences):
+    attendance_days row -> absent counters upserted with RETURNING -> members at the limit removed
+    (DELETE ... RETURNING) -> archive snapshot -> DMs / kicks queued in the outbox. None if the group does not exist.
+    """
+    with DB_POOL.writer() as conn:
+        g = conn.execute("SELECT id, name, tg_chat_id, att_absent_limit FROM groups WHERE id=?", (gid,)).fetchone()
+        if not g:
+            return None
+        studs = [(int(r["user_id"]), r["full_name"]) for r in conn.execute("""
+            SELECT u.user_id, u.full_name
+            FROM members m JOIN users u ON u.user_id=m.user_id
+            WHERE m.group_id=?
+            ORDER BY u.full_name
+        """, (gid,))]
+        marked = {int(r["user_id"]) for r in conn.execute(
+            "SELECT user_id FROM attendance WHERE group_id=? AND att_date=? AND status='absent'", (gid, att_date))}
+        absent = [uid for uid, _nm in studs if uid in marked]
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO attendance_days(group_id, att_date, saved_at, saved_by) VALUES (?,?,?,?)",
+            (gid, att_date, now_str(), saved_by),
+        ).rowcount == 1
+
+        limit = int(g["att_absent_limit"] or 0)
+        if limit <= 0:
+            limit = 999999
+
+        counts, kicked, unreachable = {}, [], set()
+        if absent:
+            q = ",".join("?" * len(absent))
+            if inserted:
+                counts = {int(r[0]): int(r[1]) for r in conn.execute(f"""
+                    INSERT INTO counters(group_id, user_id, absent_count, missed_task_count)
+                    SELECT ?, user_id, 1, 0 FROM members WHERE group_id=? AND user_id IN ({q})
+                    ON CONFLICT(group_id, user_id) DO UPDATE SET absent_count = absent_count + 1
+                    RETURNING user_id, absent_count
+                """, (gid, gid, *absent)).fetchall()}
+                over = [uid for uid in absent if counts.get(uid, 0) >= limit]
+                if over:
+                    kicked = [int(r[0]) for r in conn.execute(
+                        f"DELETE FROM members WHERE group_id=? AND user_id IN ({','.join('?' * len(over))}) RETURNING user_id",
+                        (gid, *over)).fetchall()]
+            else:
+                # already finalized: counters stay as they are, just read them for the DMs
+                counts = {int(r[0]): int(r[1]) for r in conn.execute(
+                    f"SELECT user_id, absent_count FROM counters WHERE group_id=? AND user_id IN ({q})", (gid, *absent))}
+            unreachable = {int(r[0]) for r in conn.execute(
+                f"SELECT user_id FROM users WHERE reachable=0 AND user_id IN ({q})", absent)}
+
+        # per-student snapshot of the day for the analytics screens (re-saves only write changed marks)
+        archive_attendance_day(conn, gid, att_date, studs, set(absent))
+
+        # one absence DM per student and day, however many times Send is pressed
+        job = f"att:{gid}:{att_date}"
+        queued = 0
         if send_dm:
-            try:
-                await bot.send_message(
-                    uid,
+            for uid in absent:
+                if uid in unreachable:
+                    continue
+                queued += outbox_put(conn, "message", uid, key=f"att:{gid}:{att_date}:{uid}", job=job, text=(
                     f"🗓 <b>Davomat ogohlantirish</b>\n"
-                    f"Guruh: <b>{safe_pdf_text(g['name'])}</b>\n"
+                    f"Guruh: <b>{escape_html(g['name'])}</b>\n"
                     f"Sana: <code>{att_date}</code>\n\n"
                     f"Siz bugun darsga qatnashmadingiz ❌\n"
-                    f"Sababsiz qoldirish: <b>{cnt_abs}/{limit}</b>",
-                )
-                sent += 1
-            except Exception:
-                pass
+                    f"Sababsiz qoldirish: <b>{counts.get(uid, 0)}/{limit}</b>"
+                ))
+        for uid in kicked:
+            if g["tg_chat_id"]:
+                outbox_put(conn, "kick", int(g["tg_chat_id"]), key=f"att_kick:{gid}:{att_date}:{uid}", job=job, user_id=uid)
+            if uid not in unreachable:
+                outbox_put(conn, "message", uid, key=f"att_kicked:{gid}:{att_date}:{uid}", job=job,
+                           text=f"⛔️ Siz <b>{escape_html(g['name'])}</b> guruhidan chiqarildingiz (davomat limitiga yetdi).")
 
-        if inserted and cnt_abs >= limit:
-            conn = db()
-            conn.execute("DELETE FROM members WHERE group_id=? AND user_id=?", (gid, uid))
-            conn.commit()
-            conn.close()
+    return {"ok": True, "inserted": inserted, "absent": len(absent), "queued": queued, "kicked": len(kicked)}
 
-            if g["tg_chat_id"]:
-                try:
-                    await bot.ban_chat_member(chat_id=int(g["tg_chat_id"]), user_id=uid)
-                    await bot.unban_chat_member(chat_id=int(g["tg_chat_id"]), user_id=uid)
-                except Exception:
-                    pass
-            try:
-                await bot.send_message(uid, f"⛔️ Siz <b>{safe_pdf_text(g['name'])}</b> guruhidan chiqarildingiz (davomat limitiga yetdi).")
-            except Exception:
-                pass
-            kicked += 1
 
-    return {"ok": True, "inserted": inserted, "absent": len(absent), "sent": sent, "kicked": kicked}
+async def finalize_attendance_day(bot: Bot, gid: int, att_date: str, saved_by: int, *, send_dm: bool = False) -> dict:
+    """Finalize attendance day: record day into attendance_days (once), increment absent counters once, and auto-kick if limit reached.
+    If send_dm=True, DM absent users with their current counter (does not re-increment if already finalized).
+    DMs and kicks go through the outbox; this returns as soon as the DB transaction is committed."""
+    await ATT_SHEETS.flush(gid, att_date)
+    res = await run_db(_finalize_day, gid, att_date, int(saved_by), send_dm)
+    if res is None:
+        return {"ok": False, "error": "group_not_found"}
+    OUTBOX.wake()
+    return res
 
 @router.callback_query(F.data.startswith("a:att_send:"))
 async def a_att_send(call: CallbackQuery):
@@ -1927,7 +3703,7 @@ async def a_att_send(call: CallbackQuery):
         await call.answer("Xatolik.", show_alert=True)
         return
 
-    msg = f"✅ Yuborildi: {res['sent']} ta\n📌 Yo‘qlar: {res['absent']} ta"
+    msg = f"📨 Navbatga qo‘yildi: {res['queued']} ta\n📌 Yo‘qlar: {res['absent']} ta"
     msg += "\n🗂 Arxivga saqlandi." if res.get("inserted") else "\nℹ️ Bu sana avval saqlangan."
     if res.get("kicked"):
         msg += f"\n⛔️ Kick: {res['kicked']}"
@@ -1955,20 +3731,23 @@ async def a_att_archive(call: CallbackQuery):
     if not await guard(call, "attendance"):
         return
     gid = int(call.data.split(":")[2])
-    conn = db()
-    ensure_attendance_schema(conn)
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    
-    try:
-        dates = conn.execute("SELECT att_date FROM attendance_days WHERE group_id=? ORDER BY att_date DESC LIMIT 60", (gid,)).fetchall()
-    except Exception as e:
-        if "attendance_days" in str(e):
+
+    def _load():
+        with db() as conn:
             ensure_attendance_schema(conn)
-            dates = conn.execute("SELECT att_date FROM attendance_days WHERE group_id=? ORDER BY att_date DESC LIMIT 60", (gid,)).fetchall()
-        else:
-            raise
+            g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
 
-    conn.close()
+            try:
+                dates = conn.execute("SELECT att_date FROM attendance_days WHERE group_id=? ORDER BY att_date DESC LIMIT 60", (gid,)).fetchall()
+            except Exception as e:
+                if "attendance_days" in str(e):
+                    ensure_attendance_schema(conn)
+                    dates = conn.execute("SELECT att_date FROM attendance_days WHERE group_id=? ORDER BY att_date DESC LIMIT 60", (gid,)).fetchall()
+                else:
+                    raise
+            return g, dates
+
+    g, dates = await run_db(_load)
 
     if not g:
         await call.answer("Guruh topilmadi.", show_alert=True)
@@ -1985,22 +3764,177 @@ async def a_att_archive(call: CallbackQuery):
     rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g_att:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
 
     await safe_edit(call,
-                    f"🗂 <b>Davomat arxivi</b>\nGuruh: <b>{safe_pdf_text(g['name'])}</b>\n\nSaqlangan sanalar:",
+                    f"🗂 <b>Davomat arxivi</b>\nGuruh: <b>{escape_html(g['name'])}</b>\n\nSaqlangan sanalar:",
                     InlineKeyboardMarkup(inline_keyboard=rows))
 
-@router.callback_query(F.data == "a:tests")
-async def a_tests(call: CallbackQuery):
-    if not await guard(call, "tests"):
-        return
-    conn = db()
-    rows = conn.execute("SELECT test_id, status, deadline FROM tests ORDER BY created_at DESC LIMIT 30").fetchall()
-    conn.close()
+
+# ---------------- Attendance analytics (attendance_archive -> att_monthly / att_streaks) ----------------
+ATT_RISK_MARGIN = 2  # "at risk": absent_count within this many absences of the group's att_absent_limit
+
+
+def archive_attendance_day(conn: sqlite3.Connection, gid: int, att_date: str, students: List[Tuple[int, str]], absent: set) -> int:
+    """
+    Snapshot a finalized day into attendance_archive (one row per student) and bring att_streaks up to date,
+    inside the caller's write transaction; att_monthly follows through the archive triggers. Re-saving a day
+    only touches rows whose status changed. Returns the number of archive rows written.
+    """
+    now = now_str()
+    prev = {int(r["user_id"]): r["status"] for r in conn.execute(
+        "SELECT user_id, status FROM attendance_archive WHERE group_id=? AND att_date=?", (gid, att_date))}
+    rows = [(gid, uid, att_date, "absent" if uid in absent else "present", now)
+            for uid, _nm in students if prev.get(uid) != ("absent" if uid in absent else "present")]
+    if not rows:
+        return 0
+    conn.executemany("""INSERT INTO attendance_archive(group_id, user_id, att_date, status, created_at) VALUES (?,?,?,?,?)
+                        ON CONFLICT(group_id, user_id, att_date) DO UPDATE SET status=excluded.status""", rows)
+    for _g, uid, _d, st, _now in rows:
+        s = conn.execute("SELECT last_date, cur_absent, max_absent FROM att_streaks WHERE group_id=? AND user_id=?",
+                         (gid, uid)).fetchone()
+        if s is None or att_date > (s["last_date"] or ""):
+            # the usual case: days are saved in order
+            cur = (int(s["cur_absent"]) if s else 0) + 1 if st == "absent" else 0
+            best = max(int(s["max_absent"]) if s else 0, cur)
+            last = att_date
+        else:
+            # a past day was changed: recount this student's runs
+            hist = conn.execute("SELECT att_date, status FROM attendance_archive WHERE group_id=? AND user_id=? ORDER BY att_date",
+                                (gid, uid)).fetchall()
+            cur, best = _att_streak(r["status"] for r in hist)
+            last = hist[-1]["att_date"]
+        conn.execute("INSERT OR REPLACE INTO att_streaks(group_id, user_id, last_date, cur_absent, max_absent) VALUES (?,?,?,?,?)",
+                     (gid, uid, last, cur, best))
+    return len(rows)
+
+
+def att_group_analytics(gid: int, months: int = 6) -> Optional[dict]:
+    """Group attendance overview from the aggregates: monthly rates, at-risk students, current absence streaks."""
+    with db() as conn:
+        g = conn.execute("SELECT name, att_absent_limit FROM groups WHERE id=?", (gid,)).fetchone()
+        if not g:
+            return None
+        limit = int(g["att_absent_limit"] or 0)
+        days = conn.execute("SELECT COUNT(*) FROM attendance_days WHERE group_id=?", (gid,)).fetchone()[0]
+        monthly = conn.execute("""SELECT month, SUM(days) AS days, SUM(absent) AS absent FROM att_monthly
+                                  WHERE group_id=? GROUP BY month ORDER BY month DESC LIMIT ?""", (gid, months)).fetchall()
+        at_risk = conn.execute("""
+            SELECT u.user_id, u.full_name, c.absent_count, COALESCE(s.cur_absent, 0) AS cur_absent
+            FROM members m
+            JOIN users u ON u.user_id=m.user_id
+            JOIN counters c ON c.group_id=m.group_id AND c.user_id=m.user_id
+            LEFT JOIN att_streaks s ON s.group_id=m.group_id AND s.user_id=m.user_id
+            WHERE m.group_id=? AND c.absent_count > 0 AND c.absent_count >= ?
+            ORDER BY c.absent_count DESC, u.full_name LIMIT 15
+        """, (gid, max(1, limit - ATT_RISK_MARGIN) if limit > 0 else 1 << 30)).fetchall()
+        streaks = conn.execute("""
+            SELECT u.user_id, u.full_name, s.cur_absent, s.max_absent
+            FROM att_streaks s
+            JOIN members m ON m.group_id=s.group_id AND m.user_id=s.user_id
+            JOIN users u ON u.user_id=s.user_id
+            WHERE s.group_id=? AND s.cur_absent >= 2
+            ORDER BY s.cur_absent DESC, u.full_name LIMIT 10
+        """, (gid,)).fetchall()
+    return {"name": g["name"], "limit": limit, "days": days, "monthly": list(reversed(monthly)),
+            "at_risk": at_risk, "streaks": streaks}
+
+
+def att_student_analytics(gid: int, uid: int, months: int = 12) -> Optional[dict]:
+    with db() as conn:
+        g = conn.execute("SELECT name, att_absent_limit FROM groups WHERE id=?", (gid,)).fetchone()
+        if not g:
+            return None
+        name = conn.execute("SELECT full_name FROM users WHERE user_id=?", (uid,)).fetchone()
+        c = conn.execute("SELECT absent_count FROM counters WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
+        s = conn.execute("SELECT last_date, cur_absent, max_absent FROM att_streaks WHERE group_id=? AND user_id=?",
+                         (gid, uid)).fetchone()
+        monthly = conn.execute("""SELECT month, days, absent FROM att_monthly WHERE group_id=? AND user_id=? AND days > 0
+                                  ORDER BY month DESC LIMIT ?""", (gid, uid, months)).fetchall()
+        last_absent = conn.execute("""SELECT att_date FROM attendance_archive WHERE group_id=? AND user_id=? AND status='absent'
+                                      ORDER BY att_date DESC LIMIT 5""", (gid, uid)).fetchall()
+    return {"group": g["name"], "limit": int(g["att_absent_limit"] or 0), "name": name["full_name"] if name else str(uid),
+            "absent_count": int(c["absent_count"]) if c else 0, "streak": s, "monthly": list(reversed(monthly)),
+            "last_absent": [r["att_date"] for r in last_absent]}
+
+
+def _rate(days: int, absent: int) -> str:
+    return f"{(days - absent) / days * 100:.0f}%" if days else "-"
+
+
+@router.callback_query(F.data.startswith("a:att_an:"))
+async def a_att_analytics(call: CallbackQuery):
+    if not await guard(call, "attendance"):
+        return
+    gid = int(call.data.split(":")[2])
+    a = await run_db(att_group_analytics, gid)
+    if not a:
+        await call.answer("Guruh topilmadi.", show_alert=True)
+        return
+
+    lim = a["limit"] if a["limit"] > 0 else "∞"
+    text = (f"📊 <b>Davomat tahlili</b>\nGuruh: <b>{escape_html(a['name'])}</b>\n"
+            f"Saqlangan kunlar: <b>{a['days']}</b> | Limit: <b>{lim}</b>\n\n")
+    if a["monthly"]:
+        text += "🗓 <b>Oylar bo‘yicha qatnashish:</b>\n"
+        for m in a["monthly"]:
+            text += f"{m['month']}: <b>{_rate(m['days'], m['absent'])}</b> ({m['days'] - m['absent']}/{m['days']})\n"
+    else:
+        text += "Hali saqlangan kun yo‘q.\n"
+    kb_rows = []
+    if a["at_risk"]:
+        text += "\n⚠️ <b>Limitga yaqinlar:</b>\n"
+        for i, r in enumerate(a["at_risk"], 1):
+            text += f"{i}. {escape_html(r['full_name'])} — <b>{r['absent_count']}/{lim}</b>"
+            text += f" (ketma-ket {r['cur_absent']})\n" if r["cur_absent"] else "\n"
+            kb_rows.append([InlineKeyboardButton(text=f"👤 {(r['full_name'] or '')[:24]}", callback_data=f"a:att_u:{gid}:{r['user_id']}")])
+    if a["streaks"]:
+        text += "\n🔴 <b>Ketma-ket qatnashmayotganlar:</b>\n"
+        for r in a["streaks"]:
+            text += f"• {escape_html(r['full_name'])} — {r['cur_absent']} dars\n"
+    kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g_att:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
+    await safe_edit(call, text, InlineKeyboardMarkup(inline_keyboard=kb_rows))
+
+
+@router.callback_query(F.data.startswith("a:att_u:"))
+async def a_att_student(call: CallbackQuery):
+    if not await guard(call, "attendance"):
+        return
+    _, _, gid, uid = call.data.split(":")
+    gid, uid = int(gid), int(uid)
+    a = await run_db(att_student_analytics, gid, uid)
+    if not a:
+        await call.answer("Guruh topilmadi.", show_alert=True)
+        return
+    s = a["streak"]
+    lim = a["limit"] if a["limit"] > 0 else "∞"
+    text = (f"👤 <b>{escape_html(a['name'])}</b>\nGuruh: <b>{escape_html(a['group'])}</b>\n\n"
+            f"Sababsiz qoldirish: <b>{a['absent_count']}/{lim}</b>\n"
+            f"Ketma-ket (hozir): <b>{s['cur_absent'] if s else 0}</b> | Eng uzun: <b>{s['max_absent'] if s else 0}</b>\n")
+    if a["monthly"]:
+        text += "\n🗓 <b>Oylar:</b>\n"
+        for m in a["monthly"]:
+            text += f"{m['month']}: <b>{_rate(m['days'], m['absent'])}</b> ({m['absent']} ta qoldirgan / {m['days']} dars)\n"
+    if a["last_absent"]:
+        text += "\n❌ Oxirgi qoldirganlari: " + ", ".join(a["last_absent"])
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:att_an:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
+    ])
+    await safe_edit(call, text, kb)
+
+@router.callback_query(F.data.regexp(r"^a:tests(:[np]:\d+)?$"))
+async def a_tests(call: CallbackQuery):
+    if not await guard(call, "tests"):
+        return
+    cursor, back = parse_page(call.data, "a:tests")
+    rows, has_prev, has_next = await run_db(TESTS_PAGES.page, (now_str(),), cursor, back)
+    await run_db(with_test_status, rows)
 
     kb_rows = []
     for r in rows:
-        st, dl = ensure_deadline(r["test_id"])
+        st = r["status"]
         icon = "🟢" if st == "active" else "⏸" if st == "paused" else "🏁"
         kb_rows.append([InlineKeyboardButton(text=f"{icon} {r['test_id']} ({st})", callback_data=f"a:t:{r['test_id']}")])
+    nav = kb_page_nav("a:tests", rows, has_prev, has_next)
+    if nav:
+        kb_rows.append(nav)
     kb_rows.append([InlineKeyboardButton(text="➕ Test yaratish", callback_data="a:t_add")])
     kb_rows.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
     await safe_edit(call, "🧪 <b>Testlar</b>", InlineKeyboardMarkup(inline_keyboard=kb_rows))
@@ -2015,7 +3949,7 @@ async def a_t_add(call: CallbackQuery, state: FSMContext):
 
 @router.message(AState.t_keys)
 async def a_t_keys(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tests"):
+    if _check_access(message.from_user.id, "tests"):
         await state.clear()
         return
     keys = (message.text or "").upper().strip().replace(" ", "")
@@ -2027,9 +3961,7 @@ async def a_t_keys(message: Message, state: FSMContext):
     await state.set_state(AState.t_minutes)
 
 async def kb_assign_builder(test_id: str, selected: set, is_public: int) -> InlineKeyboardMarkup:
-    conn = db()
-    groups = conn.execute("SELECT id, name FROM groups ORDER BY id DESC").fetchall()
-    conn.close()
+    groups = await db_fetchall("SELECT id, name FROM groups ORDER BY id DESC")
 
     rows = []
     pub_icon = "🌐✅" if is_public else "🌐❌"
@@ -2045,7 +3977,7 @@ async def kb_assign_builder(test_id: str, selected: set, is_public: int) -> Inli
 
 @router.message(AState.t_minutes)
 async def a_t_minutes(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tests"):
+    if _check_access(message.from_user.id, "tests"):
         await state.clear()
         return
     mins = safe_int((message.text or "").strip())
@@ -2058,11 +3990,9 @@ async def a_t_minutes(message: Message, state: FSMContext):
     tid = gen_test_id_5()
     deadline = (datetime.now() + timedelta(minutes=mins)).strftime("%Y-%m-%d %H:%M")
 
-    conn = db()
-    conn.execute("""INSERT INTO tests(test_id, keys, status, deadline, created_at, is_public)
-                    VALUES (?,?,?,?,?,0)""", (tid, keys, "active", deadline, now_str()))
-    conn.commit()
-    conn.close()
+    await db_write("""INSERT INTO tests(test_id, keys, status, deadline, created_at, is_public)
+                      VALUES (?,?,?,?,?,0)""", (tid, keys, "active", deadline, now_str()))
+    DEADLINES.schedule("test", tid, deadline)
 
     await state.update_data(tid=tid, selected=set(), is_public=0)
     kb = await kb_assign_builder(tid, set(), 0)
@@ -2078,7 +4008,7 @@ async def a_t_pub(call: CallbackQuery, state: FSMContext):
     if not await guard(call, "tests"):
         return
     tid = call.data.split(":")[2]
-    st, _ = ensure_deadline(tid)
+    st, _ = await run_db(ensure_deadline, tid)
     if st == "finished":
         await call.answer("Yakunlangan testni o‘zgartirib bo‘lmaydi.", show_alert=True)
         return
@@ -2114,13 +4044,14 @@ async def a_t_assign_save(call: CallbackQuery, state: FSMContext):
     selected = set(data.get("selected", set()))
     is_public = int(data.get("is_public", 0))
 
-    conn = db()
-    conn.execute("UPDATE tests SET is_public=? WHERE test_id=?", (is_public, tid))
-    conn.execute("DELETE FROM test_groups WHERE test_id=?", (tid,))
-    for gid in selected:
-        conn.execute("INSERT OR IGNORE INTO test_groups(test_id, group_id) VALUES (?,?)", (tid, gid))
-    conn.commit()
-    conn.close()
+    def _save():
+        with DB_POOL.writer() as conn:
+            conn.execute("UPDATE tests SET is_public=? WHERE test_id=?", (is_public, tid))
+            conn.execute("DELETE FROM test_groups WHERE test_id=?", (tid,))
+            conn.executemany("INSERT OR IGNORE INTO test_groups(test_id, group_id) VALUES (?,?)",
+                             [(tid, gid) for gid in selected])
+
+    await run_db(_save)
 
     await state.clear()
     await safe_edit(call, f"✅ Test <b>{tid}</b> saqlandi.\nPublic: <b>{'ON' if is_public else 'OFF'}</b>\nGuruhlar: <b>{', '.join(map(str, selected)) if selected else 'yo‘q'}</b>",
@@ -2134,31 +4065,30 @@ async def a_g_tests(call: CallbackQuery):
     if not await guard(call, "tests"):
         return
     gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    tests = conn.execute("""
-        SELECT t.test_id, t.status, t.deadline, COALESCE(t.is_public,0) as is_public
+    g = await db_fetchone("SELECT name FROM groups WHERE id=?", (gid,))
+    tests = await run_db(lambda: with_test_status(_fetchall(f"""
+        SELECT t.test_id, t.status AS raw_status, {TEST_STATUS_SQL} AS status, t.deadline,
+               COALESCE(t.is_public,0) as is_public
         FROM tests t
         LEFT JOIN test_groups tg ON tg.test_id=t.test_id
         WHERE tg.group_id=? OR COALESCE(t.is_public,0)=1
         GROUP BY t.test_id
         ORDER BY t.created_at DESC
         LIMIT 30
-    """, (gid,)).fetchall()
-    conn.close()
+    """, (now_str(), gid))))
     if not g:
         await call.answer("Guruh topilmadi.", show_alert=True)
         return
 
     kb_rows = []
     for t in tests:
-        st, _ = ensure_deadline(t["test_id"])
+        st = t["status"]
         icon = "🟢" if st == "active" else "⏸" if st == "paused" else "🏁"
         kb_rows.append([InlineKeyboardButton(text=f"{icon} {t['test_id']}", callback_data=f"a:t:{t['test_id']}")])
     kb_rows.append([InlineKeyboardButton(text="➕ Test yaratish", callback_data="a:t_add")])
     kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
 
-    await safe_edit(call, f"🧪 <b>{safe_pdf_text(g['name'])}</b> — Testlar", InlineKeyboardMarkup(inline_keyboard=kb_rows))
+    await safe_edit(call, f"🧪 <b>{escape_html(g['name'])}</b> — Testlar", InlineKeyboardMarkup(inline_keyboard=kb_rows))
 
 # =========================
 # ADMIN: Test options + rating (text+pdf)
@@ -2168,15 +4098,13 @@ async def a_t_opt(call: CallbackQuery):
     if not await guard(call, "tests"):
         return
     tid = call.data.split(":")[2]
-    st, dl = ensure_deadline(tid)
+    st, dl = await run_db(ensure_deadline, tid)
     if st is None:
         await call.answer("Test topilmadi.", show_alert=True)
         return
 
-    conn = db()
-    row = conn.execute("SELECT COALESCE(is_public,0) as p FROM tests WHERE test_id=?", (tid,)).fetchone()
-    groups = conn.execute("SELECT group_id FROM test_groups WHERE test_id=? ORDER BY group_id", (tid,)).fetchall()
-    conn.close()
+    row = await db_fetchone("SELECT COALESCE(is_public,0) as p FROM tests WHERE test_id=?", (tid,))
+    groups = await db_fetchall("SELECT group_id FROM test_groups WHERE test_id=? ORDER BY group_id", (tid,))
 
     is_public = int(row["p"]) if row else 0
     grp_list = ", ".join(str(int(g["group_id"])) for g in groups) if groups else "yo‘q"
@@ -2190,6 +4118,9 @@ async def a_t_opt(call: CallbackQuery):
         kb_rows.append([InlineKeyboardButton(text="🏁 Yakunlash", callback_data=f"a:t_finish:{tid}")])
     kb_rows.append([InlineKeyboardButton(text="🏆 Reyting (text)", callback_data=f"a:t_rate:{tid}")])
     kb_rows.append([InlineKeyboardButton(text="📥 Reyting (PDF)", callback_data=f"a:t_pdf:{tid}")])
+    kb_rows.append([InlineKeyboardButton(text="🔬 Savollar tahlili", callback_data=f"a:t_items:{tid}"),
+                    InlineKeyboardButton(text="📥 Tahlil (PDF)", callback_data=f"a:t_items_pdf:{tid}")])
+    kb_rows.append([InlineKeyboardButton(text="🔑 Kalitni tuzatish", callback_data=f"a:t_keyedit:{tid}")])
     if st != "finished":
         kb_rows.append([InlineKeyboardButton(text="🔁 Biriktirish", callback_data=f"a:t_reassign:{tid}")])
     kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data="a:tests"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
@@ -2202,14 +4133,91 @@ async def a_t_opt(call: CallbackQuery):
             f"📌 PDF faqat test yakunlanganda ma’qul (ammo bu yerda har doim ochiladi).")
     await safe_edit(call, text, InlineKeyboardMarkup(inline_keyboard=kb_rows))
 
+@router.callback_query(F.data.startswith("a:t_items:"))
+async def a_t_items(call: CallbackQuery):
+    if not await guard(call, "tests"):
+        return
+    tid = call.data.split(":")[2]
+    res = await run_db(item_analysis, tid)
+    if not res or not res[0]["n"]:
+        await call.answer("Topshirilgan javoblar yo‘q.", show_alert=True)
+        return
+    await call.answer()
+    msgs = item_analysis_text(tid, *res)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📥 PDF", callback_data=f"a:t_items_pdf:{tid}")],
+        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:t:{tid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
+    ])
+    for i, text in enumerate(msgs):
+        await call.message.answer(text, reply_markup=kb if i == len(msgs) - 1 else None)
+
+@router.callback_query(F.data.startswith("a:t_items_pdf:"))
+async def a_t_items_pdf(call: CallbackQuery):
+    if not await guard(call, "tests"):
+        return
+    tid = call.data.split(":")[2]
+
+    def render() -> Optional[bytes]:
+        res = item_analysis(tid)
+        if not res or not res[0]["n"]:
+            return None
+        return pdf_item_analysis(f"Savollar tahlili — Test {tid}", *res)
+
+    if not await REPORTS.send(call.message, "items", tid, [("test", tid)], f"items_{tid}.pdf", render):
+        await call.answer("Topshirilgan javoblar yo‘q.", show_alert=True)
+
+@router.callback_query(F.data.startswith("a:t_keyedit:"))
+async def a_t_keyedit(call: CallbackQuery, state: FSMContext):
+    if not await guard(call, "tests"):
+        return
+    tid = call.data.split(":")[2]
+    row = await db_fetchone("SELECT keys FROM tests WHERE test_id=?", (tid,))
+    if not row:
+        await call.answer("Test topilmadi.", show_alert=True)
+        return
+    await state.clear()
+    await state.update_data(tid=tid)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:t:{tid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
+    ])
+    await safe_edit(call,
+                    f"🔑 <b>Kalitni tuzatish</b> — <code>{tid}</code>\n"
+                    f"Hozirgi kalit: <code>{escape_html(row['keys'])}</code>\n\n"
+                    f"To‘g‘ri kalitni yuboring (faqat A/B/C/D). Barcha topshirilgan javoblar qayta baholanadi.\nBekor: /cancel",
+                    kb)
+    await state.set_state(AState.t_edit_keys)
+
+@router.message(AState.t_edit_keys)
+async def a_t_keyedit_save(message: Message, state: FSMContext):
+    if _check_access(message.from_user.id, "tests"):
+        await state.clear()
+        return
+    keys = (message.text or "").upper().strip().replace(" ", "")
+    if not keys or any(ch not in "ABCD" for ch in keys):
+        await message.answer("❌ Faqat A/B/C/D bo‘lsin. Qayta yuboring:")
+        return
+    tid = (await state.get_data()).get("tid")
+    res = await run_db(regrade_test, tid, keys)
+    await run_db(log_admin, message.from_user.id, "test_regrade",
+                 {"test_id": tid, "keys": keys, "regraded": res["regraded"], "changed": res["changed"]})
+    await state.clear()
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🏆 Reyting", callback_data=f"a:t_rate:{tid}")],
+        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:t:{tid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
+    ])
+    await message.answer(
+        f"✅ Kalit yangilandi: <code>{tid}</code> ({res['total']} savol)\n"
+        f"Qayta baholandi: <b>{res['regraded']}</b> ta, ball o‘zgardi: <b>{res['changed']}</b> ta\n\n"
+        f"📊 To‘g‘ri javoblar (savol: %):\n{fmt_per_question(res['per_q'], res['n'])}",
+        reply_markup=kb,
+    )
+
 @router.callback_query(F.data.startswith("a:t_pause:"))
 async def a_t_pause(call: CallbackQuery):
     if not await guard(call, "tests"):
         return
     tid = call.data.split(":")[2]
-    conn = db()
-    conn.execute("UPDATE tests SET status='paused' WHERE test_id=?", (tid,))
-    conn.commit(); conn.close()
+    await db_write("UPDATE tests SET status='paused' WHERE test_id=?", (tid,))
     await call.answer("Pauza", show_alert=True)
     await a_t_opt(call)
 
@@ -2218,13 +4226,11 @@ async def a_t_resume(call: CallbackQuery):
     if not await guard(call, "tests"):
         return
     tid = call.data.split(":")[2]
-    st, _ = ensure_deadline(tid)
+    st, _ = await run_db(ensure_deadline, tid)
     if st == "finished":
         await call.answer("Yakunlangan testni davom ettirib bo‘lmaydi.", show_alert=True)
         return
-    conn = db()
-    conn.execute("UPDATE tests SET status='active' WHERE test_id=?", (tid,))
-    conn.commit(); conn.close()
+    await db_write("UPDATE tests SET status='active' WHERE test_id=?", (tid,))
     await call.answer("Davom", show_alert=True)
     await a_t_opt(call)
 
@@ -2233,9 +4239,7 @@ async def a_t_finish(call: CallbackQuery):
     if not await guard(call, "tests"):
         return
     tid = call.data.split(":")[2]
-    conn = db()
-    conn.execute("UPDATE tests SET status='finished' WHERE test_id=?", (tid,))
-    conn.commit(); conn.close()
+    await db_write("UPDATE tests SET status='finished' WHERE test_id=?", (tid,))
     await call.answer("Yakunlandi", show_alert=True)
     await a_t_opt(call)
 
@@ -2243,43 +4247,61 @@ async def a_t_finish(call: CallbackQuery):
 async def a_t_rate(call: CallbackQuery):
     if not await guard(call, "tests"):
         return
-    tid = call.data.split(":")[2]
-    st, dl = ensure_deadline(tid)
+    parts = call.data.split(":")
+    tid = parts[2]
+    pg = int(parts[3]) if len(parts) > 3 else 0
+    st, dl = await run_db(ensure_deadline, tid)
 
-    conn = db()
-    rows = conn.execute("""SELECT full_name, score, total, percent, date
-                           FROM results WHERE test_id=?
-                           ORDER BY percent DESC, score DESC""", (tid,)).fetchall()
-    conn.close()
-    if not rows:
+    # the leaderboard is already sorted in memory, so a page is a slice by offset
+    n = await run_db(LEADERBOARD.size, tid)
+    if not n:
         await call.answer("Natija yo‘q.", show_alert=True)
         return
+    pages = (n + RATING_PAGE_SIZE - 1) // RATING_PAGE_SIZE
+    pg = max(0, min(pg, pages - 1))
+    rows = await run_db(LEADERBOARD.page, tid, pg * RATING_PAGE_SIZE, RATING_PAGE_SIZE)
 
     text = f"🏆 <b>Reyting</b> — <code>{tid}</code>\nHolat: <b>{st}</b> | ⏰ <code>{dl}</code>\n\n"
-    for i, r in enumerate(rows, 1):
-        text += f"{i}. {safe_pdf_text(r['full_name'])} — <b>{r['percent']:.1f}%</b> | {to_uz_time_str(r['date'])}\n"
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
+    for i, r in enumerate(rows, pg * RATING_PAGE_SIZE + 1):
+        text += f"{i}. {escape_html(r['full_name'])} — <b>{r['percent']:.1f}%</b> | {to_uz_time_str(r['date'])}\n"
+    if pages > 1:
+        text += f"\n📄 {pg + 1}/{pages} · jami {n}"
+
+    nav = []
+    if pg > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"a:t_rate:{tid}:{pg - 1}"))
+    if pg < pages - 1:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"a:t_rate:{tid}:{pg + 1}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=([nav] if nav else []) + [
         [InlineKeyboardButton(text="📥 PDF", callback_data=f"a:t_pdf:{tid}")],
         [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:t:{tid}")],
         [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
     ])
     await safe_edit(call, text, kb)
 
+@router.callback_query(F.data.startswith("a:t_pdf:"))
+async def a_t_pdf(call: CallbackQuery):
+    if not await guard(call, "tests"):
+        return
+    tid = call.data.split(":")[2]
+
+    sent = await REPORTS.send(call.message, "rating", tid, [("test", tid)],
+                              f"rating_{tid}.pdf", pdf_rating, tid, f"Reyting — Test {tid}")
+    if not sent:
+        await call.answer("Natija yo‘q.", show_alert=True)
+
 @router.callback_query(F.data.startswith("a:t_reassign:"))
 async def a_t_reassign(call: CallbackQuery, state: FSMContext):
     if not await guard(call, "tests"):
         return
     tid = call.data.split(":")[2]
-    st, _ = ensure_deadline(tid)
+    st, _ = await run_db(ensure_deadline, tid)
     if st == "finished":
         await call.answer("Yakunlangan testni biriktirib bo‘lmaydi.", show_alert=True)
         return
 
-    conn = db()
-    grp = conn.execute("SELECT group_id FROM test_groups WHERE test_id=?", (tid,)).fetchall()
-    pub = conn.execute("SELECT COALESCE(is_public,0) as p FROM tests WHERE test_id=?", (tid,)).fetchone()
-    conn.close()
+    grp = await db_fetchall("SELECT group_id FROM test_groups WHERE test_id=?", (tid,))
+    pub = await db_fetchone("SELECT COALESCE(is_public,0) as p FROM tests WHERE test_id=?", (tid,))
     selected = {int(x["group_id"]) for x in grp}
     is_public = int(pub["p"]) if pub else 0
 
@@ -2289,6 +4311,472 @@ async def a_t_reassign(call: CallbackQuery, state: FSMContext):
     await safe_edit(call, "🔁 Biriktirishni yangilang:", kb)
     await state.set_state(AState.t_assign)
 
+# =========================
+# ADMIN: DATA EXPORT (CSV.gz / Parquet, streamed from a cursor)
+# =========================
+try:
+    import pyarrow as pa  # optional: Parquet exports (CSV works without it)
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+EXPORT_CHUNK = 5000  # rows per fetchmany / Parquet row group
+EXPORT_MAX_BYTES = 49 * 1024 * 1024  # Telegram bot uploads stop at 50 MB
+
+# dataset -> label, FROM clause, columns (name, type, expr), group filter, date column, order
+EXPORTS = {
+    "results": {
+        "label": "Test natijalari",
+        "from": "results r",
+        "cols": [("id", "int", "r.id"), ("test_id", "text", "r.test_id"), ("user_id", "int", "r.user_id"),
+                 ("full_name", "text", "r.full_name"), ("score", "int", "r.score"), ("total", "int", "r.total"),
+                 ("percent", "real", "r.percent"), ("date", "text", "r.date")],
+        "group": "EXISTS (SELECT 1 FROM members m WHERE m.group_id=? AND m.user_id=r.user_id)",
+        "date": "r.date",
+        "order": "r.id",
+    },
+    "attendance": {
+        "label": "Davomat",
+        "from": "attendance a LEFT JOIN groups g ON g.id=a.group_id LEFT JOIN users u ON u.user_id=a.user_id",
+        "cols": [("group_id", "int", "a.group_id"), ("group_name", "text", "g.name"), ("att_date", "text", "a.att_date"),
+                 ("user_id", "int", "a.user_id"), ("full_name", "text", "u.full_name"), ("status", "text", "a.status")],
+        "group": "a.group_id=?",
+        "date": "a.att_date",
+        "order": "a.group_id, a.att_date, a.user_id",
+    },
+    "attendance_days": {
+        "label": "Davomat kunlari",
+        "from": "attendance_days d LEFT JOIN groups g ON g.id=d.group_id",
+        "cols": [("group_id", "int", "d.group_id"), ("group_name", "text", "g.name"), ("att_date", "text", "d.att_date"),
+                 ("saved_at", "text", "d.saved_at"), ("saved_by", "int", "d.saved_by")],
+        "group": "d.group_id=?",
+        "date": "d.att_date",
+        "order": "d.group_id, d.att_date",
+    },
+    "task_submissions": {
+        "label": "Vazifa baholari",
+        "from": "task_submissions s LEFT JOIN tasks t ON t.id=s.task_id",
+        "cols": [("id", "int", "s.id"), ("task_id", "int", "s.task_id"), ("group_id", "int", "t.group_id"),
+                 ("title", "text", "t.title"), ("points", "int", "t.points"), ("user_id", "int", "s.user_id"),
+                 ("full_name", "text", "s.full_name"), ("submitted_at", "text", "s.submitted_at"),
+                 ("content_type", "text", "s.content_type"), ("score", "int", "s.score"), ("feedback", "text", "s.feedback"),
+                 ("graded_at", "text", "s.graded_at"), ("graded_by", "int", "s.graded_by")],
+        "group": "t.group_id=?",
+        "date": "s.submitted_at",
+        "order": "s.id",
+    },
+    "counters": {
+        "label": "Hisoblagichlar",
+        "from": "counters c LEFT JOIN groups g ON g.id=c.group_id LEFT JOIN users u ON u.user_id=c.user_id",
+        "cols": [("group_id", "int", "c.group_id"), ("group_name", "text", "g.name"), ("user_id", "int", "c.user_id"),
+                 ("full_name", "text", "u.full_name"), ("absent_count", "int", "c.absent_count"),
+                 ("missed_task_count", "int", "c.missed_task_count")],
+        "group": "c.group_id=?",
+        "date": None,  # running totals, no date
+        "order": "c.group_id, c.user_id",
+    },
+}
+
+
+def _export_query(ds: str, gid: int, d_from: Optional[str], d_to: Optional[str]) -> Tuple[str, list]:
+    spec = EXPORTS[ds]
+    sql = "SELECT " + ", ".join(f"{expr} AS {name}" for name, _, expr in spec["cols"]) + f" FROM {spec['from']} WHERE 1=1"
+    params: list = []
+    if gid:
+        sql += f" AND {spec['group']}"
+        params.append(gid)
+    if spec["date"] and d_from:
+        sql += f" AND {spec['date']} >= ?"
+        params.append(d_from)
+    if spec["date"] and d_to:
+        # dates are "%Y-%m-%d" or "%Y-%m-%d %H:%M": everything before the next day
+        sql += f" AND {spec['date']} < ?"
+        params.append((datetime.strptime(d_to, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d"))
+    return sql + f" ORDER BY {spec['order']}", params
+
+
+def _export_chunks(conn: sqlite3.Connection, ds: str, gid: int, d_from: Optional[str], d_to: Optional[str]) -> Iterator[list]:
+    sql, params = _export_query(ds, gid, d_from, d_to)
+    cur = conn.execute(sql, params)
+    while True:
+        rows = cur.fetchmany(EXPORT_CHUNK)
+        if not rows:
+            return
+        yield [tuple(r) for r in rows]
+
+
+def _write_csv(f, ds: str, chunks: Iterable[list]) -> int:
+    w = csv.writer(f)
+    w.writerow([name for name, _, _ in EXPORTS[ds]["cols"]])
+    n = 0
+    for rows in chunks:
+        w.writerows(rows)
+        n += len(rows)
+    return n
+
+
+def _write_parquet(path: str, ds: str, chunks: Iterable[list]) -> int:
+    types = {"int": pa.int64(), "real": pa.float64(), "text": pa.string()}
+    schema = pa.schema([(name, types[t]) for name, t, _ in EXPORTS[ds]["cols"]])
+    n = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as w:
+        for rows in chunks:
+            cols = list(zip(*rows))
+            w.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(cols, schema)], schema=schema))
+            n += len(rows)
+    return n
+
+
+def export_data(ds: str, gid: int, d_from: Optional[str], d_to: Optional[str], fmt: str) -> Tuple[str, str, dict]:
+    """
+    Write dataset `ds` (or "all" -> one zip with every dataset) for group `gid` (0 = all groups) and
+    [d_from, d_to] into a temp file, EXPORT_CHUNK rows at a time. Returns (path, filename, {ds: rows}).
+    The caller removes the file.
+    """
+    ext = ".parquet" if fmt == "parquet" else ".csv"
+    scope = f"G{gid}" if gid else "all"
+    if d_from or d_to:
+        scope += f"_{d_from or ''}_{d_to or ''}"
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=".zip" if ds == "all" else (ext if fmt == "parquet" else ".csv.gz"))
+    os.close(fd)
+    counts = {}
+    try:
+        with db() as conn:
+            if ds == "all":
+                with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                    for name in EXPORTS:
+                        chunks = _export_chunks(conn, name, gid, d_from, d_to)
+                        if fmt == "parquet":
+                            fd, part = tempfile.mkstemp(prefix="export_", suffix=ext)
+                            os.close(fd)
+                            try:
+                                counts[name] = _write_parquet(part, name, chunks)
+                                zf.write(part, name + ext)
+                            finally:
+                                os.remove(part)
+                        else:
+                            with zf.open(name + ext, "w", force_zip64=True) as raw, \
+                                    io.TextIOWrapper(raw, encoding="utf-8", newline="") as f:
+                                counts[name] = _write_csv(f, name, chunks)
+                filename = f"export_{scope}.zip"
+            elif fmt == "parquet":
+                counts[ds] = _write_parquet(path, ds, _export_chunks(conn, ds, gid, d_from, d_to))
+                filename = f"{ds}_{scope}{ext}"
+            else:
+                with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+                    counts[ds] = _write_csv(f, ds, _export_chunks(conn, ds, gid, d_from, d_to))
+                filename = f"{ds}_{scope}.csv.gz"
+    except Exception:
+        os.remove(path)
+        raise
+    return path, filename, counts
+
+
+def kb_export_formats() -> InlineKeyboardMarkup:
+    row = [InlineKeyboardButton(text="📄 CSV", callback_data="a:exp_fmt:csv")]
+    if pq is not None:
+        row.append(InlineKeyboardButton(text="🧱 Parquet", callback_data="a:exp_fmt:parquet"))
+    return InlineKeyboardMarkup(inline_keyboard=[row, [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")]])
+
+
+def parse_date_range(s: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    """Admin date range: `-` -> (None, None), `FROM` -> (FROM, None), `FROM TO` -> (FROM, TO); invalid -> None."""
+    parts = s.replace("..", " ").split()
+    if parts in (["-"], []):
+        return None, None
+    if len(parts) > 2:
+        return None
+    try:
+        for p in parts:
+            datetime.strptime(p, "%Y-%m-%d")
+    except ValueError:
+        return None
+    if len(parts) == 2 and parts[0] > parts[1]:
+        return None
+    return parts[0], (parts[1] if len(parts) == 2 else None)
+
+
+@router.callback_query(F.data == "a:export")
+async def a_export(call: CallbackQuery, state: FSMContext):
+    if not await guard(call, "export"):
+        return
+    await state.clear()
+    rows = [[InlineKeyboardButton(text=f"📄 {spec['label']}", callback_data=f"a:exp:{ds}")] for ds, spec in EXPORTS.items()]
+    rows.append([InlineKeyboardButton(text="📦 Hammasi (zip)", callback_data="a:exp:all")])
+    rows.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
+    await safe_edit(call, "📤 <b>Eksport</b>\nQaysi ma’lumot kerak?", InlineKeyboardMarkup(inline_keyboard=rows))
+
+
+@router.callback_query(F.data.startswith("a:exp:"))
+async def a_exp_groups(call: CallbackQuery):
+    if not await guard(call, "export"):
+        return
+    ds = call.data.split(":")[2]
+    if ds != "all" and ds not in EXPORTS:
+        await call.answer("Noma’lum eksport.", show_alert=True)
+        return
+    prefix = f"a:exp:{ds}"
+    cursor, back = parse_page(call.data, prefix)
+    groups, has_prev, has_next = await run_db(GROUPS_PAGES.page, (), cursor, back)
+    kb_rows = [[InlineKeyboardButton(text="🌐 Barcha guruhlar", callback_data=f"a:exp_g:{ds}:0")]]
+    for g in groups:
+        kb_rows.append([InlineKeyboardButton(text=f"📁 {g['name']}", callback_data=f"a:exp_g:{ds}:{g['id']}")])
+    nav = kb_page_nav(prefix, groups, has_prev, has_next)
+    if nav:
+        kb_rows.append(nav)
+    kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data="a:export"),
+                    InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
+    await safe_edit(call, "📤 <b>Eksport</b>\nGuruhni tanlang:", InlineKeyboardMarkup(inline_keyboard=kb_rows))
+
+
+@router.callback_query(F.data.startswith("a:exp_g:"))
+async def a_exp_group(call: CallbackQuery, state: FSMContext):
+    if not await guard(call, "export"):
+        return
+    _, _, ds, gid = call.data.split(":")
+    await state.clear()
+    await state.update_data(exp_ds=ds, exp_gid=int(gid))
+    await safe_edit(call, "📅 Sana oralig‘ini yuboring:\n"
+                          "<code>2024-09-01 2025-06-30</code> — oraliq\n"
+                          "<code>2024-09-01</code> — shu sanadan boshlab\n"
+                          "<code>-</code> — hammasi", kb_home_admin(call.from_user.id))
+    await state.set_state(AState.exp_range)
+
+
+@router.message(AState.exp_range)
+async def a_exp_range(message: Message, state: FSMContext):
+    if _check_access(message.from_user.id, "export"):
+        await state.clear()
+        return
+    rng = parse_date_range((message.text or "").strip())
+    if rng is None:
+        await message.answer("❌ Format: <code>2024-09-01 2025-06-30</code> yoki <code>-</code>")
+        return
+    await state.update_data(exp_from=rng[0], exp_to=rng[1])
+    await message.answer("Formatni tanlang:", reply_markup=kb_export_formats())
+
+
+@router.callback_query(F.data.startswith("a:exp_fmt:"))
+async def a_exp_run(call: CallbackQuery, state: FSMContext):
+    if not await guard(call, "export"):
+        return
+    fmt = call.data.split(":")[2]
+    data = await state.get_data()
+    if "exp_ds" not in data or (fmt == "parquet" and pq is None):
+        await call.answer("Eksportni qaytadan boshlang.", show_alert=True)
+        return
+    await state.clear()
+    await call.answer("⏳ Tayyorlanmoqda...")
+    ds, gid = data["exp_ds"], int(data["exp_gid"])
+    if ds in ("attendance", "all"):
+        await ATT_SHEETS.flush_all()
+    try:
+        path, filename, counts = await run_report(export_data, ds, gid, data.get("exp_from"), data.get("exp_to"), fmt)
+    except Exception as e:
+        await call.message.answer(f"❌ Eksport xatolik: <code>{escape_html(e)}</code>")
+        return
+    try:
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            await call.message.answer(f"❌ Fayl juda katta ({size // (1024 * 1024)} MB). Guruh yoki sana oralig‘ini toraytiring.")
+            return
+        caption = "📤 " + " | ".join(f"{EXPORTS[k]['label']}: {v}" for k, v in counts.items())
+        await call.message.answer_document(FSInputFile(path, filename=filename), caption=caption)
+    finally:
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+# =========================
+# RESULTS IMPORT (CSV / XLSX upload -> upsert on user_id + test_id)
+# =========================
+try:
+    import openpyxl  # .xlsx uploads (in requirements.txt; a bare install still takes CSV)
+except ImportError:
+    openpyxl = None
+
+IMPORT_EXTS = (".csv", ".txt", ".xlsx")
+IMPORT_ERRORS_SHOWN = 15
+
+
+def _norm_name(s) -> str:
+    """Name key for matching upload rows to members: apostrophe variants, spacing and case ignored."""
+    s = str(s or "")
+    for ch in ("ʻ", "ʼ", "’", "‘", "`"):
+        s = s.replace(ch, "'")
+    return " ".join(s.split()).casefold()
+
+
+def _cell_int(v) -> Optional[int]:
+    if v is None or isinstance(v, bool):
+        return None
+    if isinstance(v, (int, float)):
+        return int(v) if float(v).is_integer() else None
+    s = str(v).strip().replace(",", ".")
+    try:
+        f = float(s)
+    except ValueError:
+        return None
+    return int(f) if f.is_integer() else None
+
+
+def iter_upload_rows(path: str) -> Iterator[Tuple[int, list]]:
+    """(line_no, cells) of an uploaded .csv/.xlsx, read one row at a time."""
+    if path.lower().endswith(".xlsx"):
+        if openpyxl is None:
+            raise ValueError("XLSX o‘qish uchun serverda openpyxl yo‘q — faylni CSV qilib yuboring.")
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for i, row in enumerate(wb.worksheets[0].iter_rows(values_only=True), 1):
+                yield i, list(row)
+        finally:
+            wb.close()
+        return
+    with open(path, newline="", encoding="utf-8-sig", errors="replace") as f:
+        try:
+            dialect = csv.Sniffer().sniff(f.read(4096), delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        f.seek(0)
+        for i, row in enumerate(csv.reader(f, dialect), 1):
+            yield i, row
+
+
+def validate_results_rows(gid: int, total: int, rows: Iterable[Tuple[int, list]]):
+    """
+    Check (user_id or full name, score) rows against the members of group `gid`.
+    Returns (good, errors): good = [(user_id, score, full_name)], errors = [(line_no, reason)].
+    A first row whose score is not a number is taken as a header.
+    """
+    students = group_students(gid)
+    by_id = dict(students)
+    by_name: dict = {}
+    for uid, nm in students:
+        by_name.setdefault(_norm_name(nm), []).append(uid)
+
+    good: List[Tuple[int, int, str]] = []
+    errors: List[Tuple[int, str]] = []
+    seen: dict = {}
+    for line, cells in rows:
+        if not any(c is not None and str(c).strip() for c in cells):
+            continue
+        if len(cells) < 2:
+            errors.append((line, "2 ta ustun kerak: user_id yoki ism, ball"))
+            continue
+        who, raw = cells[0], cells[1]
+        score = _cell_int(raw)
+        if score is None:
+            if line == 1:
+                continue
+            errors.append((line, f"ball noto‘g‘ri: {raw}"))
+            continue
+        if not 0 <= score <= total:
+            errors.append((line, f"ball 0..{total} oralig‘ida bo‘lsin: {score}"))
+            continue
+        uid = _cell_int(who)
+        if uid not in by_id:
+            ids = by_name.get(_norm_name(who), [])
+            if len(ids) > 1:
+                errors.append((line, f"guruhda bir xil ismli o‘quvchilar bor, user_id yozing: {who}"))
+                continue
+            if not ids:
+                errors.append((line, f"guruhda topilmadi: {who}"))
+                continue
+            uid = ids[0]
+        if uid in seen:
+            errors.append((line, f"takror: {by_id[uid]} ({seen[uid]}-qatorda bor)"))
+            continue
+        seen[uid] = line
+        good.append((uid, score, by_id[uid]))
+    return good, errors
+
+
+def upsert_results(tid: str, total: int, rows: List[Tuple[int, int, str]]) -> Tuple[int, int]:
+    """
+    Write [(user_id, score, full_name)] of test `tid` in one transaction: results that already exist for
+    (user_id, test_id) are updated when the score changed (an overwritten online result stops being one, so
+    a later key fix does not regrade it back), the rest inserted. Importing the same file again changes
+    nothing. Returns (inserted, updated).
+    """
+    dt = now_str()
+    with DB_POOL.writer() as conn:
+        conn.execute("""CREATE TEMP TABLE IF NOT EXISTS imp_results(
+                user_id INTEGER PRIMARY KEY,
+                score INTEGER,
+                percent REAL,
+                full_name TEXT
+            )""")
+        conn.execute("DELETE FROM imp_results")
+        conn.executemany("INSERT INTO imp_results(user_id, score, percent, full_name) VALUES (?,?,?,?)",
+                         [(uid, sc, (sc / total) * 100 if total else 0.0, nm) for uid, sc, nm in rows])
+        updated = conn.execute("""
+            UPDATE results SET score=i.score, total=?, percent=i.percent, date=?, full_name=i.full_name,
+                               submission_id=NULL
+            FROM imp_results i
+            WHERE results.test_id=? AND results.user_id=i.user_id
+              AND (results.score IS NOT i.score OR results.total IS NOT ? OR results.percent IS NOT i.percent)
+        """, (total, dt, tid, total)).rowcount
+        inserted = conn.execute("""
+            INSERT INTO results(user_id, test_id, score, total, percent, date, full_name)
+            SELECT i.user_id, ?, i.score, ?, i.percent, ?, i.full_name
+            FROM imp_results i
+            WHERE NOT EXISTS (SELECT 1 FROM results r WHERE r.test_id=? AND r.user_id=i.user_id)
+        """, (tid, total, dt, tid)).rowcount
+        conn.execute("DELETE FROM imp_results")
+    if inserted or updated:
+        LEADERBOARD.invalidate(tid)
+    return inserted, updated
+
+
+def import_results_file(path: str, gid: int, tid: str, total: int):
+    """Parse + validate + upsert an uploaded results file. Returns (inserted, updated, errors)."""
+    good, errors = validate_results_rows(gid, total, iter_upload_rows(path))
+    inserted, updated = upsert_results(tid, total, good) if good else (0, 0)
+    return inserted, updated, errors
+
+
+async def import_results_upload(message: Message, state: FSMContext) -> None:
+    """Handle a CSV/XLSX sent while a results import (or manual entry) for a test is waiting."""
+    data = await state.get_data()
+    gid, tid, total = int(data["gid"]), data["tid"], int(data["total"])
+    doc = message.document
+    name = doc.file_name or ""
+    if not name.lower().endswith(IMPORT_EXTS):
+        await message.answer("❌ Faqat .csv yoki .xlsx fayl yuboring.")
+        return
+
+    tmp_path = os.path.join(tempfile.gettempdir(), f"import_{doc.file_unique_id}_{int(time.time() * 1000)}{os.path.splitext(name)[1].lower()}")
+    try:
+        await message.bot.download(doc, destination=tmp_path)
+        inserted, updated, errors = await run_db(import_results_file, tmp_path, gid, tid, total)
+    except Exception as e:
+        await message.answer(f"❌ Import xatolik: <code>{escape_html(e)}</code>")
+        return
+    finally:
+        try:
+            os.remove(tmp_path)
+        except Exception:
+            pass
+
+    text = (f"✅ Import tugadi.\nTest: <code>{escape_html(tid)}</code>\nGuruh: <code>{gid}</code>\n"
+            f"Yangi: <b>{inserted}</b> | Yangilandi: <b>{updated}</b> | Xato: <b>{len(errors)}</b>")
+    if errors:
+        text += "\n\n" + "\n".join(f"{ln}-qator: {escape_html(r)}" for ln, r in errors[:IMPORT_ERRORS_SHOWN])
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            text += f"\n... yana {len(errors) - IMPORT_ERRORS_SHOWN} ta (faylda)"
+        text += "\n\nTuzatib, faylni qayta yuborishingiz mumkin — to‘g‘ri qatorlar takrorlanmaydi."
+    if not errors:
+        await state.clear()
+    await message.answer(text, reply_markup=kb_admin_home(message.from_user.id))
+    if len(errors) > IMPORT_ERRORS_SHOWN:
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(["line", "error"])
+        w.writerows(errors)
+        await message.answer_document(BufferedInputFile(buf.getvalue().encode("utf-8-sig"),
+                                                        filename=f"import_errors_{tid}.csv"))
+
 # =========================
 # GROUP RESULTS: manual + import (inside group)
 # =========================
@@ -2317,7 +4805,7 @@ async def a_m_start(call: CallbackQuery, state: FSMContext):
 
 @router.message(AState.m_tid)
 async def a_m_tid(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "results"):
+    if _check_access(message.from_user.id, "results"):
         await state.clear()
         return
     tid = (message.text or "").strip()
@@ -2327,7 +4815,7 @@ async def a_m_tid(message: Message, state: FSMContext):
 
 @router.message(AState.m_total)
 async def a_m_total(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "results"):
+    if _check_access(message.from_user.id, "results"):
         await state.clear()
         return
     total = safe_int((message.text or "").strip())
@@ -2336,7 +4824,7 @@ async def a_m_total(message: Message, state: FSMContext):
         return
     data = await state.get_data()
     gid = int(data["gid"])
-    students = group_students(gid)
+    students = await run_db(group_students, gid)
     if not students:
         await message.answer("Guruhda o‘quvchi yo‘q.")
         await state.clear()
@@ -2345,16 +4833,20 @@ async def a_m_total(message: Message, state: FSMContext):
     preview = "\n".join([f"{i+1}. {nm}" for i, (_uid, nm) in enumerate(students)])
     await message.answer(
         f"✅ Endi ballarni ketma-ket yuboring.\n"
-        f"O‘quvchilar: <b>{len(students)}</b>\n\n{safe_pdf_text(preview)}\n\n"
-        f"Format: 10 9 8 ... (bo‘shliq bilan).",
+        f"O‘quvchilar: <b>{len(students)}</b>\n\n{escape_html(preview)}\n\n"
+        f"Format: 10 9 8 ... (bo‘shliq bilan).\n"
+        f"Yoki CSV/XLSX fayl yuboring: 1-ustun user_id yoki ism, 2-ustun ball.",
     )
     await state.set_state(AState.m_scores)
 
 @router.message(AState.m_scores)
 async def a_m_scores(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "results"):
+    if _check_access(message.from_user.id, "results"):
         await state.clear()
         return
+    if message.document:
+        await import_results_upload(message, state)
+        return
     data = await state.get_data()
     gid = int(data["gid"])
     tid = data["tid"]
@@ -2367,15 +4859,9 @@ async def a_m_scores(message: Message, state: FSMContext):
         await message.answer(f"❌ Ballar soni mos emas. Kerak: {len(students)}, Siz: {len(scores)}")
         return
 
-    conn = db()
-    dt = now_str()
-    for idx, (uid, nm) in enumerate(students):
-        sc = scores[idx]
-        pct = (sc / total) * 100 if total else 0.0
-        conn.execute("""INSERT INTO results(user_id, test_id, score, total, percent, date, full_name)
-                        VALUES (?,?,?,?,?,?,?)""", (uid, tid, sc, total, pct, dt, nm))
-    conn.commit()
-    conn.close()
+    # re-sending the same scores updates the existing rows instead of adding duplicates
+    rows = [(uid, scores[idx], nm) for idx, (uid, nm) in enumerate(students)]
+    await run_db(upsert_results, tid, total, rows)
 
     await state.clear()
     await message.answer(f"✅ Manual natijalar saqlandi.\nTest: <code>{tid}</code>\nGuruh: <code>{gid}</code>", reply_markup=kb_admin_home(message.from_user.id))
@@ -2387,50 +4873,49 @@ async def a_imp_start(call: CallbackQuery, state: FSMContext):
     gid = int(call.data.split(":")[2])
     await state.clear()
     await state.update_data(gid=gid)
-    await safe_edit(call, "📥 Import: Test ID kiriting (natijalar DBda bo‘lishi kerak):", kb_home_admin(call.from_user.id))
+    await safe_edit(call, "📥 Import: Test ID kiriting (masalan: 12345):", kb_home_admin(call.from_user.id))
     await state.set_state(AState.imp_tid)
 
 @router.message(AState.imp_tid)
 async def a_imp_tid(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "results"):
+    if _check_access(message.from_user.id, "results"):
         await state.clear()
         return
     tid = (message.text or "").strip()
-    data = await state.get_data()
-    gid = int(data["gid"])
+    if not tid:
+        await message.answer("❌ Test ID kiriting.")
+        return
+    await state.update_data(tid=tid)
+    await message.answer("Jami savollar soni (total) ni kiriting:")
+    await state.set_state(AState.imp_total)
 
-    # Import = show rating for that group & test (no duplication logic here)
-    conn = db()
-    ids = conn.execute("SELECT user_id FROM members WHERE group_id=?", (gid,)).fetchall()
-    user_ids = [int(x["user_id"]) for x in ids]
-    if not user_ids:
-        conn.close()
-        await message.answer("Guruh bo‘sh.")
+@router.message(AState.imp_total)
+async def a_imp_total(message: Message, state: FSMContext):
+    if _check_access(message.from_user.id, "results"):
         await state.clear()
         return
+    total = safe_int((message.text or "").strip())
+    if total is None or total < 1:
+        await message.answer("❌ Total raqam bo‘lsin.")
+        return
+    await state.update_data(total=total)
+    await message.answer(
+        "📎 CSV yoki XLSX fayl yuboring.\n"
+        "1-ustun: <b>user_id</b> yoki <b>ism-familiya</b> (guruhdagidek)\n"
+        "2-ustun: <b>ball</b> (0..total)\n"
+        "Sarlavha qatori bo‘lishi mumkin. Faylni qayta yuborsangiz natijalar yangilanadi, takrorlanmaydi."
+    )
+    await state.set_state(AState.imp_file)
 
-    q = ",".join(["?"] * len(user_ids))
-    rows = conn.execute(f"""
-        SELECT full_name, percent, date
-        FROM results
-        WHERE test_id=? AND user_id IN ({q})
-        ORDER BY percent DESC
-    """, (tid, *user_ids)).fetchall()
-    conn.close()
-
-    if not rows:
-        await message.answer("Bu guruhda bu test bo‘yicha natija topilmadi.")
+@router.message(AState.imp_file)
+async def a_imp_file(message: Message, state: FSMContext):
+    if _check_access(message.from_user.id, "results"):
         await state.clear()
         return
-
-    text = f"✅ Import topildi.\nTest: <code>{tid}</code>\nGuruh: <code>{gid}</code>\nNatija: <b>{len(rows)}</b> ta\n\n"
-    for i, r in enumerate(rows[:15], 1):
-        text += f"{i}. {safe_pdf_text(r['full_name'])} — {r['percent']:.1f}%\n"
-    if len(rows) > 15:
-        text += f"... yana {len(rows)-15} ta"
-
-    await state.clear()
-    await message.answer(text, reply_markup=kb_admin_home(message.from_user.id))
+    if not message.document:
+        await message.answer("📎 Natijalar faylini (.csv / .xlsx) yuboring.")
+        return
+    await import_results_upload(message, state)
 
 # =========================
 # TASKS (inside group) — create draft, allow description+media in same message, publish alerts
@@ -2440,11 +4925,9 @@ async def a_g_tasks(call: CallbackQuery):
     if not await guard(call, "tasks"):
         return
     gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    tasks = conn.execute("""SELECT id, title, due_at, status FROM tasks
-                            WHERE group_id=? ORDER BY id DESC LIMIT 20""", (gid,)).fetchall()
-    conn.close()
+    g = await db_fetchone("SELECT name FROM groups WHERE id=?", (gid,))
+    tasks = await db_fetchall("""SELECT id, title, due_at, status FROM tasks
+                                 WHERE group_id=? ORDER BY id DESC LIMIT 20""", (gid,))
     if not g:
         await call.answer("Guruh topilmadi.", show_alert=True)
         return
@@ -2456,7 +4939,7 @@ async def a_g_tasks(call: CallbackQuery):
         kb_rows.append([InlineKeyboardButton(text=f"{icon} {t['title'][:18]}", callback_data=f"a:task_v:{gid}:{t['id']}")])
     kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
 
-    await safe_edit(call, f"📌 <b>{safe_pdf_text(g['name'])}</b> — Vazifalar", InlineKeyboardMarkup(inline_keyboard=kb_rows))
+    await safe_edit(call, f"📌 <b>{escape_html(g['name'])}</b> — Vazifalar", InlineKeyboardMarkup(inline_keyboard=kb_rows))
 
 @router.callback_query(F.data.startswith("a:task_new:"))
 async def a_task_new(call: CallbackQuery, state: FSMContext):
@@ -2470,7 +4953,7 @@ async def a_task_new(call: CallbackQuery, state: FSMContext):
 
 @router.message(AState.task_title)
 async def a_task_title(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tasks"):
+    if _check_access(message.from_user.id, "tasks"):
         await state.clear()
         return
     title = (message.text or "").strip()
@@ -2486,7 +4969,7 @@ async def a_task_title(message: Message, state: FSMContext):
 
 @router.message(AState.task_desc_media)
 async def a_task_desc_media(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tasks"):
+    if _check_access(message.from_user.id, "tasks"):
         await state.clear()
         return
 
@@ -2523,7 +5006,7 @@ async def a_task_desc_media(message: Message, state: FSMContext):
 
 @router.message(AState.task_points)
 async def a_task_points(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tasks"):
+    if _check_access(message.from_user.id, "tasks"):
         await state.clear()
         return
     points = safe_int((message.text or "").strip())
@@ -2536,7 +5019,7 @@ async def a_task_points(message: Message, state: FSMContext):
 
 @router.message(AState.task_due)
 async def a_task_due(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tasks"):
+    if _check_access(message.from_user.id, "tasks"):
         await state.clear()
         return
     due_s = (message.text or "").strip()
@@ -2553,16 +5036,17 @@ async def a_task_due(message: Message, state: FSMContext):
     points = int(data["points"])
     media = data.get("media", [])
 
-    conn = db()
-    cur = conn.execute("""INSERT INTO tasks(group_id, title, description, points, due_at, created_at, status)
-                          VALUES (?,?,?,?,?,?, 'draft')""",
-                       (gid, title, desc, points, due_s, now_str()))
-    task_id = cur.lastrowid
-    for m in media:
-        conn.execute("""INSERT INTO task_media(task_id, file_type, file_id) VALUES (?,?,?)""",
-                     (task_id, m["type"], m["file_id"]))
-    conn.commit()
-    conn.close()
+    def _create() -> int:
+        with DB_POOL.writer() as conn:
+            cur = conn.execute("""INSERT INTO tasks(group_id, title, description, points, due_at, created_at, status)
+                                  VALUES (?,?,?,?,?,?, 'draft')""",
+                               (gid, title, desc, points, due_s, now_str()))
+            task_id = cur.lastrowid
+            conn.executemany("""INSERT INTO task_media(task_id, file_type, file_id) VALUES (?,?,?)""",
+                             [(task_id, m["type"], m["file_id"]) for m in media])
+            return task_id
+
+    task_id = await run_db(_create)
 
     await state.clear()
 
@@ -2573,7 +5057,7 @@ async def a_task_due(message: Message, state: FSMContext):
     ])
     await message.answer(
         f"✅ Vazifa draft saqlandi.\n"
-        f"Vazifa: <b>{safe_pdf_text(title)}</b>\n"
+        f"Vazifa: <b>{escape_html(title)}</b>\n"
         f"Ball: <b>{points}</b>\n"
         f"Deadline: <code>{due_s}</code>\n\n"
         f"Endi publish qiling:",
@@ -2587,9 +5071,7 @@ async def a_task_view(call: CallbackQuery):
     _, _, gid, tid = call.data.split(":")
     gid = int(gid); tid = int(tid)
 
-    conn = db()
-    t = conn.execute("SELECT * FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    conn.close()
+    t = await db_fetchone("SELECT * FROM tasks WHERE id=? AND group_id=?", (tid, gid))
     if not t:
         await call.answer("Vazifa topilmadi.", show_alert=True)
         return
@@ -2600,11 +5082,11 @@ async def a_task_view(call: CallbackQuery):
         [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g_tasks:{gid}")],
         [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
     ])
-    text = (f"📌 <b>{safe_pdf_text(t['title'])}</b>\n"
+    text = (f"📌 <b>{escape_html(t['title'])}</b>\n"
             f"Status: <b>{t['status']}</b>\n"
             f"Ball: <b>{t['points']}</b>\n"
             f"Deadline: <code>{t['due_at']}</code>\n\n"
-            f"{safe_pdf_text(t['description'] or '')[:1500]}")
+            f"{escape_html((t['description'] or '')[:1500])}")
     await safe_edit(call, text, kb)
 
 @router.callback_query(F.data.startswith("a:task_subs:"))
@@ -2614,21 +5096,18 @@ async def a_task_subs(call: CallbackQuery):
     _, _, gid_s, tid_s = call.data.split(":", 3)
     gid = int(gid_s); tid = int(tid_s)
 
-    conn = db()
     # task title
-    t = conn.execute("SELECT id, title, points FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
+    t = await db_fetchone("SELECT id, title, points FROM tasks WHERE id=? AND group_id=?", (tid, gid))
     if not t:
-        conn.close()
         await call.answer("Vazifa topilmadi.", show_alert=True)
         return
 
-    subs = conn.execute("""SELECT ts.id AS id, ts.user_id, u.full_name, ts.submitted_at,
-                                    COALESCE(ts.score, -1) AS score
-                             FROM task_submissions ts
-                             JOIN users u ON u.user_id=ts.user_id
-                             WHERE ts.task_id=?
-                             ORDER BY ts.submitted_at DESC""", (tid,)).fetchall()
-    conn.close()
+    subs = await db_fetchall("""SELECT ts.id AS id, ts.user_id, u.full_name, ts.submitted_at,
+                                       COALESCE(ts.score, -1) AS score
+                                FROM task_submissions ts
+                                JOIN users u ON u.user_id=ts.user_id
+                                WHERE ts.task_id=?
+                                ORDER BY ts.submitted_at DESC""", (tid,))
 
     rows = []
     for s in subs:
@@ -2642,20 +5121,117 @@ async def a_task_subs(call: CallbackQuery):
     rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:task_v:{gid}:{tid}")])
     rows.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
 
-    await safe_edit(call, f"📨 <b>Topshiriqlar</b>\nVazifa: <b>{safe_pdf_text(t['title'])}</b>", InlineKeyboardMarkup(inline_keyboard=rows))
+    await safe_edit(call, f"📨 <b>Topshiriqlar</b>\nVazifa: <b>{escape_html(t['title'])}</b>", InlineKeyboardMarkup(inline_keyboard=rows))
 
 
-@router.callback_query(F.data.startswith("a:task_view:"))
-async def a_task_view_redirect(call: CallbackQuery):
-    """Back-button helper: open group menu from task context."""
+@router.callback_query(F.data.startswith("a:task_sub_v:"))
+async def a_task_sub_view(call: CallbackQuery):
     if not await guard_call(call, "tasks"):
         return
+
     try:
-        gid = int(call.data.split(":")[-1])
+        parts = call.data.split(":")
+        sub_id = int(parts[-1])
     except Exception:
         await call.answer("Noto‘g‘ri so‘rov.", show_alert=True)
         return
-    # redirect to group panel if exists, else home
+
+    row = await db_fetchone(
+        "SELECT id, task_id, user_id, msg_json, submitted_at, score, feedback "
+        "FROM task_submissions WHERE id=?",
+        (sub_id,)
+    )
+    if not row:
+        await call.answer("Topilmadi.", show_alert=True)
+        return
+
+    sub = dict(row)
+    trow = await db_fetchone("SELECT group_id, title FROM tasks WHERE id=?", (sub["task_id"],))
+    gid = int(trow["group_id"]) if trow else 0
+    ttitle = trow["title"] if trow else f"#{sub['task_id']}"
+
+    def _extract_from_msg_json(s: str):
+        try:
+            d = json.loads(s) if s else {}
+        except Exception:
+            d = {}
+        txt = d.get("text") or ""
+        cap = d.get("caption") or ""
+
+        if d.get("photo"):
+            ph = d["photo"][-1] if isinstance(d["photo"], list) else d["photo"]
+            fid = (ph or {}).get("file_id")
+            return ("photo", fid, cap or txt)
+
+        if d.get("video"):
+            fid = (d["video"] or {}).get("file_id")
+            return ("video", fid, cap or txt)
+
+        if d.get("document"):
+            fid = (d["document"] or {}).get("file_id")
+            return ("document", fid, cap or txt)
+
+        if d.get("audio"):
+            fid = (d["audio"] or {}).get("file_id")
+            return ("audio", fid, cap or txt)
+
+        if d.get("voice"):
+            fid = (d["voice"] or {}).get("file_id")
+            return ("voice", fid, cap or txt)
+
+        return ("text", None, txt or cap)
+
+    ctype, file_id, text = _extract_from_msg_json(sub.get("msg_json") or "")
+
+    header = (
+        f"📝 <b>Vazifa yuborilishi</b>\n"
+        f"Vazifa: <b>{ttitle}</b>\n"
+        f"Sub ID: <code>{sub['id']}</code>\n"
+        f"User: <code>{sub['user_id']}</code>\n"
+        f"Sana: <code>{sub.get('submitted_at','')}</code>\n"
+    )
+    if sub.get("score") is not None:
+        header += f"✅ Baholangan: <b>{sub['score']}</b> ball\n"
+    if sub.get("feedback"):
+        header += f"💬 Izoh: {sub['feedback']}\n"
+
+    # resend attachment/text to admin (separate message)
+    try:
+        if ctype == "photo" and file_id:
+            await call.message.answer_photo(file_id, caption=(text or "")[:900])
+        elif ctype == "video" and file_id:
+            await call.message.answer_video(file_id, caption=(text or "")[:900])
+        elif ctype == "document" and file_id:
+            await call.message.answer_document(file_id, caption=(text or "")[:900])
+        elif ctype == "audio" and file_id:
+            await call.message.answer_audio(file_id, caption=(text or "")[:900])
+        elif ctype == "voice" and file_id:
+            await call.message.answer_voice(file_id, caption=(text or "")[:900])
+        else:
+            if text:
+                await call.message.answer(f"🗒 Matn:\n{text}")
+    except Exception:
+        pass
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Baholash", callback_data=f"a:task_grade:{gid}:{sub['task_id']}:{sub['user_id']}:{sub_id}")],
+        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:task_subs:{gid}:{sub['task_id']}"),
+         InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")]
+    ])
+    await safe_edit(call, header, kb)
+
+
+@router.callback_query(F.data.startswith("a:task_view:"))
+async def a_task_view_redirect(call: CallbackQuery):
+    """Back-button helper: open group menu from task context."""
+    if not await guard_call(call, "tasks"):
+        return
+    try:
+        gid = int(call.data.split(":")[-1])
+    except Exception:
+        await call.answer("Noto‘g‘ri so‘rov.", show_alert=True)
+        return
+    # redirect to group panel if exists, else home
     await call.answer()
     # Prefer existing group view callback
     try:
@@ -2680,8 +5256,7 @@ async def a_task_grade_start(call: CallbackQuery, state: FSMContext):
         await call.answer("Noto‘g‘ri so‘rov.", show_alert=True)
         return
 
-    conn = db()
-    sub = conn.execute("""
+    sub = await db_fetchone("""
         SELECT ts.id,
                t.group_id AS group_id,
                ts.task_id,
@@ -2693,8 +5268,7 @@ async def a_task_grade_start(call: CallbackQuery, state: FSMContext):
         LEFT JOIN tasks t ON t.id=ts.task_id
         LEFT JOIN users u ON u.user_id=ts.user_id
         WHERE ts.id=?
-    """, (sub_id,)).fetchone()
-    conn.close()
+    """, (sub_id,))
     if not sub:
         await call.answer("Topshiriq topilmadi.", show_alert=True)
         return
@@ -2737,16 +5311,14 @@ async def a_task_grade_save(message: Message, state: FSMContext):
         await message.answer("Ball raqam bo‘lishi kerak. Masalan: 7")
         return
 
-    conn = db()
-    sub = conn.execute("""
+    sub = await db_fetchone("""
         SELECT ts.id, ts.task_id, ts.user_id, COALESCE(u.full_name,''), COALESCE(t.points,0)
         FROM task_submissions ts
         LEFT JOIN tasks t ON t.id=ts.task_id
         LEFT JOIN users u ON u.user_id=ts.user_id
         WHERE ts.id=?
-    """, (sub_id,)).fetchone()
+    """, (sub_id,))
     if not sub:
-        conn.close()
         await message.answer("Topshiriq topilmadi.")
         await state.clear()
         return
@@ -2757,27 +5329,24 @@ async def a_task_grade_save(message: Message, state: FSMContext):
         max_score = 0
     if score < 0 or (max_score > 0 and score > max_score):
         await message.answer(f"Ball 0..{max_score} oralig‘ida bo‘lsin.")
-        conn.close()
         return
 
-    conn.execute("UPDATE task_submissions SET score=?, graded_at=?, graded_by=? WHERE id=?",
-                 (score, now_str(), message.from_user.id, sub_id))
-    conn.commit()
-    conn.close()
+    def _grade():
+        with DB_POOL.writer() as conn:
+            conn.execute("UPDATE task_submissions SET score=?, graded_at=?, graded_by=? WHERE id=?",
+                         (score, now_str(), message.from_user.id, sub_id))
+            # notify student; keyed by the admin's message so a redelivered update does not DM twice
+            outbox_put(conn, "message", user_id, key=f"grade:{sub_id}:{message.chat.id}:{message.message_id}",
+                       job=f"task_grade:{task_id}",
+                       text=f"✅ <b>Topshiriq baholandi</b>\n"
+                            f"🧑‍🎓 {escape_html(full_name)}\n"
+                            f"⭐ Ball: <b>{score}</b>/{max_score}\n"
+                            f"📌 Topshiriq ID: <code>{task_id}</code>")
 
-    # Notify student (Telegram)
-    try:
-        await bot.send_message(
-            user_id,
-            f"✅ <b>Topshiriq baholandi</b>\n"
-            f"🧑‍🎓 {full_name}\n"
-            f"⭐ Ball: <b>{score}</b>/{max_score}\n"
-            f"📌 Topshiriq ID: <code>{task_id}</code>"
-        )
-    except:
-        pass
+    await run_db(_grade)
+    OUTBOX.wake()
 
-    log_admin(message.from_user.id, "task_grade", {"sub_id": sub_id, "task_id": task_id, "user_id": user_id, "score": score})
+    await run_db(log_admin, message.from_user.id, "task_grade", {"sub_id": sub_id, "task_id": task_id, "user_id": user_id, "score": score})
 
     await message.answer("✅ Baholandi.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👁️ Ko‘rish", callback_data=f"a:task_sub_v:{sub_id}")],
@@ -2799,33 +5368,32 @@ async def a_task_grade_finish(message: Message, state: FSMContext):
     if fb == "-":
         fb = ""
 
-    conn = db()
-    t = conn.execute("SELECT title, points FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    u = conn.execute("SELECT full_name FROM users WHERE user_id=?", (uid,)).fetchone()
-    if not t or not u:
-        conn.close()
-        await state.clear()
-        await message.answer("Topilmadi.", reply_markup=kb_home_admin())
+    def _grade():
+        with DB_POOL.writer() as conn:
+            t = conn.execute("SELECT title, points FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
+            sub = conn.execute("SELECT id FROM task_submissions WHERE task_id=? AND user_id=?", (tid, uid)).fetchone()
+            if not t or not sub:
+                return None
+            conn.execute("""UPDATE task_submissions
+                            SET score=?, feedback=?, graded_by=?, graded_at=?
+                            WHERE id=?""", (score, fb, message.from_user.id, now_str(), sub["id"]))
+            # notify student; keyed by the admin's message so a redelivered update does not DM twice
+            msg = (f"✅ <b>Vazifa baholandi</b>\n"
+                   f"📌 {escape_html(t['title'])}\n"
+                   f"⭐ Ball: <b>{score}/{int(t['points'])}</b>")
+            if fb:
+                msg += f"\n💬 Izoh: {escape_html(fb)}"
+            outbox_put(conn, "message", uid, key=f"grade:{tid}:{uid}:{message.chat.id}:{message.message_id}",
+                       job=f"task_grade:{tid}", text=msg)
+            return int(sub["id"])
+
+    sub_id = await run_db(_grade)
+    await state.clear()
+    if sub_id is None:
+        await message.answer("Topilmadi.", reply_markup=kb_home_admin(message.from_user.id))
         return
+    OUTBOX.wake()
 
-    conn.execute("""UPDATE task_submissions
-                    SET score=?, feedback=?, graded_by=?, graded_at=?
-                    WHERE task_id=? AND user_id=?""", (score, fb, message.from_user.id, now_str(), tid, uid))
-    conn.commit()
-    conn.close()
-
-    # Notify student (Telegram message)
-    try:
-        msg = (f"✅ <b>Vazifa baholandi</b>\n"
-               f"📌 {safe_pdf_text(t['title'])}\n"
-               f"⭐ Ball: <b>{score}/{int(t['points'])}</b>")
-        if fb:
-            msg += f"\n💬 Izoh: {safe_pdf_text(fb)}"
-        await bot.send_message(uid, msg)
-    except Exception:
-        pass
-
-    await state.clear()
     kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:task_sub_v:{sub_id}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")]])
     await message.answer("✅ Saqlandi va o‘quvchiga yuborildi.", reply_markup=kb)
 
@@ -2837,36 +5405,41 @@ async def a_task_publish(call: CallbackQuery):
     _, _, gid, tid = call.data.split(":")
     gid = int(gid); tid = int(tid)
 
-    conn = db()
-    t = conn.execute("SELECT * FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    if not t:
-        conn.close()
-        await call.answer("Vazifa topilmadi.", show_alert=True)
-        return
-    conn.execute("UPDATE tasks SET status='published' WHERE id=?", (tid,))
-    # alert members
-    members = conn.execute("SELECT user_id FROM members WHERE group_id=?", (gid,)).fetchall()
-    conn.commit()
-    conn.close()
-
-    sent = 0
-    for r in members:
-        uid = int(r["user_id"])
-        try:
-            await call.bot.send_message(
-                uid,
+    def _publish():
+        with DB_POOL.writer() as conn:
+            t = conn.execute("SELECT * FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
+            if not t:
+                return None, 0
+            conn.execute("UPDATE tasks SET status='published' WHERE id=?", (tid,))
+            g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
+            text = (
                 f"📢 <b>Yangi vazifa!</b>\n"
-                f"Guruh: <b>{safe_pdf_text(get_group_name(gid))}</b>\n"
-                f"Vazifa: <b>{safe_pdf_text(t['title'])}</b>\n"
+                f"Guruh: <b>{escape_html(g['name'] if g else gid)}</b>\n"
+                f"Vazifa: <b>{escape_html(t['title'])}</b>\n"
                 f"Ball: <b>{t['points']}</b>\n"
                 f"Deadline: <code>{t['due_at']}</code>\n\n"
                 f"Vazifani topshirish uchun: Guruhlarim → Guruh → Vazifalar"
             )
-            sent += 1
-        except:
-            pass
+            # alert members (skip users known to have blocked the bot); publishing again alerts only newcomers
+            queued = 0
+            for r in conn.execute(
+                """SELECT m.user_id FROM members m
+                     LEFT JOIN users u ON u.user_id=m.user_id
+                    WHERE m.group_id=? AND COALESCE(u.reachable, 1)=1""",
+                (gid,),
+            ).fetchall():
+                uid = int(r["user_id"])
+                queued += outbox_put(conn, "message", uid, key=f"task_pub:{tid}:{uid}", job=f"task_pub:{tid}", text=text)
+            return t, queued
+
+    t, queued = await run_db(_publish)
+    if not t:
+        await call.answer("Vazifa topilmadi.", show_alert=True)
+        return
+    OUTBOX.wake()
+    DEADLINES.schedule("task", tid, t["due_at"])
 
-    await call.answer(f"Publish ✅ (alert: {sent})", show_alert=True)
+    await call.answer(f"Publish ✅ (alert navbatda: {queued})", show_alert=True)
     await a_task_view(call)
 
 def get_group_name(gid: int) -> str:
@@ -2881,13 +5454,11 @@ async def u_tasks(call: CallbackQuery):
     uid = call.from_user.id
     gid = int(call.data.split(":")[2])
 
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    tasks = conn.execute("""SELECT id, title, due_at, points
-                            FROM tasks WHERE group_id=? AND status='published'
-                            ORDER BY id DESC LIMIT 20""", (gid,)).fetchall()
-    conn.close()
+    mem = await db_fetchone("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid))
+    g = await db_fetchone("SELECT name FROM groups WHERE id=?", (gid,))
+    tasks = await db_fetchall("""SELECT id, title, due_at, points
+                                 FROM tasks WHERE group_id=? AND status IN ('published', 'closed')
+                                 ORDER BY id DESC LIMIT 20""", (gid,))
     if not mem or not g:
         await call.answer("Bu guruh sizniki emas.", show_alert=True)
         return
@@ -2900,7 +5471,7 @@ async def u_tasks(call: CallbackQuery):
         )])
     kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"u:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")])
 
-    await safe_edit(call, f"📌 <b>{safe_pdf_text(g['name'])}</b> — Vazifalar", InlineKeyboardMarkup(inline_keyboard=kb_rows))
+    await safe_edit(call, f"📌 <b>{escape_html(g['name'])}</b> — Vazifalar", InlineKeyboardMarkup(inline_keyboard=kb_rows))
 
 @router.callback_query(F.data.startswith("u:task_v:"))
 async def u_task_view(call: CallbackQuery):
@@ -2908,11 +5479,9 @@ async def u_task_view(call: CallbackQuery):
     _, _, gid, tid = call.data.split(":")
     gid = int(gid); tid = int(tid)
 
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    t = conn.execute("SELECT * FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    sub = conn.execute("SELECT score, submitted_at FROM task_submissions WHERE task_id=? AND user_id=?", (tid, uid)).fetchone()
-    conn.close()
+    mem = await db_fetchone("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid))
+    t = await db_fetchone("SELECT * FROM tasks WHERE id=? AND group_id=?", (tid, gid))
+    sub = await db_fetchone("SELECT score, submitted_at FROM task_submissions WHERE task_id=? AND user_id=?", (tid, uid))
 
     if not mem or not t:
         await call.answer("Topilmadi.", show_alert=True)
@@ -2929,10 +5498,10 @@ async def u_task_view(call: CallbackQuery):
     btns.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"u:tasks:{gid}")])
     btns.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")])
 
-    text = (f"📌 <b>{safe_pdf_text(t['title'])}</b>\n"
+    text = (f"📌 <b>{escape_html(t['title'])}</b>\n"
             f"Ball: <b>{t['points']}</b>\n"
             f"Deadline: <code>{t['due_at']}</code>\n\n"
-            f"{safe_pdf_text(t['description'] or '')[:1500]}\n\n"
+            f"{escape_html((t['description'] or '')[:1500])}\n\n"
             f"📎 Topshirish: istalgan format (text/photo/video/audio/document/voice).")
     await safe_edit(call, text, InlineKeyboardMarkup(inline_keyboard=btns))
 
@@ -2942,11 +5511,9 @@ async def u_task_send(call: CallbackQuery, state: FSMContext):
     _, _, gid, tid = call.data.split(":")
     gid = int(gid); tid = int(tid)
 
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    sub = conn.execute("SELECT 1 FROM task_submissions WHERE task_id=? AND user_id=?", (tid, uid)).fetchone()
-    t = conn.execute("SELECT due_at FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    conn.close()
+    mem = await db_fetchone("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid))
+    sub = await db_fetchone("SELECT 1 FROM task_submissions WHERE task_id=? AND user_id=?", (tid, uid))
+    t = await db_fetchone("SELECT due_at FROM tasks WHERE id=? AND group_id=?", (tid, gid))
 
     if not mem:
         await call.answer("Bu guruh sizniki emas.", show_alert=True)
@@ -2982,11 +5549,9 @@ async def u_task_receive_any(message: Message, state: FSMContext):
     uid = message.from_user.id
 
     # verify membership + not already
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    sub = conn.execute("SELECT 1 FROM task_submissions WHERE task_id=? AND user_id=?", (tid, uid)).fetchone()
-    t = conn.execute("SELECT due_at, title FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    conn.close()
+    mem = await db_fetchone("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid))
+    sub = await db_fetchone("SELECT 1 FROM task_submissions WHERE task_id=? AND user_id=?", (tid, uid))
+    t = await db_fetchone("SELECT due_at, title FROM tasks WHERE id=? AND group_id=?", (tid, gid))
     if not mem:
         await message.answer("Bu guruh sizniki emas.")
         await state.clear()
@@ -3007,72 +5572,43 @@ async def u_task_receive_any(message: Message, state: FSMContext):
     except:
         pass
 
-    ensure_user(uid, message.from_user.full_name or "No Name")
-    full_name = get_user_name(uid)
+    await run_db(ensure_user, uid, message.from_user.full_name or "No Name")
+    full_name = await run_db(get_user_name, uid)
 
     # store full message json (for admin view)
     msg_json = message.model_dump_json(exclude_none=True)
 
-    conn = db()
-    cur = conn.execute(
-        """INSERT INTO task_submissions(task_id, user_id, full_name, submitted_at, msg_json)
-           VALUES (?,?,?,?,?)""",
-        (tid, uid, full_name, now_str(), msg_json),
-    )
-    sub_id = int(cur.lastrowid or 0)
-    conn.commit()
-
-    # Notify admins to grade (tasks perm OR super)
-    try:
-        trow = conn.execute("SELECT group_id, title FROM tasks WHERE id=?", (tid,)).fetchone()
-        gid = int(trow["group_id"]) if trow else 0
-        ttitle = trow["title"] if trow else f"#{tid}"
-        admin_rows = conn.execute(
-            """SELECT a.user_id
-                 FROM admins a
-                 LEFT JOIN admin_permissions p
-                   ON p.admin_id=a.user_id AND p.perm='tasks'
-                 WHERE a.role='super' OR COALESCE(p.enabled,0)=1"""
-        ).fetchall()
-        admin_ids = [int(r["user_id"]) for r in admin_rows] if admin_rows else []
-        if SUPER_ADMIN_ID not in admin_ids:
-            admin_ids.append(SUPER_ADMIN_ID)
-
-        alert_txt = (
-            "🆕 <b>Yangi vazifa yuborildi</b>\n"
-            f"👤 O‘quvchi: <b>{escape_html(full_name)}</b>\n"
-            f"📌 Vazifa: <b>{escape_html(ttitle)}</b>\n"
-            f"🆔 Sub ID: <code>{sub_id}</code>\n"
-            "Baholang 👇"
-        )
-        alert_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="👁️ Ko‘rish / Baholash", callback_data=f"a:task_sub_v:{sub_id}")],
-        ])
-
-        for aid in admin_ids:
-            try:
-                await bot.send_message(aid, alert_txt, reply_markup=alert_kb)
-            except Exception:
-                pass
-
-        # Also notify the group's Telegram chat if linked (optional)
-        try:
-            ginfo = conn.execute("SELECT tg_chat_id FROM groups WHERE id=?", (gid,)).fetchone()
-            tg_chat_id = int(ginfo["tg_chat_id"]) if ginfo and ginfo["tg_chat_id"] else 0
-        except Exception:
-            tg_chat_id = 0
-
-        if tg_chat_id:
-            try:
-                await bot.send_message(tg_chat_id, alert_txt, reply_markup=alert_kb)
-            except Exception:
-                pass
-    except Exception:
-                pass
-    except Exception:
-        pass
+    admin_ids = ADMIN_CACHE.with_perm("tasks")
+    if SUPER_ADMIN_ID not in admin_ids:
+        admin_ids.append(SUPER_ADMIN_ID)
+
+    def _submit():
+        with DB_POOL.writer() as conn:
+            sub_id = int(conn.execute(
+                """INSERT INTO task_submissions(task_id, user_id, full_name, submitted_at, msg_json)
+                   VALUES (?,?,?,?,?)""",
+                (tid, uid, full_name, now_str(), msg_json),
+            ).lastrowid)
+            g = conn.execute("SELECT tg_chat_id FROM groups WHERE id=?", (gid,)).fetchone()
+
+            # Notify admins to grade (tasks perm OR super), and the group's Telegram chat if linked
+            alert_txt = (
+                "🆕 <b>Yangi vazifa yuborildi</b>\n"
+                f"👤 O‘quvchi: <b>{escape_html(full_name)}</b>\n"
+                f"📌 Vazifa: <b>{escape_html(t['title'])}</b>\n"
+                f"🆔 Sub ID: <code>{sub_id}</code>\n"
+                "Baholang 👇"
+            )
+            alert_kb = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="👁️ Ko‘rish / Baholash", callback_data=f"a:task_sub_v:{sub_id}")],
+            ]).model_dump(exclude_none=True)
+            chats = list(admin_ids) + ([int(g["tg_chat_id"])] if g and g["tg_chat_id"] else [])
+            for chat_id in chats:
+                outbox_put(conn, "message", chat_id, key=f"task_sub:{sub_id}:{chat_id}", job=f"task_sub:{tid}",
+                           text=alert_txt, reply_markup=alert_kb)
 
-    conn.close()
+    await run_db(_submit)
+    OUTBOX.wake()
 
     await state.clear()
     await message.answer("✅ Vazifa qabul qilindi. Tekshiruvdan so‘ng ball qo‘yiladi.", reply_markup=kb_user_home())
@@ -3085,2257 +5621,731 @@ async def enforce_kick_limits(bot: Bot):
     If task published and due passed, and user didn't submit => missed_task_count++
     If missed_task_count >= limit => remove + kick from tg group
     """
-    conn = db()
-    # published tasks past due
-    tasks = conn.execute("""
-        SELECT id, group_id, due_at
-        FROM tasks
-        WHERE status='published'
-    """).fetchall()
-
-    for t in tasks:
-        try:
-            due = parse_dt(t["due_at"])
-        except:
-            continue
-        if datetime.now() <= due:
-            continue
+    if await run_db(_collect_task_misses):
+        OUTBOX.wake()
+
+def _collect_task_misses() -> int:
+    """DB pass of enforce_kick_limits, one write transaction, set-based:
+    - overdue = tasks still 'published' whose due_at has passed (range scan on ix_tasks_status_due);
+    - new misses = members of their groups with neither a submission nor a task_miss_log row (anti-join);
+    - counters get +N per (group, user) in one UPDATE, members over the limit are dropped;
+    - overdue tasks are closed, so every task is enforced exactly once and the next run only sees
+      deadlines that passed since (the 'published' -> 'closed' transition is the high-water mark);
+    - the warning DM (and the kick + notice for users over the limit) is queued in the outbox, keyed by
+      the new missed count so each step is announced once.
+    Returns the number of outbox rows queued."""
+    now = now_str()
+    with DB_POOL.writer() as conn:
+        conn.execute("""CREATE TEMP TABLE IF NOT EXISTS new_misses(
+                task_id INTEGER, group_id INTEGER, user_id INTEGER
+            )""")
+        conn.execute("DELETE FROM new_misses")
+        conn.execute("""
+            INSERT INTO new_misses(task_id, group_id, user_id)
+            SELECT t.id, t.group_id, m.user_id
+              FROM tasks t
+              JOIN members m ON m.group_id=t.group_id
+             WHERE t.status='published' AND t.due_at <= ? AND t.due_at GLOB '????-??-?? ??:??'
+               AND NOT EXISTS (SELECT 1 FROM task_submissions s WHERE s.task_id=t.id AND s.user_id=m.user_id)
+               AND NOT EXISTS (SELECT 1 FROM task_miss_log l
+                                WHERE l.task_id=t.id AND l.group_id=t.group_id AND l.user_id=m.user_id)
+        """, (now,))
+        conn.execute("""INSERT OR IGNORE INTO task_miss_log(task_id, group_id, user_id)
+                        SELECT task_id, group_id, user_id FROM new_misses""")
+        conn.execute("""INSERT OR IGNORE INTO counters(group_id, user_id, absent_count, missed_task_count)
+                        SELECT DISTINCT group_id, user_id, 0, 0 FROM new_misses""")
+        per_user = conn.execute("""SELECT group_id, user_id, COUNT(*) AS n
+                                     FROM new_misses GROUP BY group_id, user_id""").fetchall()
+        conn.executemany(
+            "UPDATE counters SET missed_task_count = missed_task_count + ? WHERE group_id=? AND user_id=?",
+            [(int(r["n"]), int(r["group_id"]), int(r["user_id"])) for r in per_user],
+        )
+        rows = conn.execute("""
+            SELECT c.group_id, c.user_id, c.missed_task_count AS cnt,
+                   COALESCE(g.task_miss_limit, 5) AS lim, g.tg_chat_id
+              FROM (SELECT DISTINCT group_id, user_id FROM new_misses) n
+              JOIN counters c ON c.group_id=n.group_id AND c.user_id=n.user_id
+              LEFT JOIN groups g ON g.id=n.group_id
+        """).fetchall()
+        over = [(int(r["group_id"]), int(r["user_id"])) for r in rows if int(r["cnt"]) >= int(r["lim"])]
+        conn.executemany("DELETE FROM members WHERE group_id=? AND user_id=?", over)
+        skip = {int(r[0]) for r in conn.execute(
+            "SELECT user_id FROM users WHERE reachable=0 AND user_id IN (SELECT user_id FROM new_misses)")}
+        queued, job = 0, f"task_miss:{today_str()}"
+        for r in rows:
+            gid, uid, cnt, lim = int(r["group_id"]), int(r["user_id"]), int(r["cnt"]), int(r["lim"])
+            if uid not in skip:
+                queued += outbox_put(conn, "message", uid, key=f"task_miss:{gid}:{uid}:{cnt}", job=job,
+                                     text=f"⚠️ Vazifa deadline o‘tdi va siz topshirmadingiz.\n"
+                                          f"Jarima: <b>{cnt}/{lim}</b>\n"
+                                          f"Agar limitdan oshsa guruhdan chiqarilasiz.")
+            if cnt >= lim:
+                if r["tg_chat_id"]:
+                    queued += outbox_put(conn, "kick", int(r["tg_chat_id"]), key=f"task_kick:{gid}:{uid}:{cnt}",
+                                         job=job, user_id=uid)
+                if uid not in skip:
+                    queued += outbox_put(conn, "message", uid, key=f"task_kicked:{gid}:{uid}:{cnt}", job=job,
+                                         text="⛔️ Vazifalarni bajarmagani uchun guruhdan chiqarildingiz.")
+        closed = conn.execute("""UPDATE tasks SET status='closed'
+                                  WHERE status='published' AND due_at <= ? AND due_at GLOB '????-??-?? ??:??'""",
+                              (now,)).rowcount
+        conn.execute("DELETE FROM new_misses")
+    if closed:
+        logging.info("Task enforcement: closed %d task(s), %d new miss(es)", closed, sum(int(r["n"]) for r in per_user))
+    return queued
 
-        gid = int(t["group_id"])
-        task_id = int(t["id"])
+# =========================
+# DEADLINE SCHEDULER
+# =========================
+class DeadlineScheduler:
+    """
+    Min-heap of upcoming test deadlines and task due times, fired when due instead of polled:
+    - test -> status 'finished' at tests.deadline;
+    - task -> enforce_kick_limits() at tasks.due_at (one set-based pass covers every task due by then).
+    The DB stays the durable copy: load() rebuilds the heap at startup (anything already overdue fires
+    right away) and every DEADLINE_RESYNC seconds, to catch rows edited outside the bot.
+    Handlers call schedule() after creating a test or publishing a task.
+    """
 
-        # get members
-        members = conn.execute("SELECT user_id FROM members WHERE group_id=?", (gid,)).fetchall()
-        limit_row = conn.execute("SELECT tg_chat_id, task_miss_limit FROM groups WHERE id=?", (gid,)).fetchone()
-        tg_chat_id = int(limit_row["tg_chat_id"]) if limit_row and limit_row["tg_chat_id"] else None
-        lim = int(limit_row["task_miss_limit"]) if limit_row else 5
+    def __init__(self):
+        self._heap: list = []
+        self._due: dict = {}  # (kind, key) -> due datetime; heap entries that don't match are stale
+        self._wake: Optional[asyncio.Event] = None
+        self.fired = 0
 
-        for m in members:
-            uid = int(m["user_id"])
-            sub = conn.execute("SELECT 1 FROM task_submissions WHERE task_id=? AND user_id=?", (task_id, uid)).fetchone()
-            if sub:
-                continue
+    def schedule(self, kind: str, key, due_s: Optional[str]) -> None:
+        try:
+            due = parse_dt(due_s)
+        except Exception:
+            return
+        if self._due.get((kind, key)) == due:
+            return
+        self._due[(kind, key)] = due
+        heapq.heappush(self._heap, (due, kind, key))
+        if self._wake is not None:
+            self._wake.set()
 
-            # increment missed_task_count once per task per user: we can mark via a pseudo row in submissions? simplest: use attendance table? We'll use a special log table quickly:
-            conn.execute("""CREATE TABLE IF NOT EXISTS task_miss_log(
-                task_id INTEGER, group_id INTEGER, user_id INTEGER,
-                UNIQUE(task_id, group_id, user_id)
-            )""")
-            already = conn.execute("SELECT 1 FROM task_miss_log WHERE task_id=? AND group_id=? AND user_id=?",
-                                   (task_id, gid, uid)).fetchone()
-            if already:
+    @staticmethod
+    def _pending_rows() -> List[Tuple[str, object, str]]:
+        with db() as conn:
+            tests = conn.execute("""SELECT test_id, deadline FROM tests
+                                    WHERE status!='finished' AND deadline IS NOT NULL AND deadline!=''""").fetchall()
+            tasks = conn.execute("SELECT id, due_at FROM tasks WHERE status='published'").fetchall()
+        return ([("test", r["test_id"], r["deadline"]) for r in tests] +
+                [("task", int(r["id"]), r["due_at"]) for r in tasks])
+
+    async def load(self) -> None:
+        rows = await run_db(self._pending_rows)
+        self._heap, self._due = [], {}
+        for kind, key, due_s in rows:
+            self.schedule(kind, key, due_s)
+
+    async def reload(self) -> None:
+        """Rebuild the heap now (after a DB restore) and let run() pick up the new next deadline."""
+        await self.load()
+        if self._wake is not None:
+            self._wake.set()
+
+    def _pop_due(self) -> Tuple[List[str], bool]:
+        now = datetime.now()
+        tests, tasks = [], False
+        while self._heap and self._heap[0][0] <= now:
+            due, kind, key = heapq.heappop(self._heap)
+            if self._due.get((kind, key)) != due:
                 continue
-
-            conn.execute("INSERT OR IGNORE INTO task_miss_log(task_id, group_id, user_id) VALUES (?,?,?)",
-                         (task_id, gid, uid))
-            conn.execute("INSERT OR IGNORE INTO counters(group_id, user_id, absent_count, missed_task_count) VALUES (?,?,0,0)",
-                         (gid, uid))
-            conn.execute("UPDATE counters SET missed_task_count = missed_task_count + 1 WHERE group_id=? AND user_id=?",
-                         (gid, uid))
-            row = conn.execute("SELECT missed_task_count FROM counters WHERE group_id=? AND user_id=?",
-                               (gid, uid)).fetchone()
-            cnt = int(row["missed_task_count"]) if row else 0
-
-            # alert DM
+            del self._due[(kind, key)]
+            if kind == "test":
+                tests.append(key)
+            else:
+                tasks = True
+        return tests, tasks
+
+    async def _fire(self, bot: Bot, tests: List[str], tasks: bool) -> None:
+        if tests:
+            await run_db(self._finish_tests, tests)
+        if tasks:
+            await enforce_kick_limits(bot)
+        self.fired += len(tests) + int(tasks)
+
+    @staticmethod
+    def _finish_tests(test_ids: List[str]) -> None:
+        with DB_POOL.writer() as conn:
+            conn.executemany("UPDATE tests SET status='finished' WHERE test_id=? AND status!='finished'",
+                             [(t,) for t in test_ids])
+
+    async def run(self, bot: Bot):
+        self._wake = asyncio.Event()
+        next_sync = 0.0
+        while True:
+            self._wake.clear()
             try:
-                await bot.send_message(uid, f"⚠️ Vazifa deadline o‘tdi va siz topshirmadingiz.\n"
-                                            f"Jarima: <b>{cnt}/{lim}</b>\n"
-                                            f"Agar limitdan oshsa guruhdan chiqarilasiz.")
-            except:
+                if time.monotonic() >= next_sync:
+                    await self.load()
+                    next_sync = time.monotonic() + DEADLINE_RESYNC
+                tests, tasks = self._pop_due()
+                if tests or tasks:
+                    await self._fire(bot, tests, tasks)
+            except Exception:
+                logging.exception("Deadline scheduler tick failed")
+            timeout = next_sync - time.monotonic()
+            if self._heap:
+                timeout = min(timeout, (self._heap[0][0] - datetime.now()).total_seconds())
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(0.0, timeout))
+            except asyncio.TimeoutError:
                 pass
 
-            # kick if exceeded
-            if cnt >= lim:
-                conn.execute("DELETE FROM members WHERE group_id=? AND user_id=?", (gid, uid))
-                if tg_chat_id:
-                    try:
-                        await bot.ban_chat_member(chat_id=tg_chat_id, user_id=uid)
-                        await bot.unban_chat_member(chat_id=tg_chat_id, user_id=uid)
-                    except:
-                        pass
-                try:
-                    await bot.send_message(uid, "⛔️ Vazifalarni bajarmagani uchun guruhdan chiqarildingiz.")
-                except:
-                    pass
+    def stats(self) -> dict:
+        nxt = min(self._due.values()) if self._due else None
+        return {"pending": len(self._due), "fired": self.fired,
+                "next": nxt.strftime("%Y-%m-%d %H:%M") if nxt else "—"}
 
-    conn.commit()
-    conn.close()
+
+DEADLINES = DeadlineScheduler()
 
 # =========================
-# GLOBAL BROADCAST (text + media)
+# DELIVERY LOG / REACHABILITY
 # =========================
-@router.callback_query(F.data == "a:broadcast")
-async def a_broadcast(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "broadcast"):
-        return
-    await state.clear()
-    await safe_edit(call, "📢 Barcha userlarga yuboriladigan xabarni yuboring (text yoki media). Bekor: /cancel", kb_home_admin(call.from_user.id))
-    await state.set_state(AState.broadcast_any)
+# Every fan-out (broadcast, task publish, attendance DMs, kick notices) records one deliveries row per
+# recipient. Forbidden / "chat not found" flips users.reachable to 0 and later fan-outs skip that user.
+# The flag returns to 1 as soon as the user writes to the bot again (ensure_user).
+
+def classify_send_error(e: Exception) -> Tuple[str, str]:
+    """(status, error_code) of a failed send; 'blocked' means the user cannot be reached at all."""
+    if isinstance(e, TelegramForbiddenError):
+        return "blocked", "forbidden"
+    if isinstance(e, TelegramBadRequest) and "chat not found" in str(e).lower():
+        return "blocked", "chat_not_found"
+    if isinstance(e, TelegramRetryAfter):
+        return "failed", "retry_after"
+    return "failed", type(e).__name__
+
+
+class DeliveryLog:
+    """Outcomes of one fan-out job, written in a single transaction by flush()."""
+
+    def __init__(self, job: str):
+        self.job = job
+        self.rows: List[Tuple[int, str, Optional[str]]] = []
+        self.counts = {"sent": 0, "blocked": 0, "failed": 0}
+
+    def add(self, uid: int, status: str, error_code: Optional[str] = None) -> None:
+        self.rows.append((int(uid), status, error_code))
+        self.counts[status] = self.counts.get(status, 0) + 1
+
+    async def send(self, uid: int, coro) -> bool:
+        """Await a Bot send call for `uid` and record the outcome; never raises."""
+        try:
+            await coro
+        except Exception as e:
+            self.add(uid, *classify_send_error(e))
+            return False
+        self.add(uid, "sent")
+        return True
 
-@router.message(AState.broadcast_any)
-async def a_broadcast_send(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "broadcast"):
-        await state.clear()
-        return
-    conn = db()
-    users = conn.execute("SELECT user_id FROM users").fetchall()
-    conn.close()
+    def _flush(self, rows) -> None:
+        ts = now_str()
+        blocked = [(ts, uid) for uid, status, _ in rows if status == "blocked"]
+        with DB_POOL.writer() as conn:
+            conn.executemany(
+                "INSERT INTO deliveries(user_id, job, status, error_code, created_at) VALUES (?,?,?,?,?)",
+                [(uid, self.job, status, code, ts) for uid, status, code in rows],
+            )
+            if blocked:
+                conn.executemany("UPDATE users SET reachable=0, unreachable_at=? WHERE user_id=?", blocked)
+
+    async def flush(self) -> None:
+        rows, self.rows = self.rows, []
+        if rows:
+            await run_db(self._flush, rows)
+
+    async def record(self, uid: int, status: str, error_code: Optional[str] = None) -> None:
+        """Write one outcome right away (jobs that resume after a restart must not repeat a send)."""
+        self.counts[status] = self.counts.get(status, 0) + 1
+        await run_db(self._flush, [(int(uid), status, error_code)])
+
+
+def unreachable_ids(uids) -> set:
+    """Subset of `uids` known to have blocked the bot (or deleted their account)."""
+    uids = [int(u) for u in uids]
+    out = set()
+    with db() as conn:
+        for i in range(0, len(uids), 500):
+            chunk = uids[i:i + 500]
+            q = ",".join("?" * len(chunk))
+            out.update(int(r["user_id"]) for r in conn.execute(
+                f"SELECT user_id FROM users WHERE reachable=0 AND user_id IN ({q})", chunk))
+    return out
 
-    sent = 0
-    for r in users:
-        uid = int(r["user_id"])
-        try:
-            # copy message (works for text & most media)
-            await message.copy_to(chat_id=uid)
-            sent += 1
-        except:
-            pass
 
-    await state.clear()
-    await message.answer(f"✅ Yuborildi: {sent} ta", reply_markup=kb_admin_home(message.from_user.id))
+def reach_report() -> str:
+    with db() as conn:
+        u = conn.execute("SELECT COUNT(*) AS n, COALESCE(SUM(reachable=0), 0) AS off FROM users").fetchone()
+        jobs = conn.execute(
+            """SELECT job, COUNT(*) AS n,
+                      SUM(status='sent') AS sent, SUM(status='blocked') AS blocked, SUM(status='failed') AS failed,
+                      MAX(created_at) AS last_at
+                 FROM deliveries
+                GROUP BY job
+                ORDER BY MAX(id) DESC
+                LIMIT 10"""
+        ).fetchall()
+    n, off = int(u["n"] or 0), int(u["off"] or 0)
+    pct = (n - off) * 100.0 / n if n else 100.0
+    lines = [
+        "📶 <b>Yetib borish</b>",
+        f"👥 Userlar: <b>{n}</b>",
+        f"✅ Yetib boradi: <b>{n - off}</b> ({pct:.1f}%)",
+        f"🚫 Bloklagan / o‘chgan: <b>{off}</b>",
+        "",
+        "<b>Oxirgi yuborishlar</b>",
+    ]
+    if not jobs:
+        lines.append("—")
+    for j in jobs:
+        rate = int(j["sent"] or 0) * 100.0 / int(j["n"]) if j["n"] else 0.0
+        lines.append(f"• <code>{escape_html(j['job'])}</code> — {j['sent']}/{j['n']} ({rate:.0f}%), "
+                     f"🚫 {j['blocked']}, ⚠️ {j['failed']} · {escape_html(j['last_at'])}")
+    return "\n".join(lines)
 
-# =========================
-# ADMIN: ADMINS (super only) minimal
-# =========================
-@router.callback_query(F.data == "a:admins")
-async def a_admins(call: CallbackQuery):
-    if not is_super(call.from_user.id):
-        await call.answer("Faqat super admin.", show_alert=True)
+
+@router.message(Command("reach"))
+async def cmd_reach(message: Message):
+    """Reach rates: reachable users and per-job delivery outcomes."""
+    if not await guard_msg(message, "broadcast"):
         return
-    conn = db()
-    admins = conn.execute("SELECT user_id, role FROM admins ORDER BY role DESC").fetchall()
-    conn.close()
-    text = "👮 <b>Adminlar</b>\n\n" + "\n".join([f"• <code>{a['user_id']}</code> — {a['role']}" for a in admins])
-    await safe_edit(call, text, InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")]]))
+    await message.reply(await run_db(reach_report))
 
-# =========================
-# CANCEL command
-# =========================
-@router.message(Command("cancel"))
-async def cmd_cancel(message: Message, state: FSMContext):
+
+@router.callback_query(F.data == "a:reach")
+async def a_reach(call: CallbackQuery, state: FSMContext):
+    if not await guard(call, "broadcast"):
+        return
     await state.clear()
-    uid = message.from_user.id
-    if is_admin(uid):
-        await message.answer("Bekor qilindi.", reply_markup=kb_admin_home(uid))
-    else:
-        await message.answer("Bekor qilindi.", reply_markup=kb_user_home())
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬅️ Ortga", callback_data="a:broadcast"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
+    ])
+    await safe_edit(call, await run_db(reach_report), kb)
+
 
 # =========================
-# STARTUP TASKS
+# OUTBOX (durable Telegram side effects)
 # =========================
-async def on_startup(bot: Bot):
-    # periodic enforcement (kick limits, missed tasks, etc.)
-    async def loop_kick():
-        while True:
+# Handlers never await a fan-out. They add outbox rows with outbox_put() inside the same transaction as
+# the change that causes them (task published, day finalized, member removed ...), and OUTBOX sends them
+# in the background behind BROADCAST_LIMITER. Each row is claimed ('sending'), sent, then marked
+# 'sent' / 'blocked' / 'failed' together with its deliveries row, so a restart or a RetryAfter loses
+# nothing; only a crash between Telegram accepting a send and that mark can repeat it (rows still
+# 'sending' are released on the next start). A dedupe_key stays reserved until the row is purged.
+
+def outbox_put(conn: sqlite3.Connection, kind: str, chat_id: int, *, key: Optional[str] = None,
+               job: Optional[str] = None, **payload) -> int:
+    """Queue one side effect in the caller's transaction: kind 'message' (text, optional reply_markup as
+    an InlineKeyboardMarkup.model_dump()), 'kick' (user_id) or 'document' (path, filename, caption,
+    cleanup). 1 if queued, 0 if `key` is already in the outbox."""
+    now = time.time()
+    return conn.execute(
+        "INSERT OR IGNORE INTO outbox(dedupe_key, kind, chat_id, payload, job, next_at, created_at) VALUES (?,?,?,?,?,?,?)",
+        (key, kind, int(chat_id), json.dumps(payload, ensure_ascii=False, separators=(",", ":")), job, now, now),
+    ).rowcount
+
+
+class Outbox:
+    """Worker pool draining the outbox table; wake() after committing new rows to skip the poll delay."""
+
+    # errors a retry will not fix
+    _FINAL = (TelegramBadRequest, TelegramForbiddenError, OSError, ValueError, KeyError)
+
+    def __init__(self, workers: int, max_attempts: int, batch: int = 50, poll: float = 5.0):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.batch = batch
+        self.poll = poll
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.counts = {"sent": 0, "blocked": 0, "failed": 0, "retried": 0}
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def start(self, bot: Bot) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Finish the batch in flight and stop claiming; whatever is left stays in the table."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self.wake()
+        try:
+            # wait_for cancels the loop if the batch does not finish in time; its rows stay 'sending'
+            await asyncio.wait_for(self._task, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        self._task = None
+
+    def _release(self) -> int:
+        with DB_POOL.writer() as conn:
+            return conn.execute("UPDATE outbox SET status='pending' WHERE status='sending'").rowcount
+
+    def _claim(self) -> List[dict]:
+        with DB_POOL.writer() as conn:
+            rows = conn.execute("""
+                UPDATE outbox SET status='sending', attempts = attempts + 1
+                 WHERE id IN (SELECT id FROM outbox WHERE status='pending' AND next_at <= ?
+                               ORDER BY next_at, id LIMIT ?)
+                RETURNING id, kind, chat_id, payload, job, attempts
+            """, (time.time(), self.batch)).fetchall()
+        return sorted((dict(r) for r in rows), key=lambda r: r["id"])
+
+    def _finish(self, row: dict, status: str, code: Optional[str], delay: float) -> None:
+        now = time.time()
+        path = None
+        with DB_POOL.writer() as conn:
+            if status == "retry":
+                # RetryAfter is Telegram pacing us, not a failure of this row
+                back = 1 if code == "retry_after" else 0
+                conn.execute("UPDATE outbox SET status='pending', attempts = attempts - ?, next_at=?, error=? WHERE id=?",
+                             (back, now + delay, code, row["id"]))
+                return
+            conn.execute("UPDATE outbox SET status=?, done_at=?, error=? WHERE id=?", (status, now, code, row["id"]))
+            uid = int(row["chat_id"])
+            if row["kind"] != "kick" and uid > 0:
+                conn.execute("INSERT INTO deliveries(user_id, job, status, error_code, created_at) VALUES (?,?,?,?,?)",
+                             (uid, row["job"] or row["kind"], status, code, now_str()))
+                if status == "blocked":
+                    conn.execute("UPDATE users SET reachable=0, unreachable_at=? WHERE user_id=?", (now_str(), uid))
+            p = json.loads(row["payload"] or "{}")
+            if row["kind"] == "document" and p.get("cleanup"):
+                left = conn.execute("""SELECT 1 FROM outbox WHERE kind='document' AND status IN ('pending', 'sending')
+                                        AND json_extract(payload, '$.path')=? LIMIT 1""", (p["path"],)).fetchone()
+                if not left:
+                    path = p["path"]
+        if path:
             try:
-                await enforce_kick_limits(bot)
-            except Exception:
+                os.remove(path)
+            except OSError:
                 pass
-            await asyncio.sleep(300)
 
-    # daily DB backup to admins at 06:00 Asia/Samarkand
-    async def loop_daily_backup():
-        while True:
+    def _next_due(self) -> Optional[float]:
+        r = _fetchone("SELECT MIN(next_at) FROM outbox WHERE status='pending'")
+        return r[0] if r else None
+
+    def _purge(self) -> int:
+        with DB_POOL.writer() as conn:
+            return conn.execute("DELETE FROM outbox WHERE status IN ('sent', 'blocked', 'failed', 'cancelled') AND done_at < ?",
+                                (time.time() - OUTBOX_KEEP_DAYS * 86400,)).rowcount
+
+    async def _deliver(self, bot: Bot, kind: str, chat_id: int, p: dict) -> None:
+        if kind == "message":
+            kb = p.get("reply_markup")
+            await bot.send_message(chat_id, p["text"], reply_markup=InlineKeyboardMarkup.model_validate(kb) if kb else None)
+        elif kind == "kick":
+            await bot.ban_chat_member(chat_id=chat_id, user_id=int(p["user_id"]))
+            await bot.unban_chat_member(chat_id=chat_id, user_id=int(p["user_id"]))
+        elif kind == "document":
+            await bot.send_document(chat_id, FSInputFile(p["path"], filename=p.get("filename")), caption=p.get("caption"))
+        else:
+            raise ValueError(f"unknown outbox kind {kind!r}")
+
+    async def _send(self, bot: Bot, sem: asyncio.Semaphore, row: dict) -> None:
+        async with sem:
+            await BROADCAST_LIMITER.acquire()
+            status, code, delay = "sent", None, 0.0
+            try:
+                await self._deliver(bot, row["kind"], int(row["chat_id"]), json.loads(row["payload"] or "{}"))
+            except TelegramRetryAfter as e:
+                BROADCAST_LIMITER.pause(e.retry_after)
+                status, code, delay = "retry", "retry_after", float(e.retry_after)
+            except Exception as e:
+                status, code = classify_send_error(e)
+                if status == "failed" and not isinstance(e, self._FINAL) and row["attempts"] < self.max_attempts:
+                    status, delay = "retry", min(600.0, 5.0 * 2 ** row["attempts"])
+            self.counts["retried" if status == "retry" else status] += 1
             try:
-                wait_s = seconds_until_local_time("Asia/Samarkand", 6, 0)
-                await asyncio.sleep(wait_s)
-                await send_db_backup_to_admins(bot, reason="daily 06:00")
+                await run_db(self._finish, row, status, code, delay)
             except Exception:
-                # if something fails, don't crash the bot
-                await asyncio.sleep(300)
-
-    asyncio.create_task(loop_kick())
-    asyncio.create_task(loop_daily_backup())
-
-
-@router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext):
-    await state.clear()
-    uid = message.from_user.id
-
-    # ensure user row exists
-    conn = db()
-    u = conn.execute("SELECT full_name FROM users WHERE user_id=?", (uid,)).fetchone()
-    conn.close()
-
-    if not u:
-        # ask name (first time)
-        await message.answer(
-            "👋 Salom! Ism va familiyangizni kiriting (masalan: Ali Valiyev):"
-        )
-        await state.set_state(UState.reg_name)
-        return
-
-    # admin or user panel
-    if is_admin(uid):
-        await message.answer("⚙️ <b>Admin panel</b>", reply_markup=kb_admin_home(uid))
-    else:
-        await message.answer(f"👋 Salom, <b>{safe_pdf_text(u['full_name'])}</b>!", reply_markup=kb_user_home())
-
-@router.message(UState.reg_name)
-async def reg_name(message: Message, state: FSMContext):
-    name = (message.text or "").strip()
-    if len(name) < 3:
-        await message.answer("Iltimos, ism-familiyani to‘liq yozing:")
-        return
-    ensure_user(message.from_user.id, name)
-    await state.clear()
-    await message.answer("✅ Saqlandi! Asosiy menyu:", reply_markup=kb_user_home())
-
-# =========================
-# USER HOME NAV
-# =========================
-@router.callback_query(F.data == "u:home")
-async def u_home(call: CallbackQuery, state: FSMContext):
-    await state.clear()
-    await safe_edit(call, "🏠 <b>Menyu</b>", kb_user_home())
-
-@router.callback_query(F.data == "a:home")
-async def a_home(call: CallbackQuery, state: FSMContext):
-    await state.clear()
-    uid = call.from_user.id
-    if not is_admin(uid):
-        await call.answer("Ruxsat yo‘q.", show_alert=True)
-        return
-    await safe_edit(call, "🏠 <b>Admin panel</b>", kb_admin_home(uid))
-
-@router.callback_query(F.data == "a:as_user")
-async def a_as_user(call: CallbackQuery, state: FSMContext):
-    await state.clear()
-    uid = call.from_user.id
-    if not is_admin(uid):
-        await call.answer("Ruxsat yo‘q.", show_alert=True)
-        return
-    kb = kb_user_home()
-    kb.inline_keyboard.append([InlineKeyboardButton(text="🔙 Admin panel", callback_data="a:home")])
-    await safe_edit(call, "👤 User rejimi", kb)
-
-# =========================
-# USER: join group
-# =========================
-@router.callback_query(F.data == "u:join")
-async def u_join(call: CallbackQuery, state: FSMContext):
-    await state.clear()
-    await safe_edit(call, "🔑 Guruh kodini kiriting (masalan: 1234AB):", kb_home_user())
-    await state.set_state(UState.join_code)
-
-@router.message(UState.join_code)
-async def u_join_code(message: Message, state: FSMContext):
-    code = (message.text or "").upper().strip()
-    if not re.fullmatch(r"\d{4}[A-H]{2}", code):
-        await message.answer("❌ Kod formati xato. Masalan: 1234AB")
-        return
-    uid = message.from_user.id
-    ensure_user(uid, message.from_user.full_name or "No Name")
-
-    conn = db()
-    g = conn.execute("SELECT id, name FROM groups WHERE invite_code=?", (code,)).fetchone()
-    if not g:
-        conn.close()
-        await message.answer("❌ Guruh topilmadi. Kodni tekshiring.")
-        return
-    exists = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (g["id"], uid)).fetchone()
-    if not exists:
-        conn.execute("INSERT INTO members(group_id, user_id) VALUES (?,?)", (g["id"], uid))
-        conn.execute("INSERT OR IGNORE INTO counters(group_id, user_id, absent_count, missed_task_count) VALUES (?,?,0,0)",
-                     (g["id"], uid))
-        conn.commit()
-    conn.close()
-
-    await state.clear()
-    await message.answer(f"✅ <b>{safe_pdf_text(g['name'])}</b> guruhiga qo‘shildingiz.", reply_markup=kb_user_home())
-
-def user_groups(uid: int) -> List[Tuple[int, str]]:
-    conn = db()
-    rows = conn.execute("""
-        SELECT g.id, g.name
-        FROM members m JOIN groups g ON g.id=m.group_id
-        WHERE m.user_id=?
-        ORDER BY g.name
-    """, (uid,)).fetchall()
-    conn.close()
-    return [(int(r["id"]), r["name"]) for r in rows]
-
-# =========================
-# USER: My groups & tests (INLINE)
-# =========================
-@router.callback_query(F.data == "u:mygroups")
-async def u_mygroups(call: CallbackQuery):
-    uid = call.from_user.id
-    groups = user_groups(uid)
-    if not groups:
-        await safe_edit(call, "Siz hech qaysi guruhda emassiz.", kb_user_home())
-        return
-
-    kb_rows = []
-    for gid, name in groups:
-        kb_rows.append([InlineKeyboardButton(text=f"📌 {name}", callback_data=f"u:g:{gid}")])
-    kb_rows.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")])
-    await safe_edit(call, "📚 <b>Guruhlarim</b>\nGuruhni tanlang:", InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-@router.callback_query(F.data.startswith("u:g:"))
-async def u_group_view(call: CallbackQuery):
-    uid = call.from_user.id
-    gid = int(call.data.split(":")[2])
-
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
-    if not mem or not g:
-        await call.answer("Bu guruh sizniki emas.", show_alert=True)
-        return
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🧪 Guruh testlari", callback_data=f"u:gt:{gid}")],
-        [InlineKeyboardButton(text="📌 Vazifalar", callback_data=f"u:tasks:{gid}")],
-        [InlineKeyboardButton(text="⬅️ Ortga", callback_data="u:mygroups")],
-        [InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")],
-    ])
-    await safe_edit(call, f"📌 <b>{safe_pdf_text(g['name'])}</b>\nQuyidan bo‘lim tanlang:", kb)
-
-# =========================
-# USER: group tests list
-# =========================
-def tests_for_user_in_group(uid: int, gid: int) -> List[sqlite3.Row]:
-    conn = db()
-    # allowed: public OR assigned to this group
-    rows = conn.execute("""
-        SELECT t.test_id, t.status, t.deadline, COALESCE(t.is_public,0) AS is_public
-        FROM tests t
-        LEFT JOIN test_groups tg ON tg.test_id=t.test_id
-        WHERE (COALESCE(t.is_public,0)=1) OR (tg.group_id=?)
-        GROUP BY t.test_id
-        ORDER BY t.created_at DESC
-    """, (gid,)).fetchall()
-    conn.close()
-    return rows
-
-@router.callback_query(F.data.startswith("u:gt:"))
-async def u_group_tests(call: CallbackQuery):
-    uid = call.from_user.id
-    gid = int(call.data.split(":")[2])
-
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
-    if not mem or not g:
-        await call.answer("Bu guruh sizniki emas.", show_alert=True)
-        return
-
-    rows = tests_for_user_in_group(uid, gid)
-    if not rows:
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"u:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")]])
-        await safe_edit(call, "Bu guruhda hozircha test yo‘q.", kb)
-        return
-
-    kb_rows = []
-    for r in rows[:30]:
-        status, dl = ensure_deadline(r["test_id"])
-        icon = "🟢" if status == "active" else "⏸" if status == "paused" else "🏁"
-        kb_rows.append([InlineKeyboardButton(
-            text=f"{icon} {r['test_id']} ({status})",
-            callback_data=f"u:solve_tid:{r['test_id']}"
-        )])
-    kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"u:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")])
-    await safe_edit(call, f"🧪 <b>{safe_pdf_text(g['name'])}</b> — Testlar:", InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-# =========================
-# USER: Solve test (by id from list or manual)
-# =========================
-@router.callback_query(F.data == "u:solve")
-async def u_solve(call: CallbackQuery, state: FSMContext):
-    await state.clear()
-    await safe_edit(call, "📝 Test ID kiriting (masalan: 12345):", kb_home_user())
-    await state.set_state(UState.solve_tid)
-
-@router.callback_query(F.data.startswith("u:solve_tid:"))
-async def u_solve_from_button(call: CallbackQuery, state: FSMContext):
-    await state.clear()
-    tid = call.data.split(":")[2]
-    await state.update_data(tid=tid)
-    await safe_edit(call, f"📝 Test <code>{tid}</code>\nJavoblarni yuboring (A/B/C/D). Masalan: ABCDAB...", kb_home_user())
-    await state.set_state(UState.solve_answers)
-
-@router.message(UState.solve_tid)
-async def u_solve_tid_msg(message: Message, state: FSMContext):
-    tid = (message.text or "").strip()
-    status, deadline = ensure_deadline(tid)
-    if status is None:
-        await message.answer("❌ Test topilmadi.")
-        return
-    if status == "paused":
-        await message.answer("⏸ Test vaqtincha to‘xtatilgan.")
-        await state.clear()
-        return
-    if status == "finished":
-        await message.answer("🏁 Test yakunlangan (deadline o‘tgan yoki yakunlangan).")
-        await state.clear()
-        return
-
-    # allow if public OR assigned to any of user's groups
-    uid = message.from_user.id
-    conn = db()
-    pub = conn.execute("SELECT COALESCE(is_public,0) AS p FROM tests WHERE test_id=?", (tid,)).fetchone()
-    if pub and int(pub["p"]) == 1:
-        allowed = True
-    else:
-        gids = conn.execute("SELECT group_id FROM members WHERE user_id=?", (uid,)).fetchall()
-        if not gids:
-            allowed = False
-        else:
-            myg = [int(x["group_id"]) for x in gids]
-            tg = conn.execute("SELECT group_id FROM test_groups WHERE test_id=?", (tid,)).fetchall()
-            allowed_set = {int(x["group_id"]) for x in tg}
-            allowed = any(g in allowed_set for g in myg)
-    # anti-cheat
-    already = conn.execute("SELECT 1 FROM submissions WHERE user_id=? AND test_id=?", (uid, tid)).fetchone()
-    keys = conn.execute("SELECT keys FROM tests WHERE test_id=?", (tid,)).fetchone()
-    conn.close()
-
-    if not allowed:
-        await message.answer("❌ Bu test sizga biriktirilmagan (public emas va guruhingizda yo‘q).")
-        await state.clear()
-        return
-    if already:
-        await message.answer("⚠️ Siz bu testni 1 marta topshirib bo‘lgansiz.")
-        await state.clear()
-        return
-    if not keys:
-        await message.answer("❌ Test topilmadi.")
-        await state.clear()
-        return
-
-    await state.update_data(tid=tid, keys=keys["keys"])
-    await message.answer(f"✅ Test topildi. Savollar: {len(keys['keys'])} ta.\nJavoblarni yuboring (A/B/C/D).")
-    await state.set_state(UState.solve_answers)
-
-@router.message(UState.solve_answers)
-async def u_solve_answers(message: Message, state: FSMContext):
-    data = await state.get_data()
-    tid = data.get("tid")
-    keys = data.get("keys", "")
-
-    status, _ = ensure_deadline(tid)
-    if status != "active":
-        await message.answer("⛔️ Test tugagan yoki pauzada.")
-        await state.clear()
-        return
-
-    ans = (message.text or "").upper().strip().replace(" ", "")
-    if (not ans) or any(ch not in "ABCD" for ch in ans):
-        await message.answer("⚠️ Faqat A/B/C/D bo‘lsin.")
-        return
-    if len(ans) != len(keys):
-        await message.answer(f"⚠️ Javoblar soni {len(keys)} ta bo‘lishi kerak.")
-        return
-
-    uid = message.from_user.id
-    ensure_user(uid, message.from_user.full_name or "No Name")
-    full_name = get_user_name(uid)
-
-    conn = db()
-    # anti-cheat
-    already = conn.execute("SELECT 1 FROM submissions WHERE user_id=? AND test_id=?", (uid, tid)).fetchone()
-    if already:
-        conn.close()
-        await message.answer("⚠️ Siz bu testni topshirib bo‘lgansiz.")
-        await state.clear()
-        return
-
-    score = sum(1 for a, k in zip(ans, keys) if a == k)
-    total = len(keys)
-    pct = (score / total) * 100 if total else 0.0
-
-    conn.execute("""INSERT INTO submissions(user_id, test_id, answers, submitted_at)
-                    VALUES (?,?,?,?)""", (uid, tid, ans, now_str()))
-    conn.execute("""INSERT INTO results(user_id, test_id, score, total, percent, date, full_name)
-                    VALUES (?,?,?,?,?,?,?)""", (uid, tid, score, total, pct, now_str(), full_name))
-    conn.commit()
-    conn.close()
-
-    await state.clear()
-    await message.answer(
-        f"✅ <b>Natija</b>\nTest: <code>{tid}</code>\nBall: <b>{score}/{total}</b>\nFoiz: <b>{pct:.1f}%</b>",
-        reply_markup=kb_user_home()
-    )
-
-# =========================
-# USER: my results
-# =========================
-@router.callback_query(F.data == "u:myresults")
-async def u_myresults(call: CallbackQuery):
-    uid = call.from_user.id
-    conn = db()
-    rows = conn.execute("""SELECT test_id, score, total, percent, date
-                           FROM results WHERE user_id=?
-                           ORDER BY id DESC LIMIT 15""", (uid,)).fetchall()
-    conn.close()
-    if not rows:
-        await safe_edit(call, "Sizda hali natija yo‘q.", kb_user_home())
-        return
-
-    text = "📄 <b>Natijalarim</b>\n\n"
-    for i, r in enumerate(rows, 1):
-        text += f"{i}) <code>{r['test_id']}</code> — <b>{r['score']}/{r['total']}</b> ({r['percent']:.1f}%) | {r['date']}\n"
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")]
-    ])
-    await safe_edit(call, text, kb)
-
-# =========================
-# ADMIN: GROUPS LIST / CREATE / VIEW
-# =========================
-@router.callback_query(F.data == "a:groups")
-async def a_groups(call: CallbackQuery):
-    if not await guard(call, "groups"):
-        return
-    conn = db()
-    groups = conn.execute("SELECT id, name, invite_code FROM groups ORDER BY id DESC").fetchall()
-    conn.close()
-
-    kb_rows = []
-    for g in groups:
-        kb_rows.append([InlineKeyboardButton(text=f"📁 {g['name']}", callback_data=f"a:g:{g['id']}")])
-    kb_rows.append([InlineKeyboardButton(text="➕ Guruh yaratish", callback_data="a:g_add")])
-    kb_rows.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
-
-    await safe_edit(call, "👥 <b>Guruhlar</b>", InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-@router.callback_query(F.data == "a:g_add")
-async def a_g_add(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "groups"):
-        return
-    await state.clear()
-    await safe_edit(call, "🆕 Guruh nomini kiriting:", kb_home_admin(call.from_user.id))
-    await state.set_state(AState.g_name)
-
-@router.message(AState.g_name)
-async def a_g_add_save(message: Message, state: FSMContext):
-    uid = message.from_user.id
-    if not is_admin(uid) or not has_perm(uid, "groups"):
-        await state.clear()
-        return
-    name = (message.text or "").strip()
-    if len(name) < 2:
-        await message.answer("Guruh nomi qisqa. Qayta kiriting:")
-        return
-
-    conn = db()
-    code = None
-    for _ in range(200):
-        cand = gen_group_code()
-        ex = conn.execute("SELECT 1 FROM groups WHERE invite_code=?", (cand,)).fetchone()
-        if not ex:
-            code = cand
-            break
-    if not code:
-        conn.close()
-        await message.answer("Kod yaratib bo‘lmadi.")
-        await state.clear()
-        return
-
-    conn.execute("INSERT INTO groups(name, invite_code) VALUES (?,?)", (name, code))
-    conn.commit()
-    conn.close()
-
-    await state.clear()
-    await message.answer(f"✅ Guruh yaratildi: <b>{safe_pdf_text(name)}</b>\nKod: <code>{code}</code>",
-                         reply_markup=kb_admin_home(uid))
-
-@router.callback_query(F.data.startswith("a:g:"))
-async def a_group_view(call: CallbackQuery):
-    if not await guard(call, "groups"):
-        return
-    gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT * FROM groups WHERE id=?", (gid,)).fetchone()
-    cnt = conn.execute("SELECT COUNT(*) AS c FROM members WHERE group_id=?", (gid,)).fetchone()
-    conn.close()
-    if not g:
-        await call.answer("Guruh topilmadi.", show_alert=True)
-        return
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="👨‍🎓 O‘quvchilar", callback_data=f"a:g_students:{gid}")],
-        [InlineKeyboardButton(text="🧪 Guruh testlari", callback_data=f"a:g_tests:{gid}")],
-        [InlineKeyboardButton(text="📥 Natija (manual/import)", callback_data=f"a:g_results:{gid}")],
-        [InlineKeyboardButton(text="🗓 Davomat", callback_data=f"a:g_att:{gid}")],
-        [InlineKeyboardButton(text="📌 Vazifalar", callback_data=f"a:g_tasks:{gid}")],
-        [InlineKeyboardButton(text="⚙️ Sozlamalar", callback_data=f"a:g_set:{gid}")],
-        [InlineKeyboardButton(text="🔁 Kod yangilash", callback_data=f"a:g_regen:{gid}")],
-        [InlineKeyboardButton(text="⬅️ Ortga", callback_data="a:groups")],
-        [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
-    ])
-
-    text = (f"📁 <b>{safe_pdf_text(g['name'])}</b>\n"
-            f"🔑 Kod: <code>{g['invite_code']}</code>\n"
-            f"👨‍🎓 O‘quvchilar: <b>{int(cnt['c'])}</b>\n"
-            f"📌 tg_chat_id: <code>{g['tg_chat_id'] if g['tg_chat_id'] else 'yo‘q'}</code>\n"
-            f"🚪 Absent kick limit: <b>{g['att_absent_limit']}</b>\n"
-            f"🚪 Task miss kick limit: <b>{g['task_miss_limit']}</b>\n")
-    await safe_edit(call, text, kb)
-
-@router.callback_query(F.data.startswith("a:g_regen:"))
-async def a_group_regen(call: CallbackQuery):
-    if not await guard(call, "groups"):
-        return
-    gid = int(call.data.split(":")[2])
-    conn = db()
-    code = None
-    for _ in range(200):
-        cand = gen_group_code()
-        ex = conn.execute("SELECT 1 FROM groups WHERE invite_code=?", (cand,)).fetchone()
-        if not ex:
-            code = cand
-            break
-    if not code:
-        conn.close()
-        await call.answer("Kod yaratib bo‘lmadi.", show_alert=True)
-        return
-    conn.execute("UPDATE groups SET invite_code=? WHERE id=?", (code, gid))
-    conn.commit()
-    conn.close()
-    await call.answer("✅ Kod yangilandi", show_alert=True)
-    # refresh view
-    await a_group_view(call)
-# =========================
-# ADMIN: Group Students (list + remove)
-# =========================
-@router.callback_query(F.data.startswith("a:g_students:"))
-async def a_g_students(call: CallbackQuery):
-    if not await guard(call, "groups"):
-        return
-    gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT name, tg_chat_id FROM groups WHERE id=?", (gid,)).fetchone()
-    students = conn.execute("""
-        SELECT u.user_id, u.full_name
-        FROM members m JOIN users u ON u.user_id=m.user_id
-        WHERE m.group_id=?
-        ORDER BY u.full_name
-    """, (gid,)).fetchall()
-    conn.close()
-    if not g:
-        await call.answer("Guruh topilmadi.", show_alert=True)
-        return
-
-    text = f"👨‍🎓 <b>{safe_pdf_text(g['name'])}</b> — O‘quvchilar\n\n"
-    kb_rows = []
-    for i, s in enumerate(students, 1):
-        text += f"{i}. {safe_pdf_text(s['full_name'])}\n"
-        kb_rows.append([InlineKeyboardButton(text=f"❌ {s['full_name'][:18]}", callback_data=f"a:g_kick:{gid}:{s['user_id']}")])
-    kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
-
-    await safe_edit(call, text, InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-@router.callback_query(F.data.startswith("a:g_kick:"))
-async def a_g_kick(call: CallbackQuery):
-    if not await guard(call, "groups"):
-        return
-    _, _, gid, uid = call.data.split(":")
-    gid = int(gid); uid = int(uid)
-
-    conn = db()
-    g = conn.execute("SELECT tg_chat_id FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.execute("DELETE FROM members WHERE group_id=? AND user_id=?", (gid, uid))
-    conn.commit()
-    conn.close()
-
-    # kick from telegram group if chat_id set
-    if g and g["tg_chat_id"]:
-        try:
-            await call.bot.ban_chat_member(chat_id=int(g["tg_chat_id"]), user_id=uid)
-            await call.bot.unban_chat_member(chat_id=int(g["tg_chat_id"]), user_id=uid)
-        except:
-            pass
-
-    await call.answer("Chiqarildi", show_alert=True)
-    await a_g_students(call)
-
-# =========================
-# ADMIN: Group Settings
-# =========================
-@router.callback_query(F.data.startswith("a:g_set:"))
-async def a_g_set(call: CallbackQuery):
-    if not await guard(call, "groups"):
-        return
-    gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT * FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
-    if not g:
-        await call.answer("Guruh topilmadi.", show_alert=True)
-        return
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💬 tg_chat_id sozlash", callback_data=f"a:gs_chat:{gid}")],
-        [InlineKeyboardButton(text="🚪 Absent kick limit", callback_data=f"a:gs_att:{gid}")],
-        [InlineKeyboardButton(text="🚪 Task miss kick limit", callback_data=f"a:gs_task:{gid}")],
-        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}")],
-        [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
-    ])
-    text = (f"⚙️ <b>Sozlamalar</b>\nGuruh: <b>{safe_pdf_text(g['name'])}</b>\n\n"
-            f"tg_chat_id: <code>{g['tg_chat_id'] if g['tg_chat_id'] else 'yo‘q'}</code>\n"
-            f"Absent kick limit: <b>{g['att_absent_limit']}</b>\n"
-            f"Task miss kick limit: <b>{g['task_miss_limit']}</b>\n\n"
-            f"tg_chat_id — Telegram guruh ID (minus bilan), masalan: -1001234567890\n"
-            f"Botni o‘sha TG guruhda admin qiling.")
-    await safe_edit(call, text, kb)
-
-@router.callback_query(F.data.startswith("a:gs_chat:"))
-async def a_gs_chat(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "groups"):
-        return
-    gid = int(call.data.split(":")[2])
-    await state.clear()
-    await state.update_data(gid=gid)
-    await safe_edit(call, "💬 tg_chat_id kiriting (masalan: -1001234567890). Bekor qilish: /cancel", kb_home_admin(call.from_user.id))
-    await state.set_state(AState.gs_chatid)
-
-@router.message(AState.gs_chatid)
-async def a_gs_chat_save(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "groups"):
-        await state.clear()
-        return
-    data = await state.get_data()
-    gid = int(data["gid"])
-    v = (message.text or "").strip()
-    chat_id = safe_int(v)
-    if chat_id is None:
-        await message.answer("❌ Raqam bo‘lishi kerak. Masalan: -1001234567890")
-        return
-    conn = db()
-    conn.execute("UPDATE groups SET tg_chat_id=? WHERE id=?", (chat_id, gid))
-    conn.commit()
-    conn.close()
-    await state.clear()
-    await message.answer("✅ Saqlandi", reply_markup=kb_admin_home(message.from_user.id))
-
-@router.callback_query(F.data.startswith("a:gs_att:"))
-async def a_gs_att(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "groups"):
-        return
-    gid = int(call.data.split(":")[2])
-    await state.clear()
-    await state.update_data(gid=gid)
-    await safe_edit(call, "🚪 Absent kick limit kiriting (masalan: 5):", kb_home_admin(call.from_user.id))
-    await state.set_state(AState.gs_att_limit)
-
-@router.message(AState.gs_att_limit)
-async def a_gs_att_save(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "groups"):
-        await state.clear()
-        return
-    data = await state.get_data()
-    gid = int(data["gid"])
-    lim = safe_int((message.text or "").strip())
-    if lim is None or lim < 1:
-        await message.answer("❌ 1 dan katta raqam kiriting.")
-        return
-    conn = db()
-    conn.execute("UPDATE groups SET att_absent_limit=? WHERE id=?", (lim, gid))
-    conn.commit()
-    conn.close()
-    await state.clear()
-    await message.answer("✅ Saqlandi", reply_markup=kb_admin_home(message.from_user.id))
-
-@router.callback_query(F.data.startswith("a:gs_task:"))
-async def a_gs_task(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "groups"):
-        return
-    gid = int(call.data.split(":")[2])
-    await state.clear()
-    await state.update_data(gid=gid)
-    await safe_edit(call, "🚪 Task miss kick limit kiriting (masalan: 5):", kb_home_admin(call.from_user.id))
-    await state.set_state(AState.gs_task_limit)
-
-@router.message(AState.gs_task_limit)
-async def a_gs_task_save(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "groups"):
-        await state.clear()
-        return
-    data = await state.get_data()
-    gid = int(data["gid"])
-    lim = safe_int((message.text or "").strip())
-    if lim is None or lim < 1:
-        await message.answer("❌ 1 dan katta raqam kiriting.")
-        return
-    conn = db()
-    conn.execute("UPDATE groups SET task_miss_limit=? WHERE id=?", (lim, gid))
-    conn.commit()
-    conn.close()
-    await state.clear()
-    await message.answer("✅ Saqlandi", reply_markup=kb_admin_home(message.from_user.id))
-
-# =========================
-# ATTENDANCE (Group-only) + Archive + Send DM
-# =========================
-def attendance_map(gid: int, date_s: str) -> dict:
-    conn = db()
-    rows = conn.execute("SELECT user_id, status FROM attendance WHERE group_id=? AND att_date=?",
-                        (gid, date_s)).fetchall()
-    conn.close()
-    return {int(r["user_id"]): r["status"] for r in rows}
-
-def group_students(gid: int) -> List[Tuple[int, str]]:
-    conn = db()
-    rows = conn.execute("""
-        SELECT u.user_id, u.full_name
-        FROM members m JOIN users u ON u.user_id=m.user_id
-        WHERE m.group_id=?
-        ORDER BY u.full_name
-    """, (gid,)).fetchall()
-    conn.close()
-    return [(int(r["user_id"]), r["full_name"]) for r in rows]
-
-@router.callback_query(F.data.startswith("a:g_att:"))
-async def a_g_att_menu(call: CallbackQuery):
-    if not await guard(call, "attendance"):
-        return
-    gid = int(call.data.split(":")[2])
-    d = today_str()
-
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
-    if not g:
-        await call.answer("Guruh topilmadi.", show_alert=True)
-        return
-
-    studs = group_students(gid)
-    amap = attendance_map(gid, d)
-
-    # UI: Only mark absent with ❌; default present
-    kb_rows = []
-    for uid, name in studs:
-        st = amap.get(uid, "present")
-        icon = "❌" if st == "absent" else "✅"
-        kb_rows.append([InlineKeyboardButton(
-            text=f"{icon} {name[:22]}",
-            callback_data=f"a:att_t:{gid}:{uid}:{d}"
-        )])
-
-    kb_rows.append([InlineKeyboardButton(text="📨 Yo‘qlarga DM yuborish", callback_data=f"a:att_send:{gid}:{d}")])
-    kb_rows.append([InlineKeyboardButton(text="📄 Hisobot (text)", callback_data=f"a:att_rep:{gid}:{d}")])
-    kb_rows.append([InlineKeyboardButton(text="📥 Hisobot (PDF)", callback_data=f"a:att_pdf:{gid}:{d}")])
-    kb_rows.append([InlineKeyboardButton(text="🗂 Arxiv", callback_data=f"a:att_arc:{gid}")])
-    kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
-
-    await safe_edit(call, f"🗓 <b>Davomat</b>\nGuruh: <b>{safe_pdf_text(g['name'])}</b>\nSana: <code>{d}</code>\n\n"
-                          f"Faqat qatnashmaganlarni ❌ qilib belgilang.", InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-@router.callback_query(F.data.startswith("a:att_t:"))
-async def a_att_toggle(call: CallbackQuery):
-    if not await guard(call, "attendance"):
-        return
-    _, _, gid, uid, d = call.data.split(":")
-    gid = int(gid); uid = int(uid)
-
-    conn = db()
-    cur = conn.execute("""
-        SELECT status FROM attendance WHERE group_id=? AND user_id=? AND att_date=?
-    """, (gid, uid, d)).fetchone()
-
-    if not cur:
-        # mark absent
-        conn.execute("""INSERT OR REPLACE INTO attendance(group_id, user_id, att_date, status)
-                        VALUES (?,?,?,'absent')""", (gid, uid, d))
-    else:
-        # if absent -> remove row (back to present)
-        if cur["status"] == "absent":
-            conn.execute("DELETE FROM attendance WHERE group_id=? AND user_id=? AND att_date=?", (gid, uid, d))
-        else:
-            conn.execute("UPDATE attendance SET status='absent' WHERE group_id=? AND user_id=? AND att_date=?", (gid, uid, d))
-    conn.commit()
-    conn.close()
-
-    await a_g_att_menu(call)
-
-@router.callback_query(F.data.startswith("a:att_rep:"))
-async def a_att_report_text(call: CallbackQuery):
-    if not await guard(call, "attendance"):
-        return
-    _, _, gid, d = call.data.split(":")
-    gid = int(gid)
-
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
-    if not g:
-        await call.answer("Guruh topilmadi.", show_alert=True)
-        return
-
-    studs = group_students(gid)
-    amap = attendance_map(gid, d)
-    absent = [(uid, nm) for uid, nm in studs if amap.get(uid, "present") == "absent"]
-    present = len(studs) - len(absent)
-
-    text = (f"📄 <b>Davomat hisoboti</b>\n"
-            f"Guruh: <b>{safe_pdf_text(g['name'])}</b>\n"
-            f"Sana: <code>{d}</code>\n\n"
-            f"Jami: <b>{len(studs)}</b>\n"
-            f"✅ Qatnashdi: <b>{present}</b>\n"
-            f"❌ Qatnashmadi: <b>{len(absent)}</b>\n\n")
-
-    if absent:
-        text += "❌ <b>QATNASHMAGANLAR:</b>\n"
-        for i, (_uid, nm) in enumerate(absent, 1):
-            text += f"{i}. {safe_pdf_text(nm)}\n"
-    else:
-        text += "✅ Bugun hamma qatnashgan."
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📥 PDF", callback_data=f"a:att_pdf:{gid}:{d}")],
-        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g_att:{gid}")],
-        [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
-    ])
-    await safe_edit(call, text, kb)
-
-@router.callback_query(F.data.startswith("a:att_pdf:"))
-async def a_att_pdf(call: CallbackQuery):
-    if not await guard(call, "attendance"):
-        return
-    _, _, gid, d = call.data.split(":")
-    gid = int(gid)
-
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
-    if not g:
-        await call.answer("Guruh topilmadi.", show_alert=True)
-        return
-
-    studs = group_students(gid)
-    amap = attendance_map(gid, d)
-    rows = [(nm, "absent" if amap.get(uid, "present") == "absent" else "present") for uid, nm in studs]
-
-    fname = f"attendance_G{gid}_{d}.pdf"
-    pdf_attendance(fname, g["name"], d, rows)
-    try:
-        await call.message.answer_document(FSInputFile(fname))
-    finally:
-        try:
-            os.remove(fname)
-        except:
-            pass
-
-@router.callback_query(F.data.startswith("a:att_send:"))
-async def a_att_send(call: CallbackQuery):
-    if not await guard(call, "attendance"):
-        return
-    _, _, gid, d = call.data.split(":")
-    gid = int(gid)
-
-    conn = db()
-    g = conn.execute("SELECT name, tg_chat_id, att_absent_limit FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
-    if not g:
-        await call.answer("Guruh topilmadi.", show_alert=True)
-        return
-
-    studs = group_students(gid)
-    amap = attendance_map(gid, d)
-    absent = [(uid, nm) for uid, nm in studs if amap.get(uid, "present") == "absent"]
-
-    sent = 0
-    for uid, nm in absent:
-        # increment absent counter
-        conn = db()
-        conn.execute("INSERT OR IGNORE INTO counters(group_id, user_id, absent_count, missed_task_count) VALUES (?,?,0,0)",
-                     (gid, uid))
-        conn.execute("UPDATE counters SET absent_count = absent_count + 1 WHERE group_id=? AND user_id=?", (gid, uid))
-        row = conn.execute("SELECT absent_count FROM counters WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-        conn.commit()
-        conn.close()
-
-        cnt_abs = int(row["absent_count"]) if row else 0
-        limit = int(g["att_absent_limit"])
-
-        # DM user
-        try:
-            await call.bot.send_message(
-                uid,
-                f"🗓 <b>Davomat ogohlantirish</b>\n"
-                f"Guruh: <b>{safe_pdf_text(g['name'])}</b>\n"
-                f"Sana: <code>{d}</code>\n\n"
-                f"Siz bugun darsga qatnashmadingiz ❌\n"
-                f"Sababsiz qoldirish: <b>{cnt_abs}/{limit}</b>"
-            )
-            sent += 1
-        except:
-            pass
-
-        # auto-kick if exceeded
-        if cnt_abs >= limit:
-            # remove from DB
-            conn = db()
-            conn.execute("DELETE FROM members WHERE group_id=? AND user_id=?", (gid, uid))
-            conn.commit()
-            conn.close()
-
-            # kick from telegram group if possible
-            if g["tg_chat_id"]:
-                try:
-                    await call.bot.ban_chat_member(chat_id=int(g["tg_chat_id"]), user_id=uid)
-                    await call.bot.unban_chat_member(chat_id=int(g["tg_chat_id"]), user_id=uid)
-                except:
-                    pass
-            try:
-                await call.bot.send_message(uid, f"⛔️ Siz <b>{safe_pdf_text(g['name'])}</b> guruhidan chiqarildingiz (davomat limiti oshdi).")
-            except:
-                pass
-
-    await call.answer(f"Yuborildi: {sent} ta", show_alert=True)
-    await a_g_att_menu(call)
-
-@router.callback_query(F.data.startswith("a:att_arc:"))
-async def a_att_archive(call: CallbackQuery):
-    if not await guard(call, "attendance"):
-        return
-    gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    dates = conn.execute("""
-        SELECT DISTINCT att_date FROM attendance WHERE group_id=? ORDER BY att_date DESC LIMIT 30
-    """, (gid,)).fetchall()
-    conn.close()
-    if not g:
-        await call.answer("Guruh topilmadi.", show_alert=True)
-        return
-
-    kb_rows = []
-    for r in dates:
-        d = r["att_date"]
-        kb_rows.append([InlineKeyboardButton(text=f"📅 {d}", callback_data=f"a:att_rep:{gid}:{d}")])
-    kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g_att:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
-
-    await safe_edit(call, f"🗂 <b>Davomat arxivi</b>\nGuruh: <b>{safe_pdf_text(g['name'])}</b>", InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-# =========================
-# ADMIN: TESTS (create + assign)
-# =========================
-@router.callback_query(F.data == "a:tests")
-async def a_tests(call: CallbackQuery):
-    if not await guard(call, "tests"):
-        return
-    conn = db()
-    rows = conn.execute("SELECT test_id, status, deadline FROM tests ORDER BY created_at DESC LIMIT 30").fetchall()
-    conn.close()
-
-    kb_rows = []
-    for r in rows:
-        st, dl = ensure_deadline(r["test_id"])
-        icon = "🟢" if st == "active" else "⏸" if st == "paused" else "🏁"
-        kb_rows.append([InlineKeyboardButton(text=f"{icon} {r['test_id']} ({st})", callback_data=f"a:t:{r['test_id']}")])
-    kb_rows.append([InlineKeyboardButton(text="➕ Test yaratish", callback_data="a:t_add")])
-    kb_rows.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
-    await safe_edit(call, "🧪 <b>Testlar</b>", InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-@router.callback_query(F.data == "a:t_add")
-async def a_t_add(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "tests"):
-        return
-    await state.clear()
-    await safe_edit(call, "🧩 Javoblar kalitini yuboring (faqat A/B/C/D), masalan: ABCDABCD", kb_home_admin(call.from_user.id))
-    await state.set_state(AState.t_keys)
-
-@router.message(AState.t_keys)
-async def a_t_keys(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tests"):
-        await state.clear()
-        return
-    keys = (message.text or "").upper().strip().replace(" ", "")
-    if not keys or any(ch not in "ABCD" for ch in keys):
-        await message.answer("❌ Faqat A/B/C/D bo‘lsin. Qayta yuboring:")
-        return
-    await state.update_data(keys=keys)
-    await message.answer("⏳ Test davomiyligi (minut) ni kiriting:")
-    await state.set_state(AState.t_minutes)
-
-async def kb_assign_builder(test_id: str, selected: set, is_public: int) -> InlineKeyboardMarkup:
-    conn = db()
-    groups = conn.execute("SELECT id, name FROM groups ORDER BY id DESC").fetchall()
-    conn.close()
-
-    rows = []
-    pub_icon = "🌐✅" if is_public else "🌐❌"
-    rows.append([InlineKeyboardButton(text=f"{pub_icon} Public", callback_data=f"a:t_pub:{test_id}")])
-    for g in groups:
-        gid = int(g["id"])
-        mark = "✅" if gid in selected else "➖"
-        rows.append([InlineKeyboardButton(text=f"{mark} {g['name'][:18]}", callback_data=f"a:t_g:{test_id}:{gid}")])
-    rows.append([InlineKeyboardButton(text="💾 Saqlash", callback_data=f"a:t_save:{test_id}")])
-    rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data="a:tests")])
-    rows.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
-
-@router.message(AState.t_minutes)
-async def a_t_minutes(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tests"):
-        await state.clear()
-        return
-    mins = safe_int((message.text or "").strip())
-    if mins is None or mins < 1:
-        await message.answer("❌ Minut raqam bo‘lsin. Qayta kiriting:")
-        return
-
-    data = await state.get_data()
-    keys = data["keys"]
-    tid = gen_test_id_5()
-    deadline = (datetime.now() + timedelta(minutes=mins)).strftime("%Y-%m-%d %H:%M")
-
-    conn = db()
-    conn.execute("""INSERT INTO tests(test_id, keys, status, deadline, created_at, is_public)
-                    VALUES (?,?,?,?,?,0)""", (tid, keys, "active", deadline, now_str()))
-    conn.commit()
-    conn.close()
-
-    await state.update_data(tid=tid, selected=set(), is_public=0)
-    kb = await kb_assign_builder(tid, set(), 0)
-    await message.answer(
-        f"✅ Test yaratildi: <b>{tid}</b>\nSavollar: <b>{len(keys)}</b>\nDeadline: <code>{deadline}</code>\n\n"
-        f"Endi testni Public yoki guruh(lar)ga biriktiring:",
-        reply_markup=kb
-    )
-    await state.set_state(AState.t_assign)
-
-@router.callback_query(AState.t_assign, F.data.startswith("a:t_pub:"))
-async def a_t_pub(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "tests"):
-        return
-    tid = call.data.split(":")[2]
-    st, _ = ensure_deadline(tid)
-    if st == "finished":
-        await call.answer("Yakunlangan testni o‘zgartirib bo‘lmaydi.", show_alert=True)
-        return
-    data = await state.get_data()
-    is_public = 0 if int(data.get("is_public", 0)) == 1 else 1
-    await state.update_data(is_public=is_public)
-    kb = await kb_assign_builder(tid, set(data.get("selected", set())), is_public)
-    await safe_edit(call, call.message.text, kb)
-
-@router.callback_query(AState.t_assign, F.data.startswith("a:t_g:"))
-async def a_t_toggle_group(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "tests"):
-        return
-    _, _, tid, gid = call.data.split(":")
-    gid = int(gid)
-    data = await state.get_data()
-    selected = set(data.get("selected", set()))
-    is_public = int(data.get("is_public", 0))
-    if gid in selected:
-        selected.remove(gid)
-    else:
-        selected.add(gid)
-    await state.update_data(selected=selected)
-    kb = await kb_assign_builder(tid, selected, is_public)
-    await safe_edit(call, call.message.text, kb)
-
-@router.callback_query(AState.t_assign, F.data.startswith("a:t_save:"))
-async def a_t_assign_save(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "tests"):
-        return
-    tid = call.data.split(":")[2]
-    data = await state.get_data()
-    selected = set(data.get("selected", set()))
-    is_public = int(data.get("is_public", 0))
-
-    conn = db()
-    conn.execute("UPDATE tests SET is_public=? WHERE test_id=?", (is_public, tid))
-    conn.execute("DELETE FROM test_groups WHERE test_id=?", (tid,))
-    for gid in selected:
-        conn.execute("INSERT OR IGNORE INTO test_groups(test_id, group_id) VALUES (?,?)", (tid, gid))
-    conn.commit()
-    conn.close()
-
-    await state.clear()
-    await safe_edit(call, f"✅ Test <b>{tid}</b> saqlandi.\nPublic: <b>{'ON' if is_public else 'OFF'}</b>\nGuruhlar: <b>{', '.join(map(str, selected)) if selected else 'yo‘q'}</b>",
-                    kb_admin_home(call.from_user.id))
-
-# =========================
-# ADMIN: Group Tests list (inside group)
-# =========================
-@router.callback_query(F.data.startswith("a:g_tests:"))
-async def a_g_tests(call: CallbackQuery):
-    if not await guard(call, "tests"):
-        return
-    gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    tests = conn.execute("""
-        SELECT t.test_id, t.status, t.deadline, COALESCE(t.is_public,0) as is_public
-        FROM tests t
-        LEFT JOIN test_groups tg ON tg.test_id=t.test_id
-        WHERE tg.group_id=? OR COALESCE(t.is_public,0)=1
-        GROUP BY t.test_id
-        ORDER BY t.created_at DESC
-        LIMIT 30
-    """, (gid,)).fetchall()
-    conn.close()
-    if not g:
-        await call.answer("Guruh topilmadi.", show_alert=True)
-        return
-
-    kb_rows = []
-    for t in tests:
-        st, _ = ensure_deadline(t["test_id"])
-        icon = "🟢" if st == "active" else "⏸" if st == "paused" else "🏁"
-        kb_rows.append([InlineKeyboardButton(text=f"{icon} {t['test_id']}", callback_data=f"a:t:{t['test_id']}")])
-    kb_rows.append([InlineKeyboardButton(text="➕ Test yaratish", callback_data="a:t_add")])
-    kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
-
-    await safe_edit(call, f"🧪 <b>{safe_pdf_text(g['name'])}</b> — Testlar", InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-# =========================
-# ADMIN: Test options + rating (text+pdf)
-# =========================
-@router.callback_query(F.data.startswith("a:t:"))
-async def a_t_opt(call: CallbackQuery):
-    if not await guard(call, "tests"):
-        return
-    tid = call.data.split(":")[2]
-    st, dl = ensure_deadline(tid)
-    if st is None:
-        await call.answer("Test topilmadi.", show_alert=True)
-        return
-
-    conn = db()
-    row = conn.execute("SELECT COALESCE(is_public,0) as p FROM tests WHERE test_id=?", (tid,)).fetchone()
-    groups = conn.execute("SELECT group_id FROM test_groups WHERE test_id=? ORDER BY group_id", (tid,)).fetchall()
-    conn.close()
-
-    is_public = int(row["p"]) if row else 0
-    grp_list = ", ".join(str(int(g["group_id"])) for g in groups) if groups else "yo‘q"
-
-    kb_rows = []
-    if st == "active":
-        kb_rows.append([InlineKeyboardButton(text="⏸ Pauza", callback_data=f"a:t_pause:{tid}")])
-    if st == "paused":
-        kb_rows.append([InlineKeyboardButton(text="▶️ Davom", callback_data=f"a:t_resume:{tid}")])
-    if st != "finished":
-        kb_rows.append([InlineKeyboardButton(text="🏁 Yakunlash", callback_data=f"a:t_finish:{tid}")])
-    kb_rows.append([InlineKeyboardButton(text="🏆 Reyting (text)", callback_data=f"a:t_rate:{tid}")])
-    kb_rows.append([InlineKeyboardButton(text="📥 Reyting (PDF)", callback_data=f"a:t_pdf:{tid}")])
-    if st != "finished":
-        kb_rows.append([InlineKeyboardButton(text="🔁 Biriktirish", callback_data=f"a:t_reassign:{tid}")])
-    kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data="a:tests"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
-
-    text = (f"⚙️ <b>Test</b>: <code>{tid}</code>\n"
-            f"Holat: <b>{st}</b>\n"
-            f"Deadline: <code>{dl}</code>\n"
-            f"Public: <b>{'ON' if is_public else 'OFF'}</b>\n"
-            f"Guruhlar: <code>{grp_list}</code>\n\n"
-            f"📌 PDF faqat test yakunlanganda ma’qul (ammo bu yerda har doim ochiladi).")
-    await safe_edit(call, text, InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-@router.callback_query(F.data.startswith("a:t_pause:"))
-async def a_t_pause(call: CallbackQuery):
-    if not await guard(call, "tests"):
-        return
-    tid = call.data.split(":")[2]
-    conn = db()
-    conn.execute("UPDATE tests SET status='paused' WHERE test_id=?", (tid,))
-    conn.commit(); conn.close()
-    await call.answer("Pauza", show_alert=True)
-    await a_t_opt(call)
-
-@router.callback_query(F.data.startswith("a:t_resume:"))
-async def a_t_resume(call: CallbackQuery):
-    if not await guard(call, "tests"):
-        return
-    tid = call.data.split(":")[2]
-    st, _ = ensure_deadline(tid)
-    if st == "finished":
-        await call.answer("Yakunlangan testni davom ettirib bo‘lmaydi.", show_alert=True)
-        return
-    conn = db()
-    conn.execute("UPDATE tests SET status='active' WHERE test_id=?", (tid,))
-    conn.commit(); conn.close()
-    await call.answer("Davom", show_alert=True)
-    await a_t_opt(call)
-
-@router.callback_query(F.data.startswith("a:t_finish:"))
-async def a_t_finish(call: CallbackQuery):
-    if not await guard(call, "tests"):
-        return
-    tid = call.data.split(":")[2]
-    conn = db()
-    conn.execute("UPDATE tests SET status='finished' WHERE test_id=?", (tid,))
-    conn.commit(); conn.close()
-    await call.answer("Yakunlandi", show_alert=True)
-    await a_t_opt(call)
-
-@router.callback_query(F.data.startswith("a:t_rate:"))
-async def a_t_rate(call: CallbackQuery):
-    if not await guard(call, "tests"):
-        return
-    tid = call.data.split(":")[2]
-    st, dl = ensure_deadline(tid)
-
-    conn = db()
-    rows = conn.execute("""SELECT full_name, score, total, percent, date
-                           FROM results WHERE test_id=?
-                           ORDER BY percent DESC, score DESC""", (tid,)).fetchall()
-    conn.close()
-    if not rows:
-        await call.answer("Natija yo‘q.", show_alert=True)
-        return
-
-    text = f"🏆 <b>Reyting</b> — <code>{tid}</code>\nHolat: <b>{st}</b> | ⏰ <code>{dl}</code>\n\n"
-    for i, r in enumerate(rows, 1):
-        text += f"{i}. {safe_pdf_text(r['full_name'])} — <b>{r['percent']:.1f}%</b> | {to_uz_time_str(r['date'])}\n"
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📥 PDF", callback_data=f"a:t_pdf:{tid}")],
-        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:t:{tid}")],
-        [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
-    ])
-    await safe_edit(call, text, kb)
-
-@router.callback_query(F.data.startswith("a:t_pdf:"))
-async def a_t_pdf(call: CallbackQuery):
-    if not await guard(call, "tests"):
-        return
-    tid = call.data.split(":")[2]
-
-    conn = db()
-    try:
-        cols = [r[1] for r in conn.execute("PRAGMA table_info(results)").fetchall()]
-        has_score = "score" in cols
-        has_total = "total" in cols
-        has_date = "date" in cols
-
-        select_cols = ["full_name", "percent"]
-        if has_score:
-            select_cols.append("score")
-        if has_total:
-            select_cols.append("total")
-        if has_date:
-            select_cols.append("date")
-
-        q = f"SELECT {', '.join(select_cols)} FROM results WHERE test_id=? ORDER BY percent DESC"
-        rows = conn.execute(q, (tid,)).fetchall()
-    finally:
-        conn.close()
-
-    if not rows:
-        await call.answer("Natija yo‘q.", show_alert=True)
-        return
-
-    fname = f"rating_{tid}.pdf"
-    pdf_rows: List[Tuple[str, int, int, float, str]] = []
-    for r in rows:
-        name = r["full_name"]
-        percent = float(r["percent"] or 0)
-        score = int(r["score"] or 0) if has_score else 0
-        total = int(r["total"] or 0) if has_total else 0
-        date_raw = r["date"] if has_date and r["date"] else ""
-        date_s = to_uz_time_str(date_raw) if date_raw else ""
-        pdf_rows.append((name, score, total, percent, date_s))
-
-    pdf_rating(fname, f"Reyting — Test {tid}", pdf_rows)
-    try:
-        await call.message.answer_document(FSInputFile(fname))
-    finally:
-        try:
-            os.remove(fname)
-        except Exception:
-            pass
-
-@router.callback_query(F.data.startswith("a:t_reassign:"))
-async def a_t_reassign(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "tests"):
-        return
-    tid = call.data.split(":")[2]
-    st, _ = ensure_deadline(tid)
-    if st == "finished":
-        await call.answer("Yakunlangan testni biriktirib bo‘lmaydi.", show_alert=True)
-        return
-
-    conn = db()
-    grp = conn.execute("SELECT group_id FROM test_groups WHERE test_id=?", (tid,)).fetchall()
-    pub = conn.execute("SELECT COALESCE(is_public,0) as p FROM tests WHERE test_id=?", (tid,)).fetchone()
-    conn.close()
-    selected = {int(x["group_id"]) for x in grp}
-    is_public = int(pub["p"]) if pub else 0
-
-    await state.clear()
-    await state.update_data(tid=tid, selected=selected, is_public=is_public)
-    kb = await kb_assign_builder(tid, selected, is_public)
-    await safe_edit(call, "🔁 Biriktirishni yangilang:", kb)
-    await state.set_state(AState.t_assign)
-
-# =========================
-# GROUP RESULTS: manual + import (inside group)
-# =========================
-@router.callback_query(F.data.startswith("a:g_results:"))
-async def a_g_results(call: CallbackQuery):
-    if not await guard(call, "results"):
-        return
-    gid = int(call.data.split(":")[2])
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📝 Manual natija", callback_data=f"a:m_start:{gid}")],
-        [InlineKeyboardButton(text="📥 Import natija", callback_data=f"a:imp_start:{gid}")],
-        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}")],
-        [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
-    ])
-    await safe_edit(call, "📥 <b>Natijalar</b>\nManual yoki Import tanlang:", kb)
-
-@router.callback_query(F.data.startswith("a:m_start:"))
-async def a_m_start(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "results"):
-        return
-    gid = int(call.data.split(":")[2])
-    await state.clear()
-    await state.update_data(gid=gid)
-    await safe_edit(call, "📝 Manual: Test ID kiriting (masalan: 12345):", kb_home_admin(call.from_user.id))
-    await state.set_state(AState.m_tid)
-
-@router.message(AState.m_tid)
-async def a_m_tid(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "results"):
-        await state.clear()
-        return
-    tid = (message.text or "").strip()
-    await state.update_data(tid=tid)
-    await message.answer("Jami savollar soni (total) ni kiriting:")
-    await state.set_state(AState.m_total)
-
-@router.message(AState.m_total)
-async def a_m_total(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "results"):
-        await state.clear()
-        return
-    total = safe_int((message.text or "").strip())
-    if total is None or total < 1:
-        await message.answer("❌ Total raqam bo‘lsin.")
-        return
-    data = await state.get_data()
-    gid = int(data["gid"])
-    students = group_students(gid)
-    if not students:
-        await message.answer("Guruhda o‘quvchi yo‘q.")
-        await state.clear()
-        return
-    await state.update_data(total=total, students=students)
-    preview = "\n".join([f"{i+1}. {nm}" for i, (_uid, nm) in enumerate(students)])
-    await message.answer(
-        f"✅ Endi ballarni ketma-ket yuboring.\n"
-        f"O‘quvchilar: <b>{len(students)}</b>\n\n{safe_pdf_text(preview)}\n\n"
-        f"Format: 10 9 8 ... (bo‘shliq bilan).",
-    )
-    await state.set_state(AState.m_scores)
-
-@router.message(AState.m_scores)
-async def a_m_scores(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "results"):
-        await state.clear()
-        return
-    data = await state.get_data()
-    gid = int(data["gid"])
-    tid = data["tid"]
-    total = int(data["total"])
-    students = data["students"]
-
-    parts = re.split(r"[,\s]+", (message.text or "").strip())
-    scores = [int(p) for p in parts if p.isdigit()]
-    if len(scores) != len(students):
-        await message.answer(f"❌ Ballar soni mos emas. Kerak: {len(students)}, Siz: {len(scores)}")
-        return
-
-    conn = db()
-    dt = now_str()
-    for idx, (uid, nm) in enumerate(students):
-        sc = scores[idx]
-        pct = (sc / total) * 100 if total else 0.0
-        conn.execute("""INSERT INTO results(user_id, test_id, score, total, percent, date, full_name)
-                        VALUES (?,?,?,?,?,?,?)""", (uid, tid, sc, total, pct, dt, nm))
-    conn.commit()
-    conn.close()
-
-    await state.clear()
-    await message.answer(f"✅ Manual natijalar saqlandi.\nTest: <code>{tid}</code>\nGuruh: <code>{gid}</code>", reply_markup=kb_admin_home(message.from_user.id))
-
-@router.callback_query(F.data.startswith("a:imp_start:"))
-async def a_imp_start(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "results"):
-        return
-    gid = int(call.data.split(":")[2])
-    await state.clear()
-    await state.update_data(gid=gid)
-    await safe_edit(call, "📥 Import: Test ID kiriting (natijalar DBda bo‘lishi kerak):", kb_home_admin(call.from_user.id))
-    await state.set_state(AState.imp_tid)
-
-@router.message(AState.imp_tid)
-async def a_imp_tid(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "results"):
-        await state.clear()
-        return
-    tid = (message.text or "").strip()
-    data = await state.get_data()
-    gid = int(data["gid"])
-
-    # Import = show rating for that group & test (no duplication logic here)
-    conn = db()
-    ids = conn.execute("SELECT user_id FROM members WHERE group_id=?", (gid,)).fetchall()
-    user_ids = [int(x["user_id"]) for x in ids]
-    if not user_ids:
-        conn.close()
-        await message.answer("Guruh bo‘sh.")
-        await state.clear()
-        return
-
-    q = ",".join(["?"] * len(user_ids))
-    rows = conn.execute(f"""
-        SELECT full_name, percent, date
-        FROM results
-        WHERE test_id=? AND user_id IN ({q})
-        ORDER BY percent DESC
-    """, (tid, *user_ids)).fetchall()
-    conn.close()
-
-    if not rows:
-        await message.answer("Bu guruhda bu test bo‘yicha natija topilmadi.")
-        await state.clear()
-        return
-
-    text = f"✅ Import topildi.\nTest: <code>{tid}</code>\nGuruh: <code>{gid}</code>\nNatija: <b>{len(rows)}</b> ta\n\n"
-    for i, r in enumerate(rows[:15], 1):
-        text += f"{i}. {safe_pdf_text(r['full_name'])} — {r['percent']:.1f}%\n"
-    if len(rows) > 15:
-        text += f"... yana {len(rows)-15} ta"
-
-    await state.clear()
-    await message.answer(text, reply_markup=kb_admin_home(message.from_user.id))
-
-# =========================
-# TASKS (inside group) — create draft, allow description+media in same message, publish alerts
-# =========================
-@router.callback_query(F.data.startswith("a:g_tasks:"))
-async def a_g_tasks(call: CallbackQuery):
-    if not await guard(call, "tasks"):
-        return
-    gid = int(call.data.split(":")[2])
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    tasks = conn.execute("""SELECT id, title, due_at, status FROM tasks
-                            WHERE group_id=? ORDER BY id DESC LIMIT 20""", (gid,)).fetchall()
-    conn.close()
-    if not g:
-        await call.answer("Guruh topilmadi.", show_alert=True)
-        return
-
-    kb_rows = [[InlineKeyboardButton(text="➕ Vazifa yaratish", callback_data=f"a:task_new:{gid}")]]
-    for t in tasks:
-        st = t["status"]
-        icon = "🟡" if st == "draft" else "🟢" if st == "published" else "🏁"
-        kb_rows.append([InlineKeyboardButton(text=f"{icon} {t['title'][:18]}", callback_data=f"a:task_v:{gid}:{t['id']}")])
-    kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
-
-    await safe_edit(call, f"📌 <b>{safe_pdf_text(g['name'])}</b> — Vazifalar", InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-@router.callback_query(F.data.startswith("a:task_new:"))
-async def a_task_new(call: CallbackQuery, state: FSMContext):
-    if not await guard(call, "tasks"):
-        return
-    gid = int(call.data.split(":")[2])
-    await state.clear()
-    await state.update_data(gid=gid, media=[])
-    await safe_edit(call, "🆕 Vazifa nomini kiriting:", kb_home_admin(call.from_user.id))
-    await state.set_state(AState.task_title)
-
-@router.message(AState.task_title)
-async def a_task_title(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tasks"):
-        await state.clear()
-        return
-    title = (message.text or "").strip()
-    if len(title) < 2:
-        await message.answer("Nom juda qisqa. Qayta kiriting:")
-        return
-    await state.update_data(title=title)
-    await message.answer("📝 Endi <b>description</b> yuboring.\n"
-                         "Bu joyga matn ham, photo/video/audio/document ham yuborsangiz bo‘ladi.\n"
-                         "Agar yana media qo‘shmoqchi bo‘lsangiz, ketma-ket yuboring.\n"
-                         "Tugatish uchun: /done")
-    await state.set_state(AState.task_desc_media)
-
-@router.message(AState.task_desc_media)
-async def a_task_desc_media(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tasks"):
-        await state.clear()
-        return
-
-    if (message.text or "").strip().lower() == "/done":
-        await message.answer("💯 Vazifa ballini kiriting (masalan: 10):")
-        await state.set_state(AState.task_points)
-        return
-
-    data = await state.get_data()
-    desc = data.get("desc", "")
-    media = data.get("media", [])
-
-    # collect text
-    if message.text:
-        desc = (desc + "\n" + message.text.strip()).strip()
-
-    # collect media (file_id)
-    def add_media(ftype: str, fid: str):
-        media.append({"type": ftype, "file_id": fid})
-
-    if message.photo:
-        add_media("photo", message.photo[-1].file_id)
-    elif message.video:
-        add_media("video", message.video.file_id)
-    elif message.document:
-        add_media("document", message.document.file_id)
-    elif message.audio:
-        add_media("audio", message.audio.file_id)
-    elif message.voice:
-        add_media("voice", message.voice.file_id)
-
-    await state.update_data(desc=desc, media=media)
-    await message.answer("✅ Qabul qilindi. Yana qo‘shing yoki /done bosing.")
-
-@router.message(AState.task_points)
-async def a_task_points(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tasks"):
-        await state.clear()
-        return
-    points = safe_int((message.text or "").strip())
-    if points is None or points < 1:
-        await message.answer("❌ 1 dan katta raqam kiriting.")
-        return
-    await state.update_data(points=points)
-    await message.answer("⏰ Deadline kiriting (YYYY-MM-DD HH:MM), masalan: 2026-02-20 18:00")
-    await state.set_state(AState.task_due)
-
-@router.message(AState.task_due)
-async def a_task_due(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "tasks"):
-        await state.clear()
-        return
-    due_s = (message.text or "").strip()
-    try:
-        parse_dt(due_s)
-    except:
-        await message.answer("❌ Format xato. Masalan: 2026-02-20 18:00")
-        return
-
-    data = await state.get_data()
-    gid = int(data["gid"])
-    title = data["title"]
-    desc = data.get("desc", "")
-    points = int(data["points"])
-    media = data.get("media", [])
-
-    conn = db()
-    cur = conn.execute("""INSERT INTO tasks(group_id, title, description, points, due_at, created_at, status)
-                          VALUES (?,?,?,?,?,?, 'draft')""",
-                       (gid, title, desc, points, due_s, now_str()))
-    task_id = cur.lastrowid
-    for m in media:
-        conn.execute("""INSERT INTO task_media(task_id, file_type, file_id) VALUES (?,?,?)""",
-                     (task_id, m["type"], m["file_id"]))
-    conn.commit()
-    conn.close()
-
-    await state.clear()
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📣 Publish", callback_data=f"a:task_pub:{gid}:{task_id}")],
-        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g_tasks:{gid}")],
-        [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
-    ])
-    await message.answer(
-        f"✅ Vazifa draft saqlandi.\n"
-        f"Vazifa: <b>{safe_pdf_text(title)}</b>\n"
-        f"Ball: <b>{points}</b>\n"
-        f"Deadline: <code>{due_s}</code>\n\n"
-        f"Endi publish qiling:",
-        reply_markup=kb
-    )
-
-@router.callback_query(F.data.startswith("a:task_v:"))
-async def a_task_view(call: CallbackQuery):
-    if not await guard(call, "tasks"):
-        return
-    _, _, gid, tid = call.data.split(":")
-    gid = int(gid); tid = int(tid)
-
-    conn = db()
-    t = conn.execute("SELECT * FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    conn.close()
-    if not t:
-        await call.answer("Vazifa topilmadi.", show_alert=True)
-        return
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📣 Publish", callback_data=f"a:task_pub:{gid}:{tid}")],
-        [InlineKeyboardButton(text="📥 Submissions", callback_data=f"a:task_subs:{gid}:{tid}")],
-        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:g_tasks:{gid}")],
-        [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
-    ])
-    text = (f"📌 <b>{safe_pdf_text(t['title'])}</b>\n"
-            f"Status: <b>{t['status']}</b>\n"
-            f"Ball: <b>{t['points']}</b>\n"
-            f"Deadline: <code>{t['due_at']}</code>\n\n"
-            f"{safe_pdf_text(t['description'] or '')[:1500]}")
-    await safe_edit(call, text, kb)
-
-@router.callback_query(F.data.startswith("a:task_subs:"))
-async def a_task_subs(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        return
-    _, _, gid_s, tid_s = call.data.split(":", 3)
-    gid = int(gid_s); tid = int(tid_s)
-
-    conn = db()
-    # task title
-    t = conn.execute("SELECT title, points FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    if not t:
-        conn.close()
-        await call.answer("Vazifa topilmadi.", show_alert=True)
-        return
-
-    subs = conn.execute("""SELECT ts.id AS id, ts.user_id, u.full_name, ts.submitted_at,
-                                    COALESCE(ts.score, -1) AS score
-                             FROM task_submissions ts
-                             JOIN users u ON u.user_id=ts.user_id
-                             WHERE ts.task_id=?
-                             ORDER BY ts.submitted_at DESC""", (tid,)).fetchall()
-    conn.close()
-
-    rows = []
-    for s in subs:
-        score = int(s["score"])
-        score_txt = "⏳ Baholanmagan" if score < 0 else f"⭐ {score}/{int(t['points'])}"
-        rows.append([InlineKeyboardButton(text=f"👤 {s['full_name']} • {score_txt}", callback_data=f"a:task_sub_v:{s['id']}")])
-
-    if not rows:
-        rows.append([InlineKeyboardButton(text="(Topshiriqlar yo‘q)", callback_data="noop")])
-
-    rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:task_v:{gid}:{tid}")])
-    rows.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")])
-
-    await safe_edit(call, f"📨 <b>Topshiriqlar</b>\nVazifa: <b>{safe_pdf_text(t['title'])}</b>", InlineKeyboardMarkup(inline_keyboard=rows))
-
-
-@router.callback_query(F.data.startswith("a:task_sub_v:"))
-async def a_task_sub_view(call: CallbackQuery):
-    if not await guard_call(call, "tasks"):
-        return
-
-    try:
-        parts = call.data.split(":")
-        sub_id = int(parts[-1])
-    except Exception:
-        await call.answer("Noto‘g‘ri so‘rov.", show_alert=True)
-        return
-
-    conn = db()
-    row = conn.execute(
-        "SELECT id, task_id, user_id, msg_json, submitted_at, score, feedback "
-        "FROM task_submissions WHERE id=?",
-        (sub_id,)
-    ).fetchone()
-    if not row:
-        conn.close()
-        await call.answer("Topilmadi.", show_alert=True)
-        return
-
-    sub = dict(row)
-    trow = conn.execute("SELECT group_id, title FROM tasks WHERE id=?", (sub["task_id"],)).fetchone()
-    conn.close()
-    gid = int(trow["group_id"]) if trow else 0
-    ttitle = trow["title"] if trow else f"#{sub['task_id']}"
-
-    def _extract_from_msg_json(s: str):
-        try:
-            d = json.loads(s) if s else {}
-        except Exception:
-            d = {}
-        txt = d.get("text") or ""
-        cap = d.get("caption") or ""
-
-        if d.get("photo"):
-            ph = d["photo"][-1] if isinstance(d["photo"], list) else d["photo"]
-            fid = (ph or {}).get("file_id")
-            return ("photo", fid, cap or txt)
-
-        if d.get("video"):
-            fid = (d["video"] or {}).get("file_id")
-            return ("video", fid, cap or txt)
-
-        if d.get("document"):
-            fid = (d["document"] or {}).get("file_id")
-            return ("document", fid, cap or txt)
-
-        if d.get("audio"):
-            fid = (d["audio"] or {}).get("file_id")
-            return ("audio", fid, cap or txt)
-
-        if d.get("voice"):
-            fid = (d["voice"] or {}).get("file_id")
-            return ("voice", fid, cap or txt)
-
-        return ("text", None, txt or cap)
-
-    ctype, file_id, text = _extract_from_msg_json(sub.get("msg_json") or "")
-
-    header = (
-        f"📝 <b>Vazifa yuborilishi</b>\n"
-        f"Vazifa: <b>{ttitle}</b>\n"
-        f"Sub ID: <code>{sub['id']}</code>\n"
-        f"User: <code>{sub['user_id']}</code>\n"
-        f"Sana: <code>{sub.get('submitted_at','')}</code>\n"
-    )
-    if sub.get("score") is not None:
-        header += f"✅ Baholangan: <b>{sub['score']}</b> ball\n"
-    if sub.get("feedback"):
-        header += f"💬 Izoh: {sub['feedback']}\n"
-
-    # resend attachment/text to admin (separate message)
-    try:
-        if ctype == "photo" and file_id:
-            await call.message.answer_photo(file_id, caption=(text or "")[:900])
-        elif ctype == "video" and file_id:
-            await call.message.answer_video(file_id, caption=(text or "")[:900])
-        elif ctype == "document" and file_id:
-            await call.message.answer_document(file_id, caption=(text or "")[:900])
-        elif ctype == "audio" and file_id:
-            await call.message.answer_audio(file_id, caption=(text or "")[:900])
-        elif ctype == "voice" and file_id:
-            await call.message.answer_voice(file_id, caption=(text or "")[:900])
-        else:
-            if text:
-                await call.message.answer(f"🗒 Matn:\n{text}")
-    except Exception:
-        pass
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Baholash", callback_data=f"a:task_grade:{gid}:{sub['task_id']}:{sub['user_id']}:{sub_id}")],
-        [InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:task_subs:{gid}:{sub['task_id']}"),
-         InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")]
-    ])
-    await safe_edit(call, header, kb)
-@router.callback_query(F.data.startswith("a:task_grade:"))
-async def a_task_grade_start(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
-        return
-    parts = call.data.split(":")
-    # formats: a:task_grade:gid:tid:uid:sub_id  OR a:task_grade:sub_id
-    sub_id = None
-    if len(parts) >= 6:
-        gid = int(parts[2]); tid = int(parts[3]); uid = int(parts[4]); sub_id = int(parts[5])
-    elif len(parts) >= 3:
-        sub_id = int(parts[2])
-        conn0 = db()
-        r0 = conn0.execute("SELECT task_id, user_id FROM task_submissions WHERE id=?", (sub_id,)).fetchone()
-        if not r0:
-            conn0.close()
-            await call.answer("Topilmadi.", show_alert=True)
-            return
-        tid = int(r0["task_id"]); uid = int(r0["user_id"])
-        g0 = conn0.execute("SELECT group_id FROM tasks WHERE id=?", (tid,)).fetchone()
-        gid = int(g0["group_id"]) if g0 else 0
-        conn0.close()
-    else:
-        await call.answer("Noto‘g‘ri so‘rov.", show_alert=True)
-        return
-
-    conn = db()
-    t = conn.execute("SELECT title, points FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    u = conn.execute("SELECT full_name FROM users WHERE user_id=?", (uid,)).fetchone()
-    conn.close()
-    if not t or not u:
-        await call.answer("Topilmadi.", show_alert=True)
-        return
-
-    await state.update_data(gid=gid, tid=tid, uid=uid, max_points=int(t["points"]), grade_sub_id=sub_id)
-    await state.set_state(AState.grade_score)
-    await call.message.answer(
-        f"⭐ <b>Baholash</b>\nVazifa: <b>{safe_pdf_text(t['title'])}</b>\nO‘quvchi: <b>{safe_pdf_text(u['full_name'])}</b>\n\n"
-        f"0 dan {int(t['points'])} gacha ball kiriting:",
-        reply_markup=kb_cancel_admin()
-    )
+                logging.exception("Outbox: could not mark row %s as %s", row["id"], status)
+
+    async def _run(self, bot: Bot) -> None:
+        released = await run_db(self._release)
+        if released:
+            logging.info("Outbox: %d interrupted send(s) requeued", released)
+        sem = asyncio.Semaphore(max(1, self.workers))
+        purged_at = 0.0
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                rows = await run_db(self._claim)
+                if rows:
+                    await asyncio.gather(*(self._send(bot, sem, r) for r in rows))
+                    continue
+                if time.time() - purged_at > 3600:
+                    purged_at = time.time()
+                    await run_db(self._purge)
+                due = await run_db(self._next_due)
+            except Exception:
+                logging.exception("Outbox loop error")
+                due = None
+            timeout = self.poll if due is None else min(self.poll, max(0.05, due - time.time()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
+    def _metrics(self) -> dict:
+        now = time.time()
+        with db() as conn:
+            by_status = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+            oldest = conn.execute("SELECT MIN(next_at) FROM outbox WHERE status IN ('pending', 'sending') AND next_at <= ?",
+                                  (now,)).fetchone()[0]
+            latency = conn.execute("SELECT AVG(done_at - created_at) FROM outbox WHERE status='sent' AND done_at >= ?",
+                                   (now - 3600,)).fetchone()[0]
+        return {
+            "depth": by_status.get("pending", 0) + by_status.get("sending", 0),
+            "lag_s": round(now - oldest, 1) if oldest else 0,
+            "latency_1h_s": round(latency, 1) if latency is not None else "—",
+            "kept": ", ".join(f"{k}={by_status.get(k, 0)}" for k in ("sent", "blocked", "failed", "cancelled")),
+            "this_run": ", ".join(f"{k}={v}" for k, v in self.counts.items()),
+        }
 
-@router.message(AState.grade_score)
-async def a_task_grade_score(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        await state.clear()
-        return
-    data = await state.get_data()
-    max_points = int(data.get("max_points", 0))
-    try:
-        score = int(message.text.strip())
-    except Exception:
-        await message.answer("Faqat raqam kiriting.", reply_markup=kb_cancel_admin())
-        return
-    if score < 0 or score > max_points:
-        await message.answer(f"Ball 0..{max_points} oralig‘ida bo‘lsin.", reply_markup=kb_cancel_admin())
-        return
+    async def metrics(self) -> dict:
+        """Queue depth, lag (age of the oldest ready row) and send latency, for /db_stats."""
+        return await run_db(self._metrics)
 
-    await state.update_data(score=score)
-    await state.set_state(AState.grade_feedback)
-    await message.answer("💬 Qisqa izoh (ixtiyoriy). Yo‘q bo‘lsa <code>-</code> yozing:", reply_markup=kb_cancel_admin())
 
+OUTBOX = Outbox(OUTBOX_WORKERS, OUTBOX_MAX_ATTEMPTS)
 
-@router.message(AState.grade_feedback)
-async def a_task_grade_finish(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        await state.clear()
-        return
-    data = await state.get_data()
-    gid = int(data["gid"]); tid = int(data["tid"]); uid = int(data["uid"])
-    score = int(data["score"])
-    fb = message.text.strip()
-    if fb == "-":
-        fb = ""
 
-    conn = db()
-    t = conn.execute("SELECT title, points FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    u = conn.execute("SELECT full_name FROM users WHERE user_id=?", (uid,)).fetchone()
-    if not t or not u:
-        conn.close()
-        await state.clear()
-        await message.answer("Topilmadi.", reply_markup=kb_home_admin())
-        return
+# =========================
+# GLOBAL BROADCAST (text + media)
+# =========================
+# A broadcast is a background job: the admin's message is copied to every user by a small worker pool
+# behind one global rate limiter. Progress is checkpointed per batch in broadcast_jobs (users are
+# walked in user_id order, `cursor` = last processed id), so a restart resumes where it stopped;
+# every send is also written to deliveries as it completes, and the resumed batch skips those users.
 
-    conn.execute("""UPDATE task_submissions
-                    SET score=?, feedback=?, graded_by=?, graded_at=?
-                    WHERE task_id=? AND user_id=?""", (score, fb, message.from_user.id, now_str(), tid, uid))
-    conn.commit()
-    conn.close()
+class RateLimiter:
+    """At most `rate` acquisitions per second across all callers; pause() holds everyone (RetryAfter)."""
 
-    # Notify student (Telegram message)
-    try:
-        msg = (f"✅ <b>Vazifa baholandi</b>\n"
-               f"📌 {safe_pdf_text(t['title'])}\n"
-               f"⭐ Ball: <b>{score}/{int(t['points'])}</b>")
-        if fb:
-            msg += f"\n💬 Izoh: {safe_pdf_text(fb)}"
-        await bot.send_message(uid, msg)
-    except Exception:
-        pass
+    def __init__(self, rate: float):
+        self.interval = 1.0 / max(rate, 0.1)
+        self._next = 0.0
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
 
-    await state.clear()
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"a:task_sub_v:{sub_id}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")]])
-    await message.answer("✅ Saqlandi va o‘quvchiga yuborildi.", reply_markup=kb)
+    async def acquire(self) -> None:
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                t = max(now, self._next, self._paused_until)
+                self._next = t + self.interval
+            if t > now:
+                await asyncio.sleep(t - now)
+            # a RetryAfter that arrived while we slept moves everyone behind it
+            if time.monotonic() >= self._paused_until:
+                return
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+BROADCAST_LIMITER = RateLimiter(BROADCAST_RPS)
+BROADCAST_REPORT_EVERY = 3.0  # seconds between progress edits (stays under the per-chat limit)
+_BROADCAST_TASKS: dict = {}  # job_id -> asyncio.Task
+_BROADCAST_CANCEL: set = set()
+
+_BROADCAST_STATUS = {
+    "running": "⏳ Yuborilmoqda",
+    "done": "✅ Yakunlandi",
+    "cancelled": "⛔ To‘xtatildi",
+    "failed": "❌ Xatolik",
+}
+
+
+def _fmt_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "—"
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+
+def _broadcast_text(job_id: int, status: str, total: int, sent: int, failed: int, blocked: int,
+                    rate: float) -> str:
+    done = sent + failed + blocked
+    total = max(total, done)
+    pct = (done * 100 // total) if total else 100
+    eta = (total - done) / rate if (status == "running" and rate > 0) else None
+    return (
+        f"📢 <b>Global xabar #{job_id}</b>\n"
+        f"Holat: <b>{_BROADCAST_STATUS.get(status, status)}</b>\n\n"
+        f"✅ Yuborildi: <b>{sent}</b>\n"
+        f"🚫 Bloklagan: <b>{blocked}</b>\n"
+        f"⚠️ Xato: <b>{failed}</b>\n"
+        f"📊 Jarayon: <b>{done}/{total}</b> ({pct}%)\n"
+        f"⚡ Tezlik: <b>{rate:.1f}</b> msg/s\n"
+        f"⏱ Qolgan vaqt: <b>{_fmt_eta(eta)}</b>"
+    )
 
 
-@router.callback_query(F.data.startswith("a:task_pub:"))
-async def a_task_publish(call: CallbackQuery):
-    if not await guard(call, "tasks"):
-        return
-    _, _, gid, tid = call.data.split(":")
-    gid = int(gid); tid = int(tid)
+def kb_broadcast_cancel(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ To‘xtatish", callback_data=f"a:bc_cancel:{job_id}")],
+    ])
 
-    conn = db()
-    t = conn.execute("SELECT * FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    if not t:
-        conn.close()
-        await call.answer("Vazifa topilmadi.", show_alert=True)
-        return
-    conn.execute("UPDATE tasks SET status='published' WHERE id=?", (tid,))
-    # alert members
-    members = conn.execute("SELECT user_id FROM members WHERE group_id=?", (gid,)).fetchall()
-    conn.commit()
-    conn.close()
 
-    sent = 0
-    for r in members:
-        uid = int(r["user_id"])
+async def _broadcast_one(bot: Bot, src_chat_id: int, src_message_id: int, uid: int) -> Tuple[str, Optional[str]]:
+    """Copy the source message to `uid`; returns (status, error_code) as in classify_send_error()."""
+    for _ in range(3):
+        await BROADCAST_LIMITER.acquire()
         try:
-            await call.bot.send_message(
-                uid,
-                f"📢 <b>Yangi vazifa!</b>\n"
-                f"Guruh: <b>{safe_pdf_text(get_group_name(gid))}</b>\n"
-                f"Vazifa: <b>{safe_pdf_text(t['title'])}</b>\n"
-                f"Ball: <b>{t['points']}</b>\n"
-                f"Deadline: <code>{t['due_at']}</code>\n\n"
-                f"Vazifani topshirish uchun: Guruhlarim → Guruh → Vazifalar"
-            )
-            sent += 1
-        except:
-            pass
-
-    await call.answer(f"Publish ✅ (alert: {sent})", show_alert=True)
-    await a_task_view(call)
-
-def get_group_name(gid: int) -> str:
-    conn = db()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    conn.close()
-    return g["name"] if g else str(gid)
-
-# USER: tasks list + submit
-@router.callback_query(F.data.startswith("u:tasks:"))
-async def u_tasks(call: CallbackQuery):
-    uid = call.from_user.id
-    gid = int(call.data.split(":")[2])
-
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    g = conn.execute("SELECT name FROM groups WHERE id=?", (gid,)).fetchone()
-    tasks = conn.execute("""SELECT id, title, due_at, points
-                            FROM tasks WHERE group_id=? AND status='published'
-                            ORDER BY id DESC LIMIT 20""", (gid,)).fetchall()
-    conn.close()
-    if not mem or not g:
-        await call.answer("Bu guruh sizniki emas.", show_alert=True)
-        return
-
-    kb_rows = []
-    for t in tasks:
-        kb_rows.append([InlineKeyboardButton(
-            text=f"📝 {t['title'][:18]}",
-            callback_data=f"u:task_v:{gid}:{t['id']}"
-        )])
-    kb_rows.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"u:g:{gid}"), InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")])
-
-    await safe_edit(call, f"📌 <b>{safe_pdf_text(g['name'])}</b> — Vazifalar", InlineKeyboardMarkup(inline_keyboard=kb_rows))
-
-@router.callback_query(F.data.startswith("u:task_v:"))
-async def u_task_view(call: CallbackQuery):
-    uid = call.from_user.id
-    _, _, gid, tid = call.data.split(":")
-    gid = int(gid); tid = int(tid)
-
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    t = conn.execute("SELECT * FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    sub = conn.execute("SELECT score, submitted_at FROM task_submissions WHERE task_id=? AND user_id=?", (tid, uid)).fetchone()
-    conn.close()
-
-    if not mem or not t:
-        await call.answer("Topilmadi.", show_alert=True)
-        return
-
-    btns = []
-    if sub:
-        score = sub["score"]
-        score_txt = f"✅ Yuborilgan | Ball: {score if score is not None else 'tekshirilmagan'}"
-        btns.append([InlineKeyboardButton(text=score_txt, callback_data="noop")])
-    else:
-        btns.append([InlineKeyboardButton(text="📤 Vazifani yuborish", callback_data=f"u:task_send:{gid}:{tid}")])
-
-    btns.append([InlineKeyboardButton(text="⬅️ Ortga", callback_data=f"u:tasks:{gid}")])
-    btns.append([InlineKeyboardButton(text="🏠 Menyu", callback_data="u:home")])
-
-    text = (f"📌 <b>{safe_pdf_text(t['title'])}</b>\n"
-            f"Ball: <b>{t['points']}</b>\n"
-            f"Deadline: <code>{t['due_at']}</code>\n\n"
-            f"{safe_pdf_text(t['description'] or '')[:1500]}\n\n"
-            f"📎 Topshirish: istalgan format (text/photo/video/audio/document/voice).")
-    await safe_edit(call, text, InlineKeyboardMarkup(inline_keyboard=btns))
-
-@router.callback_query(F.data.startswith("u:task_send:"))
-async def u_task_send(call: CallbackQuery, state: FSMContext):
-    uid = call.from_user.id
-    _, _, gid, tid = call.data.split(":")
-    gid = int(gid); tid = int(tid)
+            await bot.copy_message(chat_id=uid, from_chat_id=src_chat_id, message_id=src_message_id)
+            return "sent", None
+        except TelegramRetryAfter as e:
+            BROADCAST_LIMITER.pause(e.retry_after)
+        except Exception as e:
+            logging.debug("Broadcast to %s failed: %s", uid, e)
+            return classify_send_error(e)
+    return "failed", "retry_after"
 
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    sub = conn.execute("SELECT 1 FROM task_submissions WHERE task_id=? AND user_id=?", (tid, uid)).fetchone()
-    t = conn.execute("SELECT due_at FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    conn.close()
 
-    if not mem:
-        await call.answer("Bu guruh sizniki emas.", show_alert=True)
-        return
-    if sub:
-        await call.answer("Siz allaqachon yuborgansiz.", show_alert=True)
-        return
-    if not t:
-        await call.answer("Vazifa topilmadi.", show_alert=True)
+async def run_broadcast_job(bot: Bot, job_id: int):
+    job = await db_fetchone("SELECT * FROM broadcast_jobs WHERE id=?", (job_id,))
+    if not job or job["status"] != "running":
         return
+    admin_id = int(job["admin_id"])
+    src_chat_id, src_message_id = int(job["src_chat_id"]), int(job["src_message_id"])
+    prog_id = job["progress_message_id"]
+    total, cursor = int(job["total"] or 0), int(job["cursor"] or 0)
+    counts = {"sent": int(job["sent"] or 0), "failed": int(job["failed"] or 0), "blocked": int(job["blocked"] or 0)}
 
-    # deadline check
-    try:
-        if datetime.now() > parse_dt(t["due_at"]):
-            await call.answer("Deadline o‘tgan. Topshirib bo‘lmaydi.", show_alert=True)
-            return
-    except:
-        pass
-
-    await state.clear()
-    await state.update_data(task_gid=gid, task_id=tid)
-    await safe_edit(call, "📤 Vazifani yuboring (istalgan format). Bekor: /cancel", kb_home_user())
-    # reuse UState.solve_answers? create simple state:
-    await state.set_state(UState.task_submit)  # reuse state for any content
+    sem = asyncio.Semaphore(max(1, BROADCAST_WORKERS))
+    log = DeliveryLog(f"broadcast:{job_id}")
+    t0 = time.monotonic()
+    last_report = 0.0
 
-@router.message(UState.task_submit)
-async def u_task_receive_any(message: Message, state: FSMContext):
-    data = await state.get_data()
-    if "task_id" not in data:
-        return  # this handler is also used by test submit in other flow; guarded there
-    gid = int(data["task_gid"])
-    tid = int(data["task_id"])
-    uid = message.from_user.id
+    def rate() -> float:
+        elapsed = time.monotonic() - t0
+        return (sum(counts.values()) - done0) / elapsed if elapsed > 0 else 0.0
 
-    # verify membership + not already
-    conn = db()
-    mem = conn.execute("SELECT 1 FROM members WHERE group_id=? AND user_id=?", (gid, uid)).fetchone()
-    sub = conn.execute("SELECT 1 FROM task_submissions WHERE task_id=? AND user_id=?", (tid, uid)).fetchone()
-    t = conn.execute("SELECT due_at, title FROM tasks WHERE id=? AND group_id=?", (tid, gid)).fetchone()
-    conn.close()
-    if not mem:
-        await message.answer("Bu guruh sizniki emas.")
-        await state.clear()
-        return
-    if sub:
-        await message.answer("Siz allaqachon yuborgansiz.")
-        await state.clear()
-        return
-    if not t:
-        await message.answer("Vazifa topilmadi.")
-        await state.clear()
-        return
-    try:
-        if datetime.now() > parse_dt(t["due_at"]):
-            await message.answer("Deadline o‘tgan.")
-            await state.clear()
+    async def report(status: str, final: bool = False):
+        if not prog_id:
             return
-    except:
-        pass
-
-    ensure_user(uid, message.from_user.full_name or "No Name")
-    full_name = get_user_name(uid)
-
-    # store full message json (for admin view)
-    msg_json = message.model_dump_json(exclude_none=True)
-
-    conn = db()
-    conn.execute("""INSERT INTO task_submissions(task_id, user_id, full_name, submitted_at, msg_json)
-                    VALUES (?,?,?,?,?)""", (tid, uid, full_name, now_str(), msg_json))
-    conn.commit()
-    conn.close()
-
-    await state.clear()
-    await message.answer("✅ Vazifa qabul qilindi. Tekshiruvdan so‘ng ball qo‘yiladi.", reply_markup=kb_user_home())
-
-# =========================
-# BACKGROUND: enforce kick limits for missed tasks
-# =========================
-async def enforce_kick_limits(bot: Bot):
-    """
-    If task published and due passed, and user didn't submit => missed_task_count++
-    If missed_task_count >= limit => remove + kick from tg group
-    """
-    conn = db()
-    # published tasks past due
-    tasks = conn.execute("""
-        SELECT id, group_id, due_at
-        FROM tasks
-        WHERE status='published'
-    """).fetchall()
-
-    for t in tasks:
+        kb = kb_admin_home(admin_id) if final else kb_broadcast_cancel(job_id)
         try:
-            due = parse_dt(t["due_at"])
-        except:
-            continue
-        if datetime.now() <= due:
-            continue
-
-        gid = int(t["group_id"])
-        task_id = int(t["id"])
+            await bot.edit_message_text(
+                _broadcast_text(job_id, status, total, counts["sent"], counts["failed"], counts["blocked"], rate()),
+                chat_id=admin_id, message_id=int(prog_id), reply_markup=kb,
+            )
+        except Exception:
+            pass
 
-        # get members
-        members = conn.execute("SELECT user_id FROM members WHERE group_id=?", (gid,)).fetchall()
-        limit_row = conn.execute("SELECT tg_chat_id, task_miss_limit FROM groups WHERE id=?", (gid,)).fetchone()
-        tg_chat_id = int(limit_row["tg_chat_id"]) if limit_row and limit_row["tg_chat_id"] else None
-        lim = int(limit_row["task_miss_limit"]) if limit_row else 5
+    async def send(uid: int) -> Tuple[str, Optional[str]]:
+        async with sem:
+            outcome, code = await _broadcast_one(bot, src_chat_id, src_message_id, uid)
+            # per message, so a stop mid-batch does not resend what already went out
+            await log.record(uid, outcome, code)
+            return outcome, code
+
+    # the batch in flight when the job last stopped: its sends are in deliveries past the checkpoint
+    done_past = {int(r["user_id"]): r["status"] for r in await db_fetchall(
+        "SELECT user_id, status FROM deliveries WHERE job=? AND user_id>?", (log.job, cursor))}
+    for st in done_past.values():
+        counts[st] += 1
+    done0 = sum(counts.values())
+
+    status = "running"
+    try:
+        while job_id not in _BROADCAST_CANCEL:
+            rows = await db_fetchall(
+                "SELECT user_id FROM users WHERE user_id>? AND reachable=1 ORDER BY user_id LIMIT ?",
+                (cursor, BROADCAST_BATCH),
+            )
+            if not rows:
+                break
+            uids = [int(r["user_id"]) for r in rows if int(r["user_id"]) not in done_past]
+            for outcome, _code in await asyncio.gather(*(send(u) for u in uids)):
+                counts[outcome] += 1
+            cursor = int(rows[-1]["user_id"])
+            await db_write("UPDATE broadcast_jobs SET cursor=?, sent=?, failed=?, blocked=? WHERE id=?",
+                           (cursor, counts["sent"], counts["failed"], counts["blocked"], job_id))
+            if time.monotonic() - last_report >= BROADCAST_REPORT_EVERY:
+                last_report = time.monotonic()
+                await report(status)
+        status = "cancelled" if job_id in _BROADCAST_CANCEL else "done"
+    except asyncio.CancelledError:
+        # shutdown: leave the job 'running' so on_startup resumes it from the last checkpoint
+        raise
+    except Exception:
+        logging.exception("Broadcast job #%s failed", job_id)
+        status = "failed"
+    finally:
+        _BROADCAST_TASKS.pop(job_id, None)
+        _BROADCAST_CANCEL.discard(job_id)
+    await db_write("UPDATE broadcast_jobs SET status=?, finished_at=? WHERE id=?", (status, now_str(), job_id))
+    await report(status, final=True)
 
-        for m in members:
-            uid = int(m["user_id"])
-            sub = conn.execute("SELECT 1 FROM task_submissions WHERE task_id=? AND user_id=?", (task_id, uid)).fetchone()
-            if sub:
-                continue
 
-            # increment missed_task_count once per task per user: we can mark via a pseudo row in submissions? simplest: use attendance table? We'll use a special log table quickly:
-            conn.execute("""CREATE TABLE IF NOT EXISTS task_miss_log(
-                task_id INTEGER, group_id INTEGER, user_id INTEGER,
-                UNIQUE(task_id, group_id, user_id)
-            )""")
-            already = conn.execute("SELECT 1 FROM task_miss_log WHERE task_id=? AND group_id=? AND user_id=?",
-                                   (task_id, gid, uid)).fetchone()
-            if already:
-                continue
+def start_broadcast_job(bot: Bot, job_id: int) -> None:
+    t = _BROADCAST_TASKS.get(job_id)
+    if t and not t.done():
+        return
+    _BROADCAST_TASKS[job_id] = asyncio.create_task(run_broadcast_job(bot, job_id))
 
-            conn.execute("INSERT OR IGNORE INTO task_miss_log(task_id, group_id, user_id) VALUES (?,?,?)",
-                         (task_id, gid, uid))
-            conn.execute("INSERT OR IGNORE INTO counters(group_id, user_id, absent_count, missed_task_count) VALUES (?,?,0,0)",
-                         (gid, uid))
-            conn.execute("UPDATE counters SET missed_task_count = missed_task_count + 1 WHERE group_id=? AND user_id=?",
-                         (gid, uid))
-            row = conn.execute("SELECT missed_task_count FROM counters WHERE group_id=? AND user_id=?",
-                               (gid, uid)).fetchone()
-            cnt = int(row["missed_task_count"]) if row else 0
-
-            # alert DM
-            try:
-                await bot.send_message(uid, f"⚠️ Vazifa deadline o‘tdi va siz topshirmadingiz.\n"
-                                            f"Jarima: <b>{cnt}/{lim}</b>\n"
-                                            f"Agar limitdan oshsa guruhdan chiqarilasiz.")
-            except:
-                pass
 
-            # kick if exceeded
-            if cnt >= lim:
-                conn.execute("DELETE FROM members WHERE group_id=? AND user_id=?", (gid, uid))
-                if tg_chat_id:
-                    try:
-                        await bot.ban_chat_member(chat_id=tg_chat_id, user_id=uid)
-                        await bot.unban_chat_member(chat_id=tg_chat_id, user_id=uid)
-                    except:
-                        pass
-                try:
-                    await bot.send_message(uid, "⛔️ Vazifalarni bajarmagani uchun guruhdan chiqarildingiz.")
-                except:
-                    pass
+async def resume_broadcast_jobs(bot: Bot):
+    rows = await db_fetchall("SELECT id FROM broadcast_jobs WHERE status='running' ORDER BY id")
+    for r in rows:
+        logging.info("Resuming broadcast job #%s", r["id"])
+        start_broadcast_job(bot, int(r["id"]))
 
-    conn.commit()
-    conn.close()
 
-# =========================
-# GLOBAL BROADCAST (text + media)
-# =========================
 @router.callback_query(F.data == "a:broadcast")
 async def a_broadcast(call: CallbackQuery, state: FSMContext):
     if not await guard(call, "broadcast"):
         return
     await state.clear()
-    await safe_edit(call, "📢 Barcha userlarga yuboriladigan xabarni yuboring (text yoki media). Bekor: /cancel", kb_home_admin(call.from_user.id))
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📶 Yetib borish", callback_data="a:reach")],
+        [InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")],
+    ])
+    await safe_edit(call, "📢 Barcha userlarga yuboriladigan xabarni yuboring (text yoki media). Bekor: /cancel", kb)
     await state.set_state(AState.broadcast_any)
 
 @router.message(AState.broadcast_any)
 async def a_broadcast_send(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id) or not has_perm(message.from_user.id, "broadcast"):
+    if _check_access(message.from_user.id, "broadcast"):
         await state.clear()
         return
-    conn = db()
-    users = conn.execute("SELECT user_id FROM users").fetchall()
-    conn.close()
-
-    sent = 0
-    for r in users:
-        uid = int(r["user_id"])
-        try:
-            # copy message (works for text & most media)
-            await message.copy_to(chat_id=uid)
-            sent += 1
-        except:
-            pass
-
     await state.clear()
-    await message.answer(f"✅ Yuborildi: {sent} ta", reply_markup=kb_admin_home(message.from_user.id))
+    row = await db_fetchone("SELECT COUNT(*) AS c FROM users WHERE reachable=1")
+    total = int(row["c"]) if row else 0
+    _, job_id = await db_write(
+        """INSERT INTO broadcast_jobs(admin_id, src_chat_id, src_message_id, status, total, created_at)
+           VALUES (?,?,?,'running',?,?)""",
+        (message.from_user.id, message.chat.id, message.message_id, total, now_str()),
+    )
+    prog = await message.answer(_broadcast_text(job_id, "running", total, 0, 0, 0, 0.0),
+                                reply_markup=kb_broadcast_cancel(job_id))
+    if prog is not None:
+        await db_write("UPDATE broadcast_jobs SET progress_message_id=? WHERE id=?", (prog.message_id, job_id))
+    start_broadcast_job(message.bot, job_id)
+
+@router.callback_query(F.data.startswith("a:bc_cancel:"))
+async def a_broadcast_cancel(call: CallbackQuery):
+    if not await guard(call, "broadcast"):
+        return
+    job_id = int(call.data.split(":")[2])
+    if job_id in _BROADCAST_TASKS:
+        _BROADCAST_CANCEL.add(job_id)
+    else:
+        await db_write("UPDATE broadcast_jobs SET status='cancelled', finished_at=? WHERE id=? AND status='running'",
+                       (now_str(), job_id))
+    await call.answer("⛔ To‘xtatilmoqda…")
 
 # =========================
 # ADMIN: ADMINS (super only) minimal
@@ -5345,37 +6355,36 @@ async def a_admins(call: CallbackQuery):
     if not is_super(call.from_user.id):
         await call.answer("Faqat super admin.", show_alert=True)
         return
-    conn = db()
-    admins = conn.execute("SELECT user_id, role FROM admins ORDER BY role DESC").fetchall()
-    conn.close()
+    admins = await db_fetchall("SELECT user_id, role FROM admins ORDER BY role DESC")
     text = "👮 <b>Adminlar</b>\n\n" + "\n".join([f"• <code>{a['user_id']}</code> — {a['role']}" for a in admins])
     await safe_edit(call, text, InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🏠 Menyu", callback_data="a:home")]]))
 
-# =========================
-# CANCEL command
-# =========================
-@router.message(Command("cancel"))
-async def cmd_cancel(message: Message, state: FSMContext):
-    await state.clear()
-    uid = message.from_user.id
-    if is_admin(uid):
-        await message.answer("Bekor qilindi.", reply_markup=kb_admin_home(uid))
-    else:
-        await message.answer("Bekor qilindi.", reply_markup=kb_user_home())
-
 # =========================
 # STARTUP TASKS
 # =========================
 async def on_startup(bot: Bot):
-    # periodic enforcement
-    async def loop_kick():
-        while True:
-            try:
-                await enforce_kick_limits(bot)
-            except:
-                pass
-            await asyncio.sleep(300)
-    asyncio.create_task(loop_kick())
+    # test expiry + task enforcement, fired at each deadline
+    asyncio.create_task(DEADLINES.run(bot))
+    # event-loop blocking monitor (numbers in /db_stats)
+    asyncio.create_task(loop_lag_monitor())
+    # re-read admins/admin_permissions edited outside the bot
+    asyncio.create_task(loop_admin_cache())
+    # write attendance sheets left open without Save
+    asyncio.create_task(loop_att_flush())
+    # write-back of FSM states (flows in progress) + expiry of abandoned ones
+    asyncio.create_task(FSM_STORAGE.run())
+    # queued DMs / kicks / backups, including those left by the previous run
+    OUTBOX.start(bot)
+    # broadcasts interrupted by a restart continue from their last checkpoint
+    await resume_broadcast_jobs(bot)
+
+
+async def on_shutdown(bot: Bot):
+    # marks tapped since the last flush
+    await ATT_SHEETS.flush_all()
+    # let the outbox batch in flight finish; the rest is sent after the restart
+    await OUTBOX.stop()
+
 
 
 # =========================
@@ -5436,6 +6445,7 @@ async def main():
     dp.include_router(router)
     try:
         dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
     except Exception:
         pass
     await dp.start_polling(bot)
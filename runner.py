@@ -79,13 +79,18 @@ async def main():
     except Exception:
         pass
 
-    # Startup hooks (if defined)
+    # Startup / shutdown hooks (if defined)
     try:
         if hasattr(app, "on_startup"):
             try:
                 app.dp.startup.register(app.on_startup)
             except Exception:
                 pass
+        if hasattr(app, "on_shutdown"):
+            try:
+                app.dp.shutdown.register(app.on_shutdown)
+            except Exception:
+                pass
     except Exception:
         pass
 